@@ -0,0 +1,22 @@
+"""
+Benchmarks for the grade-report and class-choice pipelines.
+
+:mod:`benchmarks.synthetic` generates realistic vendor exports and
+PowerQuery payloads of any size, and :mod:`benchmarks.run` times each
+stage of the pipelines on them and compares the results with a saved
+baseline. Run it from the repository's root:
+
+    python -m benchmarks.run --sizes 1000 100000
+"""
+
+import os
+import sys
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# The scripts import their sibling modules as top-level modules.
+for _directory in ('', 'grade_reports', 'class_choice'):
+    _directory = os.path.join(REPO_ROOT, _directory).rstrip(os.sep)
+    if _directory not in sys.path:
+        sys.path.insert(0, _directory)
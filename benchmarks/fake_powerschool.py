@@ -0,0 +1,330 @@
+"""
+A local stand-in for the district's PowerSchool server, for measuring
+:mod:`ps_agent`'s throughput, concurrency and retry handling without
+touching the real one.
+
+It serves the OAuth handshake at `/oauth/access_token` and the
+PowerQueries at `/ws/schema/query/com.classchoice.school.<name>` (and
+their `/count`), paginated like the real server and filled with
+:mod:`benchmarks.synthetic` data. Responses can be delayed, a fraction
+of them can fail with 429 or 5xx statuses, and tokens expire, so every
+path through the client gets exercised.
+
+Point the scripts at it with the `PS_URL` and `PS_CREDENTIALS`
+environment variables (see :meth:`FakePowerSchool.environ`), or run it
+on its own:
+
+    python -m benchmarks.fake_powerschool --rows 100000 --latency 0.05
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    raise ImportError('The fake PowerSchool server needs Python 3.7+.')
+
+from benchmarks.synthetic import Synthetic
+
+
+QUERY_PREFIX = '/ws/schema/query/com.classchoice.school.'
+
+
+class FakePowerSchool(object):
+    """
+    A fake PowerSchool server running on a background thread.
+
+    :ivar dict tables: the records returned by each PowerQuery
+    :ivar float latency: seconds every response is delayed by
+    :ivar float jitter: up to this many more seconds of random delay
+    :ivar float error_rate: the fraction of PowerQuery responses
+        replaced by one of `error_statuses`
+    :ivar float retry_after: the `Retry-After` of 429 responses
+    :ivar float token_ttl: the seconds an access token stays valid
+    :ivar Counter stats: what the server has served so far
+    """
+
+    CLIENT_ID = 'fake-client-id'
+    CLIENT_SECRET = 'fake-client-secret'
+
+    def __init__(self,
+                 tables=None,          # type: Optional[Dict[str, List[dict]]]
+                 n_rows=1000,          # type: int
+                 seed=0,               # type: int
+                 latency=0.,           # type: float
+                 jitter=0.,            # type: float
+                 error_rate=0.,        # type: float
+                 error_statuses=(429, 500, 502, 503),  # type: tuple
+                 retry_after=1.,       # type: float
+                 token_ttl=3600.,      # type: float
+                 host='127.0.0.1',     # type: str
+                 port=0                # type: int
+                 ):
+        # type: (...) -> None
+        """
+        :param tables: the records of each PowerQuery, keyed by its URL
+            extension; by default `students` and `sections` generated
+            with :class:`benchmarks.synthetic.Synthetic`
+        :param int n_rows: the size of the generated data
+        :param int seed: seeds the generated data and the injected errors
+        :param int port: the port to listen on; any free one if 0
+        """
+        if tables is None:
+            synthetic = Synthetic(n_rows, seed=seed)
+            tables = {'students': synthetic.student_records(),
+                      'sections': synthetic.section_records()}
+        self.tables = tables
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.retry_after = retry_after
+        self.token_ttl = token_ttl
+        self.stats = Counter()
+        self._tokens = {}  # type: Dict[str, float]
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._credentials_path = None  # type: Optional[str]
+
+        handler = type('Handler', (_Handler,), {'server_state': self})
+        self._httpd = ThreadingHTTPServer((host, port), handler)
+        self._httpd.daemon_threads = True
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def url(self):
+        # type: () -> str
+        host, port = self._httpd.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def start(self):
+        # type: () -> FakePowerSchool
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                            name='fake-powerschool',
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        # type: () -> None
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+        if self._credentials_path is not None:
+            os.remove(self._credentials_path)
+            self._credentials_path = None
+
+    def credentials_path(self):
+        # type: () -> str
+        """
+        Writes a `powerschool-credentials.json` accepted by this server
+        to a temporary file, once, and returns its path.
+        """
+        if self._credentials_path is None:
+            fd, self._credentials_path = tempfile.mkstemp(
+                prefix='fake-powerschool-', suffix='.json')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'PS_CLIENT_ID': self.CLIENT_ID,
+                           'PS_CLIENT_SECRET': self.CLIENT_SECRET}, f)
+        return self._credentials_path
+
+    def environ(self):
+        # type: () -> Dict[str, str]
+        """
+        The environment variables that point :mod:`ps_agent`, and so the
+        scripts, at this server.
+        """
+        return {'PS_URL': self.url,
+                'PS_CREDENTIALS': self.credentials_path()}
+
+    def revoke_tokens(self):
+        # type: () -> None
+        """Invalidates every token handed out, as a server restart would."""
+        with self._lock:
+            self._tokens.clear()
+
+    def _issue_token(self):
+        # type: () -> str
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._tokens[token] = time.time() + self.token_ttl
+        return token
+
+    def _is_valid(self, token):
+        # type: (str) -> bool
+        with self._lock:
+            return self._tokens.get(token, 0) > time.time()
+
+    def _should_fail(self):
+        # type: () -> Optional[int]
+        with self._lock:
+            if self._random.random() < self.error_rate:
+                return self._random.choice(self.error_statuses)
+        return None
+
+    def _delay(self):
+        # type: () -> float
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.jitter)
+
+    def _count(self, key, n=1):
+        # type: (str, int) -> None
+        with self._lock:
+            self.stats[key] += n
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    server_state = None  # type: FakePowerSchool
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format % args)
+
+    def do_POST(self):
+        state = self.server_state
+        state._count('requests')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        url = urlparse(self.path)
+        time.sleep(state._delay())
+
+        if url.path == '/oauth/access_token':
+            form = {k: v[0] for k, v in parse_qs(body).items()}
+            if (form.get('client_id') != state.CLIENT_ID
+                    or form.get('client_secret') != state.CLIENT_SECRET):
+                state._count('rejected_credentials')
+                return self._send(401, {'error': 'invalid_client'})
+            state._count('tokens')
+            return self._send(200, {
+                'access_token': state._issue_token(),
+                'token_type': 'Bearer',
+                # PowerSchool sends the lifetime as a string.
+                'expires_in': str(int(state.token_ttl))
+            })
+
+        if not url.path.startswith(QUERY_PREFIX):
+            return self._send(404, {'message': 'Not Found'})
+        name, _, action = url.path[len(QUERY_PREFIX):].partition('/')
+        if name not in state.tables or action not in ('', 'count'):
+            return self._send(404, {'message': 'Not Found'})
+
+        auth = self.headers.get('Authorization', '')
+        if not (auth.startswith('Bearer ')
+                and state._is_valid(auth[len('Bearer '):])):
+            state._count('unauthorized')
+            return self._send(401, {'message': 'Invalid access token'})
+
+        status = state._should_fail()
+        if status is not None:
+            state._count('errors_{}'.format(status))
+            headers = {}
+            if status == 429:
+                headers['Retry-After'] = str(state.retry_after)
+            return self._send(status, {'message': 'Injected failure'},
+                              headers)
+
+        records = state.tables[name]
+        if action == 'count':
+            state._count('counts')
+            return self._send(200, {'count': len(records)})
+
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        page_size = int(params.get('pagesize', 100))
+        page = int(params.get('page', 1))
+        if page_size:
+            records = records[(page - 1) * page_size:page * page_size]
+        state._count('pages')
+        state._count('records', len(records))
+        if not records:
+            # Past the last page the server returns no `record` at all.
+            return self._send(200, {'name': name})
+        return self._send(200, {'name': name, 'record': records})
+
+    def _send(self, status, body, headers=None):
+        # type: (int, dict, dict) -> None
+        content = json.dumps(body).encode('utf-8')
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            content = gzip.compress(content, compresslevel=1)
+        self.server_state._count('bytes_sent', len(content))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def parse_args(argv=None):
+    # type: (Optional[List[str]]) -> argparse.Namespace
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.fake_powerschool',
+        description='Serve synthetic data as a stand-in PowerSchool.')
+    parser.add_argument('-n', '--rows', type=int, default=1000,
+                        help='the number of sections to generate; the '
+                             'roster is a quarter of that (default: 1000)')
+    parser.add_argument('-p', '--port', type=int, default=8000,
+                        help='the port to listen on (default: 8000)')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='seconds every response is delayed by')
+    parser.add_argument('--jitter', type=float, default=0.,
+                        help='up to this many more seconds of random delay')
+    parser.add_argument('--error-rate', type=float, default=0.,
+                        help='the fraction of queries that fail with a '
+                             '429 or 5xx status')
+    parser.add_argument('--token-ttl', type=float, default=3600.,
+                        help='seconds an access token is valid for '
+                             '(default: 3600)')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> None
+    args = parse_args(argv)
+    server = FakePowerSchool(n_rows=args.rows, seed=args.seed,
+                             latency=args.latency, jitter=args.jitter,
+                             error_rate=args.error_rate,
+                             token_ttl=args.token_ttl, port=args.port)
+    with server:
+        print('Serving a fake PowerSchool at {}. Point the scripts at it '
+              'with:\n'.format(server.url))
+        for name, value in sorted(server.environ().items()):
+            print('    export {}={}'.format(name, value))
+        print('\nPress CTRL+C to stop.')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        print(dict(server.stats))
+
+
+if __name__ == '__main__':
+    main()
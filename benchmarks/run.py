@@ -0,0 +1,452 @@
+"""
+Times each stage of the grade-report and class-choice pipelines on
+synthetic data of several sizes, and compares the results with a saved
+baseline.
+
+Each stage is run `--repeat` times and its fastest wall time kept; its
+peak memory is then measured with :mod:`tracemalloc` in one more run,
+since tracing slows the code down. Both are compared with the baseline
+and any stage more than `--tolerance` worse is reported as a
+regression, in which case the exit status is 1.
+
+Stages that can be checked against the synthetic data's ground truth
+also record their accuracy: the `resolve_students` stage records the
+precision of the student matches and of the suggested ones. A match
+precision below :data:`MIN_MATCH_PRECISION`, or either falling by more
+than :data:`PRECISION_TOLERANCE` from the baseline, is a regression too.
+
+usage: python -m benchmarks.run [--sizes N [N ...]] [--stages NAME ...]
+                                [--baseline PATH] [--save-baseline]
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict, namedtuple
+from typing import Callable, Dict, List, Optional
+
+from benchmarks import REPO_ROOT
+from benchmarks.fake_powerschool import FakePowerSchool
+from benchmarks.synthetic import Synthetic, powerquery_pages
+
+import pandas as pd
+
+import make_classchoice
+import merge_files
+from compact import compact
+from matching import StudentResolver
+from ps_agent import (PSClient, PowerQuery, configure_cache, fetch_sections,
+                      fetch_students)
+from sources import SOURCES, read_checked, read_source, validate
+
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, 'benchmarks', 'baseline.json')
+# The fraction of the students matched that must be the right student.
+MIN_MATCH_PRECISION = .99
+PRECISION_TOLERANCE = .01
+
+
+class CannedQuery(PowerQuery):
+    """
+    A PowerQuery answered from pre-built response bodies instead of the
+    server, so that benchmarks include the decoding of the pages but not
+    the network.
+    """
+
+    _Response = namedtuple('_Response', ['status_code', 'content'])
+
+    def __init__(self, query, records, page_size=None):
+        # type: (PowerQuery, List[dict], int) -> None
+        super(CannedQuery, self).__init__(query.url_ext, dtypes=query.dtypes)
+        self.PAGE_SIZE = page_size or query.PAGE_SIZE
+        self.n_records = len(records)
+        self.pages = powerquery_pages(records, self.PAGE_SIZE)
+
+    @property
+    def url(self):
+        # type: () -> str
+        return 'synthetic/' + self.url_ext
+
+    def _query(self, url, payload):
+        if url.endswith('/count'):
+            body = json.dumps({'count': self.n_records}).encode('utf-8')
+        else:
+            page = int(payload.get('page', 1))
+            if payload.get('pagesize', self.PAGE_SIZE) != self.PAGE_SIZE:
+                raise ValueError('Canned pages hold {} records.'
+                                 .format(self.PAGE_SIZE))
+            body = (self.pages[page - 1] if page <= len(self.pages)
+                    else b'{}')
+        return self._Response(200, body)
+
+
+class Workload(object):
+    """The synthetic inputs of one size, built as stages need them."""
+
+    def __init__(self, n_rows, directory, seed=0):
+        # type: (int, str, int) -> None
+        self.n_rows = n_rows
+        self.directory = directory
+        self.synthetic = Synthetic(n_rows, seed=seed)
+        self._paths = None
+        self._sources = None
+        self._students = None
+        self._server = None
+
+    @property
+    def paths(self):
+        # type: () -> Dict[str, str]
+        if self._paths is None:
+            self._paths = self.synthetic.write_exports(
+                os.path.join(self.directory, str(self.n_rows)))
+        return self._paths
+
+    def install_students(self):
+        # type: () -> None
+        merge_files.fetch_students = CannedQuery(
+            fetch_students, self.synthetic.student_records())
+
+    def install_sections(self):
+        # type: () -> None
+        make_classchoice.fetch_sections = CannedQuery(
+            fetch_sections, self.synthetic.section_records())
+
+    @property
+    def sources(self):
+        # type: () -> Dict[str, pd.DataFrame]
+        if self._sources is None:
+            self._sources = OrderedDict(
+                (name, merge_files.make_source(self.paths[name], name))
+                for name in SOURCES)
+        return self._sources
+
+    @property
+    def students(self):
+        # type: () -> pd.DataFrame
+        if self._students is None:
+            self.install_students()
+            self._students = merge_files.make_student_list()
+        return self._students
+
+    def enrollments(self):
+        # type: () -> pd.DataFrame
+        """
+        Export rows with their true student numbers, the same whichever
+        stages ran before.
+        """
+        synthetic = Synthetic(self.n_rows, seed=self.synthetic.seed)
+        return synthetic.enrollments().rename(
+            columns={'last': 'student_last', 'first': 'student_first'})
+
+    def resolver(self):
+        # type: () -> StudentResolver
+        return StudentResolver(self.students)
+
+    def report(self):
+        # type: () -> tuple
+        """The merged report and where to write it."""
+        report = merge_files.merge_sources(self.sources, self.students)
+        return report, os.path.join(self.directory, str(self.n_rows),
+                                    'grade-reports.csv.gz')
+
+    def http_query(self):
+        # type: () -> PowerQuery
+        """
+        The `sections` query, sent over HTTP to a local
+        :class:`FakePowerSchool` serving this workload's sections.
+        """
+        if self._server is None:
+            self._server = FakePowerSchool(
+                {'sections': self.synthetic.section_records()}).start()
+            # The token handshake reads the credentials from here.
+            os.environ.update(self._server.environ())
+        client = PSClient(base_url=self._server.url)
+        return PowerQuery('sections', client=client,
+                          dtypes=fetch_sections.dtypes)
+
+    def close(self):
+        # type: () -> None
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+    def raw_frame(self):
+        # type: () -> pd.DataFrame
+        """The parsed exports, concatenated, before any categorizing."""
+        return pd.concat([read_source(SOURCES[name], self.paths[name])
+                          .assign(source=name) for name in SOURCES],
+                         join='inner', ignore_index=True)
+
+
+class Stage(namedtuple('Stage', ['name', 'setup', 'run', 'check'])):
+    """
+    A benchmarked step. `setup` takes a :class:`Workload` and returns the
+    arguments passed to `run`; only `run` is timed. `check`, if given,
+    takes the arguments and the result of `run` and returns further
+    metrics, e.g. of accuracy, to record.
+    """
+
+    def __new__(cls, name, setup, run, check=None):
+        return super(Stage, cls).__new__(cls, name, setup, run, check)
+
+
+def match_precision(args, matches):
+    # type: (tuple, pd.DataFrame) -> Dict[str, float]
+    """
+    The fraction of the rows matched, and of those given a suggestion,
+    whose student number is the true one.
+
+    Only the matches of students on the student list count: the synthetic
+    names are so few that many of the others share their exact name with
+    a listed student, which no resolver could tell apart. Suggestions
+    are only made for names that match no one exactly, so all of them
+    count.
+    """
+    resolver, df = args
+    truth = df['student_number'].to_numpy()
+    listed = df['student_number'].isin(resolver.students.index).to_numpy()
+    metrics = {}
+    for metric, column, rows in (
+            ('match_precision', 'student_number', listed),
+            ('suggestion_precision', 'suggested_number', True)):
+        numbers = matches[column]
+        found = numbers.notnull().to_numpy() & rows
+        right = numbers[found].to_numpy(dtype='int64') == truth[found]
+        metrics[metric] = float(right.mean()) if found.any() else 1.
+    return metrics
+
+
+def _source_stage(name):
+    # type: (str) -> Stage
+    return Stage('make_' + name,
+                 lambda workload: (workload.paths[name],),
+                 getattr(merge_files, 'make_' + name))
+
+
+STAGES = OrderedDict((stage.name, stage) for stage in [
+    _source_stage('apex'),
+    _source_stage('idla'),
+    _source_stage('byu'),
+    _source_stage('schoology'),
+    Stage('validate',
+          lambda workload: (workload.paths,),
+          lambda paths: [validate(SOURCES[name], paths[name])
+                         for name in SOURCES]),
+    Stage('read_checked',
+          lambda workload: (workload.paths,),
+          lambda paths: [read_checked(SOURCES[name], paths[name])
+                         for name in SOURCES]),
+    Stage('make_student_list',
+          lambda workload: workload.install_students() or (),
+          merge_files.make_student_list),
+    Stage('resolve_students',
+          lambda workload: (workload.resolver(), workload.enrollments()),
+          lambda resolver, df: resolver.resolve(df),
+          match_precision),
+    Stage('merge_sources',
+          lambda workload: (workload.sources, workload.students),
+          merge_files.merge_sources),
+    Stage('write_report',
+          lambda workload: workload.report(),
+          merge_files.write_report),
+    Stage('compact',
+          lambda workload: (workload.raw_frame(),),
+          # On a copy, since compact() changes the frame it is given.
+          lambda df: compact(df.copy(deep=False))),
+    Stage('build_df',
+          lambda workload: workload.install_sections() or (),
+          make_classchoice.build_df),
+    Stage('fetch_sections_http',
+          lambda workload: (workload.http_query(),),
+          lambda query: query.fetch_frame())
+])
+
+
+def measure(func, args, repeat=3):
+    # type: (Callable, tuple, int) -> Dict[str, float]
+    """
+    :return: the fastest of `repeat` wall times of ``func(*args)``, in
+        seconds, and the peak memory it allocated, in bytes
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func(*args)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': seconds, 'peak_bytes': peak}
+
+
+def run(sizes, stages, directory, repeat=3, seed=0):
+    # type: (List[int], List[str], str, int, int) -> dict
+    """
+    Benchmarks `stages` at each of `sizes`.
+
+    :return: the results keyed by stage then size, as saved to a
+        baseline file
+    """
+    logger = logging.getLogger(__name__)
+    results = OrderedDict((name, OrderedDict()) for name in stages)
+    for n_rows in sizes:
+        logger.info('Generating {:,} rows of synthetic data.'.format(n_rows))
+        workload = Workload(n_rows, directory, seed=seed)
+        try:
+            for name in stages:
+                stage = STAGES[name]
+                args = stage.setup(workload)
+                result = measure(stage.run, args, repeat=repeat)
+                results[name][str(n_rows)] = result
+                logger.info('{:>19} {:>9,} rows {:9.3f} s {:10.1f} MiB'
+                            .format(name, n_rows, result['seconds'],
+                                    result['peak_bytes'] / 2 ** 20))
+                if stage.check is not None:
+                    metrics = stage.check(args, stage.run(*args))
+                    result.update(metrics)
+                    logger.info('{:>19} {}'.format('', ', '.join(
+                        '{} {:.4f}'.format(metric, value)
+                        for metric, value in sorted(metrics.items()))))
+        finally:
+            workload.close()
+    return {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'results': results
+    }
+
+
+def compare(results, baseline, tolerance=.25):
+    # type: (dict, Optional[dict], float) -> List[str]
+    """
+    :return: a description of each stage and size at which `results` is
+        more than `tolerance` (a fraction) slower or more memory hungry
+        than `baseline`, or less accurate than it or than
+        :data:`MIN_MATCH_PRECISION`
+    """
+    regressions = []
+    for name, sizes in results['results'].items():
+        for n_rows, result in sizes.items():
+            precision = result.get('match_precision')
+            if precision is not None and precision < MIN_MATCH_PRECISION:
+                regressions.append(
+                    '{} at {} rows: match_precision {:.4f} is below {}'
+                    .format(name, n_rows, precision, MIN_MATCH_PRECISION))
+            before = (baseline['results'].get(name, {}).get(n_rows)
+                      if baseline is not None else None)
+            if before is None:
+                continue
+            for metric in ('match_precision', 'suggestion_precision'):
+                if metric not in before or metric not in result:
+                    continue
+                if result[metric] < before[metric] - PRECISION_TOLERANCE:
+                    regressions.append(
+                        '{} at {} rows: {} {:.4f} -> {:.4f}'.format(
+                            name, n_rows, metric, before[metric],
+                            result[metric]))
+            for metric in ('seconds', 'peak_bytes'):
+                if not before[metric]:
+                    continue
+                ratio = result[metric] / before[metric]
+                if ratio > 1 + tolerance:
+                    regressions.append(
+                        '{} at {} rows: {} {:.3g} -> {:.3g} ({:+.0%})'.format(
+                            name, n_rows, metric, before[metric],
+                            result[metric], ratio - 1))
+    return regressions
+
+
+def parse_args(argv=None):
+    # type: (Optional[List[str]]) -> argparse.Namespace
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.run',
+        description='Benchmark the pipelines on synthetic data.')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+',
+                        default=DEFAULT_SIZES,
+                        help='numbers of rows per export to benchmark at '
+                             '(default: {})'.format(DEFAULT_SIZES))
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES),
+                        default=list(STAGES), metavar='STAGE',
+                        help='stages to run (default: all of {})'
+                             .format(', '.join(STAGES)))
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='timed runs per stage (default: 3)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seeds the synthetic data (default: 0)')
+    parser.add_argument('-b', '--baseline', default=DEFAULT_BASELINE,
+                        help='the baseline to compare with (default: '
+                             'benchmarks/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('-t', '--tolerance', type=float, default=.25,
+                        help='the fraction by which a stage may get worse '
+                             'before it counts as a regression '
+                             '(default: 0.25)')
+    parser.add_argument('-o', '--output',
+                        help='also write the results to this JSON file')
+    parser.add_argument('-d', '--data-dir',
+                        help='where to write the synthetic exports (default:'
+                             ' a temporary directory)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    args = parse_args(argv)
+    # Only report the benchmark's own progress, not the pipelines'.
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    # Benchmark the pipelines, not the caches in front of them.
+    configure_cache(enabled=False)
+
+    directory = args.data_dir or tempfile.mkdtemp(prefix='ps-bench-')
+    try:
+        results = run(args.sizes, args.stages, directory,
+                      repeat=args.repeat, seed=args.seed)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    status = 0
+    baseline = None
+    if os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, tolerance=args.tolerance)
+    for regression in regressions:
+        logger.warning('REGRESSION ' + regression)
+    if regressions:
+        status = 1
+    elif baseline is not None:
+        logger.info('No regressions against "{}".'.format(args.baseline))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info('Saved the baseline to "{}".'.format(args.baseline))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,349 @@
+"""
+Generates synthetic, but realistically shaped, inputs for the pipelines:
+the four vendor exports read by :mod:`merge_files` -- with the column
+names, formats and quirks (demo students, future classes, missing
+course IDs, "?" grades, misspelt names) of the real ones -- and the
+PowerQuery payloads of the `students` and `sections` queries.
+
+Everything is derived from a seeded random generator, so the same size
+and seed always produce the same files.
+"""
+
+import json
+import os
+from datetime import date, timedelta
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+
+SCHOOL_IDS = np.array([615, 616, 617])
+SCHOOL_WEIGHTS = [.45, .45, .1]
+
+_LAST_PARTS = (
+    ['An', 'Bar', 'Ca', 'Dal', 'Er', 'Fer', 'Gar', 'Hal', 'Ja', 'Kel',
+     'Lo', 'Mar', 'Nor', 'Or', 'Pe', 'Quin', 'Ro', 'San', 'Tor', 'Val'],
+    ['', 'ber', 'ca', 'den', 'ga', 'lin', 'mon', 'ra', 'son', 'ta',
+     'ver', 'wick'],
+    ['', 'er', 'ez', 'ford', 'ley', 'man', 'o', 'ski', 'ton', 'y']
+)
+_FIRST_NAMES = np.array([
+    'Aaron', 'Abigail', 'Adam', 'Aiden', 'Alexis', 'Amelia', 'Andrew',
+    'Ava', 'Benjamin', 'Brooklyn', 'Caleb', 'Chloe', 'Daniel', 'Elijah',
+    'Ella', 'Emily', 'Ethan', 'Evelyn', 'Gabriel', 'Grace', 'Hannah',
+    'Henry', 'Isaac', 'Isabella', 'Jack', 'Jacob', 'James', 'José',
+    'Joshua', 'Kaitlyn', 'Liam', 'Lily', 'Logan', 'Lucas', 'Madison',
+    'Mason', 'Mia', 'Noah', 'Olivia', 'Owen', 'René', 'Samuel', 'Sofia',
+    'Sophia', 'Zoë', 'Mary Kate', 'Anna Marie', 'John Paul'
+])
+_COURSES = np.array([
+    'English 9', 'English 10', 'English 11', 'English 12', 'Algebra I',
+    'Algebra II', 'Geometry', 'Pre-Calculus', 'Biology', 'Chemistry',
+    'Physics', 'Earth Science', 'U.S. History', 'World History',
+    'Government', 'Economics', 'Health', 'Spanish I', 'Spanish II',
+    'Financial Literacy', 'Computer Science', 'Art History'
+])
+_TEACHERS = np.array([
+    'Allen, Karen', 'Baker, Scott', 'Clark, Denise', 'Evans, Tyler',
+    'Foster, Julie', 'Hughes, Brian', 'Jensen, Amy', 'Larsen, Mark',
+    'Nielsen, Paula', 'Olsen, Greg', 'Peterson, Dana', 'Young, Travis'
+])
+
+
+class Synthetic(object):
+    """
+    A roster of students and the enrollments drawn from it.
+
+    :ivar pd.DataFrame roster: one row per student, with the fields of
+        the `students` PowerQuery
+    """
+
+    def __init__(self, n_rows, seed=0, typo_rate=.02, unknown_rate=.01,
+                 today=None):
+        # type: (int, int, float, float, date) -> None
+        """
+        :param int n_rows: the number of rows in each vendor export
+        :param int seed: seeds the random generator
+        :param float typo_rate: the fraction of export rows in which the
+            student's last name is misspelt
+        :param float unknown_rate: the fraction of export rows naming a
+            student who is not on the roster
+        :param today: the date future classes are relative to
+        """
+        self.n_rows = n_rows
+        self.seed = seed
+        self.typo_rate = typo_rate
+        self.unknown_rate = unknown_rate
+        self.today = today or date.today()
+        self.rng = np.random.default_rng(seed)
+        # A student takes about four classes from each vendor.
+        self.roster = self.make_roster(max(n_rows // 4, 50))
+
+    def make_roster(self, n):
+        # type: (int) -> pd.DataFrame
+        rng = self.rng
+        return pd.DataFrame({
+            'student_number': rng.choice(np.arange(100000, 100000 + 4 * n),
+                                         n, replace=False),
+            'school_id': rng.choice(SCHOOL_IDS, n, p=SCHOOL_WEIGHTS),
+            'last_name': self._last_names(n),
+            'first_name': rng.choice(_FIRST_NAMES, n)
+        })
+
+    def _last_names(self, n):
+        # type: (int) -> np.ndarray
+        rng = self.rng
+        names = self._syllables(n)
+        # Some students have double-barrelled or accented names.
+        double = rng.random(n) < .05
+        names[double] += '-' + self._syllables(double.sum())
+        accented = rng.random(n) < .02
+        names[accented] = [name.replace('a', 'á', 1) if 'a' in name
+                           else name + 'ñ' for name in names[accented]]
+        return names
+
+    def _syllables(self, n):
+        # type: (int) -> np.ndarray
+        names = self.rng.choice(_LAST_PARTS[0], n).astype(object)
+        for parts in _LAST_PARTS[1:]:
+            names += self.rng.choice(parts, n)
+        return names
+
+    def enrollments(self):
+        # type: () -> pd.DataFrame
+        """
+        Draws :attr:`n_rows` (student, course) pairs, with the students'
+        names as a vendor would write them.
+        """
+        rng = self.rng
+        n = self.n_rows
+        students = self.roster.iloc[rng.integers(0, len(self.roster), n)]
+        last = students['last_name'].to_numpy().copy()
+        first = students['first_name'].to_numpy().copy()
+
+        typos = np.flatnonzero(rng.random(n) < self.typo_rate)
+        last[typos] = [_transpose(name, i) for name, i
+                       in zip(last[typos], rng.integers(0, 4, len(typos)))]
+        unknown = rng.random(n) < self.unknown_rate
+        last[unknown] = self._last_names(unknown.sum()) + 'ova'
+
+        start = self.today - timedelta(days=120)
+        offsets = rng.integers(0, 100, n)
+        # A few classes have not started yet.
+        offsets[rng.random(n) < .03] += 200
+        return pd.DataFrame({
+            'student_number': students['student_number'].to_numpy(),
+            'last': last,
+            'first': first,
+            'course': rng.choice(_COURSES, n),
+            'section': rng.integers(1, 10, n),
+            'teacher': rng.choice(_TEACHERS, n),
+            'start_date': pd.to_datetime(start) + pd.to_timedelta(offsets,
+                                                                  'D'),
+            'grade': np.round(100 * rng.beta(5, 1.5, n), 2)
+        })
+
+    def apex(self):
+        # type: () -> pd.DataFrame
+        rng = self.rng
+        df = self.enrollments()
+        n = len(df)
+        course_id = pd.Series(2000000 + df['section'] * 1000
+                              + pd.factorize(df['course'])[0], dtype=object)
+        course_id[rng.random(n) < .01] = None
+        last = df['last'].to_numpy()
+        first = df['first'].to_numpy()
+        # Vendors enrol demo students to check their course setup.
+        demo = rng.random(n) < .005
+        last[demo], first[demo] = 'Demo', 'Student'
+        teacher = df['teacher'].str.split(', ', n=1, expand=True)
+        possible = rng.integers(50, 500, n)
+        return pd.DataFrame({
+            'ImportClassroomID': course_id,
+            'ClassroomName': df['course'] + ' - ' + df['section'].astype(str),
+            'TeacherName': teacher[1] + ' ' + teacher[0],
+            'TeacherEmail': teacher[0].str.lower() + '@example.org',
+            'LastName': last,
+            'FirstName': first,
+            'StudentName': last + ', ' + first,
+            'ClassroomStartDate': df['start_date'].dt.strftime('%m/%d/%Y'),
+            'TotalPointsAttempted': (possible * rng.random(n)).astype(int),
+            'TotalPointsPossible': possible,
+            'GradeToDate': np.round(df['grade'] * rng.uniform(.9, 1, n), 2),
+            'OverallGrade': df['grade'],
+            'Status': rng.choice(['Active', 'Completed'], n, p=[.8, .2])
+        })
+
+    def idla(self):
+        # type: () -> pd.DataFrame
+        df = self.enrollments()
+        graded_on = (self.today - timedelta(days=3)).strftime('%m/%d/%Y')
+        return pd.DataFrame({
+            'Student': df['last'] + ',' + df['first'],
+            'Course': df['course'] + ' Sem ' + df['section'].mod(2)
+            .add(1).astype(str),
+            'Start Date': df['start_date'].dt.strftime('%m/%d/%Y'),
+            'End Date': (df['start_date'] + pd.Timedelta(days=120))
+            .dt.strftime('%m/%d/%Y'),
+            'Teacher': df['teacher'],
+            'TeacherEmail': (df['teacher'].str.split(',').str[0].str.lower()
+                             + '@idla.example.org'),
+            'Grade': df['grade'].map('{:.1f}'.format) + ' as of ' + graded_on
+        })
+
+    def schoology(self):
+        # type: () -> pd.DataFrame
+        rng = self.rng
+        df = self.enrollments()
+        n = len(df)
+        grade = df['grade'].astype(object)
+        # Ungraded students have no grade at all.
+        grade[rng.random(n) < .02] = None
+        return pd.DataFrame({
+            'First Name': df['first'],
+            'Last Name': df['last'],
+            'Email': (df['student_number'].astype(str)
+                      + '@students.example.org'),
+            'Course Name': df['course'],
+            'Course Code': df['course'].str.upper().str.replace(' ', '-'),
+            'Section Name': 'Section ' + df['section'].astype(str),
+            'Grading Period Titles': 'Semester 1',
+            'Grade': grade,
+            'Letter Grade': rng.choice(['A', 'B', 'C', 'D', 'F'], n)
+        })
+
+    def byu(self):
+        # type: () -> pd.DataFrame
+        rng = self.rng
+        df = self.enrollments()
+        n = len(df)
+        grade = df['grade'].astype(object)
+        # Grades BYU has not posted yet are shown as question marks.
+        grade[rng.random(n) < .02] = '?'
+        return pd.DataFrame({
+            'Student Name': df['last'] + ', ' + df['first'],
+            'Course': df['course'],
+            'Teacher Name': df['teacher'],
+            'percentage': grade,
+            'letter grade': rng.choice(['A', 'A-', 'B+', 'B', 'C', '?'], n)
+        })
+
+    def write_exports(self, directory):
+        # type: (str) -> Dict[str, str]
+        """
+        Writes the four exports to `directory` under the file names
+        :mod:`merge_files` expects.
+
+        :return: the path of each export, keyed by the source's name
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = {}
+        for name, file_name in (('apex', 'apex.csv'), ('idla', 'idla.csv'),
+                                ('schoology', 'schoology.csv'),
+                                ('byu', 'byu.xlsx')):
+            paths[name] = os.path.join(directory, file_name)
+            df = getattr(self, name)()
+            if file_name.endswith('.xlsx'):
+                write_xlsx(df, paths[name])
+            else:
+                df.to_csv(paths[name], index=False)
+        return paths
+
+    def student_records(self):
+        # type: () -> List[dict]
+        """The roster as the `students` PowerQuery returns it."""
+        return powerquery_records(self.roster, 'students')
+
+    def section_records(self, n=None):
+        # type: (int) -> List[dict]
+        """
+        `n` sections, across four terms and the high schools, as the
+        `sections` PowerQuery returns them; :attr:`n_rows` if None.
+        """
+        rng = self.rng
+        if n is None:
+            n = self.n_rows
+        period = rng.integers(1, 9, n)
+        teacher = rng.integers(0, len(_TEACHERS), n)
+        names = pd.Series(_TEACHERS[teacher]).str.split(', ', n=1,
+                                                        expand=True)
+        course = rng.integers(0, len(_COURSES), n)
+        sections = pd.DataFrame({
+            'course_number': pd.Series(course).map('C{:04d}'.format),
+            'course_name': _COURSES[course],
+            'section_number': np.arange(1, n + 1) % 60000,
+            'expression': (pd.Series(period).astype(str) + '('
+                           + rng.choice(['A', 'B'], n) + ')'),
+            'max_enrollment': rng.choice([25, 30, 35], n),
+            'termid': rng.choice([2900, 2901, 3000, 3001], n),
+            'school_id': rng.choice(SCHOOL_IDS, n, p=SCHOOL_WEIGHTS),
+            'room': pd.Series(rng.integers(100, 300, n)).astype(str),
+            'teacher_id': 200 + teacher,
+            'teacher_last_name': names[0],
+            'teacher_first_name': names[1]
+        })
+        return powerquery_records(sections, 'sections')
+
+
+def _transpose(name, i):
+    # type: (str, int) -> str
+    """Swaps two neighbouring letters of `name`, as a typo would."""
+    i = min(i + 1, len(name) - 2)
+    if i < 1:
+        return name
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def powerquery_records(df, table):
+    # type: (pd.DataFrame, str) -> List[dict]
+    """
+    Turns a frame into PowerQuery records: every value a string, nested
+    under `tables`, and null fields left out.
+    """
+    columns = list(df.columns)
+    values = df.astype(object).where(df.notnull(), None)
+    records = []
+    for row in values.itertuples(index=False, name=None):
+        records.append({'tables': {table: {
+            column: str(value) for column, value in zip(columns, row)
+            if value is not None
+        }}})
+    return records
+
+
+def powerquery_pages(records, page_size=1000):
+    # type: (List[dict], int) -> List[bytes]
+    """
+    Splits records into the JSON response bodies of consecutive pages of
+    a PowerQuery. Past the last page PowerSchool returns an empty object.
+    """
+    pages = []
+    for start in range(0, len(records), page_size):
+        pages.append(json.dumps(
+            {'name': 'page', 'record': records[start:start + page_size]}
+        ).encode('utf-8'))
+    return pages
+
+
+def write_xlsx(df, path):
+    # type: (pd.DataFrame, str) -> None
+    """
+    Writes `df` to an Excel file with openpyxl's write-only mode, which
+    is much faster and leaner than :meth:`pandas.DataFrame.to_excel` on
+    large frames.
+    """
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        df.to_excel(path, index=False)
+        return
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(list(df.columns))
+    for row in df.astype(object).where(df.notnull(), None).itertuples(
+            index=False, name=None):
+        sheet.append(row)
+    workbook.save(path)
@@ -1,43 +1,81 @@
 #!/usr/bin/env python3
+from __future__ import annotations
 
 import argparse
 import logging
+import multiprocessing
 import os
 import platform
 import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple
 
-import pandas as pd
+# The modules shared with the other scripts live one directory up.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import frame_io  # noqa: E402
+import profiling  # noqa: E402
+from compact import compact  # noqa: E402
+from lazy import lazy_import  # noqa: E402
+from profiling import span  # noqa: E402
+from ps_agent import configure_cache, fetch_sections  # noqa: E402
 
+# Imported when first used, so that the command line answers at once.
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
-def to_categories(df: pd.DataFrame, thresh: float = 0.25,
-                  inplace: bool = False) -> Optional[pd.DataFrame]:
+DEFAULT_SCHOOL_IDS = [616]
+OUT_COLS = [
+    'course_number', 'course_name', 'section_number',
+    'teacher_id', 'teacher_name', 'room', 'expression',
+    'termid', 'max_enrollment', 'school_id'
+]
+# Two sections are the same if they agree on everything written out.
+SECTION_KEY = OUT_COLS
+OUT_ORDER = ['course_number', 'expression', 'teacher_id']
+
+
+class ExpansionRule(namedtuple('ExpansionRule',
+                               ['periods', 'to_period', 'section_number'])):
     """
-    Converts all the string columns in a pandas DataFrame to
-    categories if the number of unique elements in that
-    column comprise less than or equal to `thresh` percent
-    of the total number of elements in the column.
+    Copies every section held in one of `periods` into `to_period`, with
+    the section number `section_number`.
     """
-    assert 0 < thresh < 1
-    if not inplace:
-        df = df.copy(deep=True)
 
-    n = len(df)
-    if not n:
-        return df
+    @classmethod
+    def parse(cls, rule: str) -> 'ExpansionRule':
+        """
+        Reads a rule written as "FIRST-LAST:TO_PERIOD:SECTION_NUMBER",
+        e.g. "1-4:7:10099"; a single period may replace the range.
+        """
+        try:
+            periods, to_period, section_number = rule.split(':')
+            first, _, last = periods.partition('-')
+            return cls(tuple(range(int(first), int(last or first) + 1)),
+                       int(to_period), int(section_number))
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f'"{rule}" is not of the form "1-4:7:10099".')
+
+    def __str__(self):
+        return (f'periods {min(self.periods)}-{max(self.periods)} -> '
+                f'period {self.to_period}, section {self.section_number}')
 
-    obj_cols = df.select_dtypes('object')
-    for c in obj_cols:
-        if df[c].nunique() / n <= thresh:
-            df[c] = df[c].astype('category')
 
-    if not inplace:
-        return df
+EXPANSION_RULES = [ExpansionRule(tuple(range(1, 5)), 7, 10099)]
 
 
-def build_df(current_terms: List[int] = None) -> pd.DataFrame:
+def build_df(current_terms: List[int] = None,
+             school_ids: List[int] = None) -> pd.DataFrame:
+    """
+    Fetches every section from PowerSchool and keeps those of the given
+    terms (by default the two most recent) and schools (by default
+    :data:`DEFAULT_SCHOOL_IDS`).
+    """
     logger = logging.getLogger(__name__)
+    if school_ids is None:
+        school_ids = DEFAULT_SCHOOL_IDS
     order = [
         'course_number', 'course_name', 'section_number',
         'expression', 'period', 'semester',
@@ -46,26 +84,141 @@ def build_df(current_terms: List[int] = None) -> pd.DataFrame:
     ]
     numeric_cols = ['period'] + order[6:9] + ['teacher_id']
 
-    sections = pd.DataFrame(fetch_sections())
+    with span('fetch sections') as s:
+        sections = fetch_sections.fetch_frame()
+        s.set(rows=len(sections))
     logger.info('Sections successfully fetched.')
     sections[['period', 'semester']] = (sections['expression']
                                         .str.split(r'(\d).*\(([AB])\)',
                                                    expand=True).iloc[:, 1:3])
-    sections['teacher_name'] = (sections['teacher_last_name'] + ', '
-                                + sections['teacher_first_name'])
+    # The names may be categoricals, which cannot be added.
+    sections['teacher_name'] = sections['teacher_last_name'].str.cat(
+        sections['teacher_first_name'], sep=', ')
     sections[numeric_cols] = sections[numeric_cols].astype('uint16')
     if current_terms is None:
         current_terms = sorted(sections['termid'].unique())[-2:]
         logger.debug(f'No term ID provided. Using term ID(s) {current_terms}.')
     sections = (sections[(sections['termid'].isin(current_terms))
-                         & (sections['school_id'] == 616)]
+                         & (sections['school_id'].isin(school_ids))]
                 .reset_index(drop=True))
     logger.info(f'Keeping only sections for term ID(s) '
-                f'"{list(current_terms)}".')
-    return to_categories(sections)[order]
+                f'"{list(current_terms)}" at school(s) "{list(school_ids)}".')
+    compact(sections)
+    return sections[order]
+
+
+def partition(sections: pd.DataFrame
+              ) -> Dict[Tuple[int, int], pd.DataFrame]:
+    """Splits sections by (school ID, term ID) in a single pass."""
+    return {(int(school_id), int(term_id)): group.reset_index(drop=True)
+            for (school_id, term_id), group
+            in sections.groupby(['school_id', 'termid'], sort=True,
+                                observed=True)}
+
+
+def expand_sections(sections: pd.DataFrame,
+                    rules: Iterable[ExpansionRule] = None
+                    ) -> Tuple[pd.DataFrame, int]:
+    """
+    Applies every expansion rule (by default :data:`EXPANSION_RULES`) to
+    the original sections in one pass, then drops duplicate sections.
+
+    The copies are gathered with a single take of the matching rows.
+    Their expressions are rewritten once per distinct expression rather
+    than once per row, and duplicates are found by hashing
+    :data:`SECTION_KEY` instead of comparing whole rows.
+
+    :return: the sections with their copies, and how many were added
+    """
+    if rules is None:
+        rules = EXPANSION_RULES
+    rules = list(rules)
+    periods = sections['period'].to_numpy()
+    # Sorted, so that categorical expressions still sort by value.
+    expr_codes, expressions = pd.factorize(sections['expression'], sort=True)
+    expressions = np.asarray(expressions, dtype=object)
+
+    rows = [np.arange(len(sections))]
+    codes = [expr_codes]
+    new_periods = []
+    new_numbers = []
+    pool = [expressions]
+    for rule in rules:
+        matched = np.flatnonzero(np.isin(periods, rule.periods))
+        rows.append(matched)
+        # The expression starts with the period, e.g. "1(A)" -> "7(A)".
+        codes.append(expr_codes[matched] + sum(map(len, pool)))
+        pool.append(np.array([str(rule.to_period) + e[1:]
+                              for e in expressions], dtype=object))
+        new_periods.append(np.full(len(matched), rule.to_period))
+        new_numbers.append(np.full(len(matched), rule.section_number))
+    n_copies = sum(len(r) for r in rows[1:])
+
+    out = sections.take(np.concatenate(rows)).reset_index(drop=True)
+    if n_copies:
+        _set_tail(out, 'period', np.concatenate(new_periods))
+        _set_tail(out, 'section_number', np.concatenate(new_numbers))
+    pool_codes, categories = pd.factorize(np.concatenate(pool), sort=True)
+    expression = pool_codes[np.concatenate(codes)]
+    if isinstance(sections['expression'].dtype, pd.CategoricalDtype):
+        out['expression'] = pd.Categorical.from_codes(expression, categories)
+    else:
+        out['expression'] = categories[expression]
+
+    key = pd.util.hash_pandas_object(out[SECTION_KEY], index=False)
+    keep = ~key.duplicated().to_numpy()
+    n_new = int(keep[len(sections):].sum())
+    return out[keep], n_new
+
 
+def _set_tail(df: pd.DataFrame, column: str, values: np.ndarray):
+    """Overwrites the last rows of `column`, keeping its dtype."""
+    if isinstance(df[column].dtype, pd.CategoricalDtype):
+        df[column] = df[column].astype(object)
+    if not pd.api.types.is_numeric_dtype(df[column]):
+        values = values.astype(str)
+    df.iloc[len(df) - len(values):, df.columns.get_loc(column)] = values
 
-def parse_args() -> argparse.Namespace:
+
+def finish_sections(sections: pd.DataFrame,
+                    class_size: Optional[int] = None,
+                    rules: Iterable[ExpansionRule] = None) -> pd.DataFrame:
+    """
+    Overrides the class size if asked, adds the sections made by the
+    expansion `rules` and orders the columns and rows for output.
+    """
+    logger = logging.getLogger(__name__)
+    if class_size:
+        # Copies inherit the size, and duplicates are dropped below.
+        sections = sections.assign(max_enrollment=class_size)
+    with span('expand sections') as s:
+        sections, n_new = expand_sections(sections, rules)
+        s.set(rows=len(sections), new=n_new)
+    logger.debug(f'Created {n_new} new sections.')
+
+    return frame_io.sort_frame(sections[OUT_COLS], OUT_ORDER)
+
+
+def write_partition(key: Tuple[int, int], sections: pd.DataFrame,
+                    directory: Path, class_size: Optional[int] = None,
+                    rules: Iterable[ExpansionRule] = None,
+                    fmt: str = 'csv') -> Tuple[Path, int]:
+    """
+    Finishes the sections of one (school ID, term ID) pair and writes
+    them to `directory` in the format `fmt`.
+
+    :return: the file written and the number of sections in it
+    """
+    school_id, term_id = key
+    output_path = directory / f'class-choice-{school_id}-{term_id}.{fmt}'
+    with span('write partition', school_id=school_id, termid=term_id) as s:
+        output = finish_sections(sections, class_size, rules)
+        frame_io.write_frame(output, output_path, fmt=fmt)
+        s.set(rows=len(output))
+    return output_path, len(output)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', '--term-id', type=str, nargs='?',
                         default=None,
@@ -76,20 +229,74 @@ def parse_args() -> argparse.Namespace:
     default = Path(os.getcwd())/'class-choice.csv'
     rel_default = default.relative_to(os.getcwd())
 
-    parser.add_argument('-o', '--output', type=str, nargs=1,
+    parser.add_argument('-o', '--output', type=str,
                         default=default,
-                        help=f'the output path, (default={rel_default})')
+                        help=f'the output path, (default={rel_default}); '
+                             'with --batch, the output directory')
+    parser.add_argument('--format', choices=frame_io.FORMATS,
+                        help='the output file format; parquet and feather '
+                             'need pyarrow (default: judged from the output '
+                             'path, else csv)')
+    parser.add_argument('--school-ids', type=str,
+                        default=','.join(map(str, DEFAULT_SCHOOL_IDS)),
+                        help='a comma-separated list of the schools to make '
+                             'sections for (default='
+                             f'{",".join(map(str, DEFAULT_SCHOOL_IDS))})')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='write one file per school and term, named '
+                             'class-choice-SCHOOL-TERM.FORMAT, from a single '
+                             'download')
+    parser.add_argument('-e', '--expand', type=ExpansionRule.parse,
+                        action='append', metavar='RULE',
+                        help='copy the sections of some periods into '
+                             'another, written "FIRST-LAST:PERIOD:SECTION"; '
+                             'may be given several times (default='
+                             f'{_rule_string(EXPANSION_RULES[0])})')
+    parser.add_argument('--no-expand', action='store_true',
+                        help='do not add any new sections')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='with --batch, how many files to build at '
+                             'once (default=1)')
     parser.add_argument('-q', '--quiet', action='store_true',
                         help='quiet all console output')
     parser.add_argument('-s', '--class-size', type=int, nargs=1,
                         help='Change all class sizes to given number.')
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument('--refresh', action='store_true',
+                       help='ignore cached PowerSchool results and download '
+                            'them again')
+    cache.add_argument('--offline', action='store_true',
+                       help='use only cached PowerSchool results')
+    parser.add_argument('--cache-ttl', type=float, default=600,
+                        help='seconds for which cached PowerSchool results '
+                             'are reused (default=600)')
+    parser.add_argument('--profile', type=str, metavar='TRACE',
+                        help='write how long each stage took, and how much '
+                             'memory and data it used, to this JSON file')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='with --profile, also measure the memory '
+                             'allocated by each stage (slow)')
+    parser.add_argument('--worker', action='store_true',
+                        help='run in the worker started by worker.py, which '
+                             'has everything loaded already; runs here if '
+                             'there is none')
+
+    return parser.parse_args(argv)
 
-    return parser.parse_args()
 
+def main(argv: Optional[List[str]] = None, interactive: bool = True):
+    """
+    :param argv: the command line arguments; sys.argv by default
+    :param interactive: whether someone may be waiting at a console that
+        closes when the script exits
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    level = logging.ERROR if args.quiet else logging.INFO
+    logging.basicConfig(level=level, format='%(message)s')
+    logger = logging.getLogger(__name__)
 
-def main():
-    args = parse_args()
-    is_windows = platform.system() == 'Windows'
+    is_windows = interactive and platform.system() == 'Windows'
     term_ids = args.term_id
     if term_ids is not None:
         term_ids = [int(term_id.strip()) for term_id in args.term_id.split(',')]
@@ -104,65 +311,143 @@ def main():
 
     if term_ids and any(map(lambda term_id: term_id < 2601, term_ids)):
         raise ValueError('Term ID cannot be less than 2601.')
+    # Before anything is downloaded, e.g. if pyarrow is missing.
+    frame_io.check_format(args.format or frame_io.format_of(args.output))
+
+    if args.worker:
+        import worker
+        argv = [arg for arg in argv if arg != '--worker']
+        if term_ids and args.term_id is None:
+            # The worker cannot ask for them.
+            argv += ['--term-id', ','.join(map(str, term_ids))]
+        status = worker.submit('make_classchoice', argv)
+        if status is not None:
+            sys.exit(status)
+        logger.info('No worker is running; running here.')
 
     output_path = Path(args.output)
-    if output_path.is_dir():
-        output_path /= 'class-choice.csv'
+    if args.format and not (args.batch or output_path.is_dir()):
+        output_path = Path(frame_io.with_format(output_path, args.format))
+    args.format = args.format or frame_io.format_of(output_path)
+    if args.batch:
+        if output_path.suffix:
+            output_path = output_path.parent
+        output_path.mkdir(parents=True, exist_ok=True)
+    elif output_path.is_dir():
+        output_path /= f'class-choice.{args.format}'
 
-    level = logging.ERROR if args.quiet else logging.INFO
-    logging.basicConfig(level=level, format='%(message)s')
+    if args.profile:
+        profiling.enable(trace_memory=args.profile_memory)
+    try:
+        with span('make_classchoice'):
+            if args.batch:
+                run_batch(args, term_ids, output_path)
+            else:
+                run(args, term_ids, output_path)
+    finally:
+        if args.profile:
+            profiling.write(args.profile)
+            logger.info(f'Profile saved to "{args.profile}".')
+
+    if is_windows:
+        logger.info('Operation complete.')
+        input('Press ENTER to exit')
+
+
+def run(args: argparse.Namespace, term_ids: Optional[List[int]],
+        output_path: Path):
     logger = logging.getLogger(__name__)
+    configure_cache(ttl=args.cache_ttl, refresh=args.refresh,
+                    offline=args.offline)
     logger.info('Fetching sections from PowerSchool. '
                 'This may take a few moments.')
 
-    sections = build_df(current_terms=term_ids)
+    with span('build_df') as s:
+        sections = build_df(current_terms=term_ids,
+                            school_ids=parse_ids(args.school_ids))
+        s.set(rows=len(sections))
     if not len(sections):
         raise ValueError(f'No sections found with term ID {term_ids}.')
-    to_copy = (sections[sections['period'].isin(range(1, 5))]
-               .copy(deep=True))
-    logger.info('Creating new sections for period 7.')
-    to_copy['period'] = 7
-    to_copy['expression'] = '7' + to_copy['expression'].str[1:]
-    to_copy['section_number'] = 10099
-    n_new = to_copy.drop_duplicates().shape[0]
-    logger.info(f'Created {n_new} new sections.')
-    logger.info('Merging with original sections.')
-    sections = (pd.concat([sections, to_copy])
-                .drop_duplicates())
-
-    if args.class_size:
-        logger.info(f'Setting class size to {args.class_size}.')
-        sections['max_enrollment'] = args.class_size[0]
-        sections.drop_duplicates(inplace=True)
-
-    logger.info(f'Output contains {sections.shape[0]} total sections.')
-    out_cols = [
-        'course_number', 'course_name', 'section_number',
-        'teacher_id', 'teacher_name', 'room', 'expression',
-        'termid', 'max_enrollment', 'school_id'
-    ]
+    rules = expansion_rules(args)
+    for rule in rules:
+        logger.info(f'Creating new sections: {rule}.')
+    class_size = args.class_size[0] if args.class_size else None
+    if class_size:
+        logger.info(f'Setting class size to {class_size}.')
+    output = finish_sections(sections, class_size, rules)
 
-    logger.info(f'Saving output to "{output_path.relative_to(os.getcwd())}".')
-    output = (sections[out_cols]
-              .sort_values(by=['course_number',
-                               'expression',
-                               'teacher_id']))
-    output.to_csv(output_path, index=False)
+    logger.info(f'Output contains {output.shape[0]} total sections.')
+    logger.info(f'Saving output to "{os.path.relpath(output_path)}".')
+    with span('write output', rows=len(output), format=args.format):
+        frame_io.write_frame(output, output_path, fmt=args.format)
 
     n_samples = 10
     logger.info(f'Printing {n_samples} random entries from output.\n')
     if not args.quiet:
         print(output.sample(n_samples).to_string(index=False))
 
-    if is_windows:
-        logger.info('Operation complete.')
-        input('Press ENTER to exit')
 
+def run_batch(args: argparse.Namespace, term_ids: Optional[List[int]],
+              directory: Path):
+    """
+    Fetches the sections once and writes a file for every school and
+    term among them, in `args.jobs` processes.
+    """
+    logger = logging.getLogger(__name__)
+    configure_cache(ttl=args.cache_ttl, refresh=args.refresh,
+                    offline=args.offline)
+    logger.info('Fetching sections from PowerSchool. '
+                'This may take a few moments.')
+
+    with span('build_df') as s:
+        sections = build_df(current_terms=term_ids,
+                            school_ids=parse_ids(args.school_ids))
+        s.set(rows=len(sections))
+    if not len(sections):
+        raise ValueError(f'No sections found with term ID {term_ids}.')
+    partitions = partition(sections)
+    class_size = args.class_size[0] if args.class_size else None
+    rules = expansion_rules(args)
+    logger.info(f'Writing {len(partitions)} files, one per school and term, '
+                f'to "{os.path.relpath(directory)}".')
 
-if __name__ == '__main__':
-    sys.path.insert(0, '..')
-    from ps_agent import fetch_sections
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [pool.submit(profiling.call, write_partition, key,
+                                   part, directory, class_size, rules,
+                                   args.format, profile=profiling.settings())
+                       for key, part in partitions.items()]
+            results = []
+            for future in futures:
+                result, spans = future.result()
+                profiling.merge(spans)
+                results.append(result)
+    else:
+        results = [write_partition(key, part, directory, class_size, rules,
+                                   args.format)
+                   for key, part in partitions.items()]
+
+    for output_path, n_rows in results:
+        logger.info(f'Saved {n_rows} sections to "{output_path.name}".')
 
+
+def expansion_rules(args: argparse.Namespace) -> List[ExpansionRule]:
+    if args.no_expand:
+        return []
+    return args.expand or EXPANSION_RULES
+
+
+def _rule_string(rule: ExpansionRule) -> str:
+    return (f'{min(rule.periods)}-{max(rule.periods)}:{rule.to_period}:'
+            f'{rule.section_number}')
+
+
+def parse_ids(ids: str) -> List[int]:
+    return [int(i.strip()) for i in ids.split(',') if i.strip()]
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
     try:
         main()
     except Exception as e:
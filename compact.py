@@ -0,0 +1,181 @@
+"""
+Shrinks DataFrames in place by giving each column the narrowest dtype
+that holds its values, so that the frames the scripts concatenate and
+join over and over are cheap to copy.
+
+:func:`compact` looks at every column once:
+
+    - string columns with few distinct values become categoricals, whose
+      categories are sorted so that rows sort as they would as strings;
+      the others can become Arrow-backed strings, if :mod:`pyarrow` is
+      installed
+    - object columns holding only numbers become numeric
+    - integer columns, nullable or not, get the smallest integer type of
+      the same signedness that holds their range
+    - float columns can become float32 where that loses nothing
+
+and returns what it changed, with the bytes saved by each column.
+"""
+
+import logging
+from collections import OrderedDict, namedtuple
+from typing import Dict, Iterable, Optional
+
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+_INTS = {
+    'signed': ['int8', 'int16', 'int32', 'int64'],
+    'unsigned': ['uint8', 'uint16', 'uint32', 'uint64']
+}
+
+
+class Change(namedtuple('Change', ['before', 'after', 'bytes_before',
+                                   'bytes_after'])):
+    """How :func:`compact` changed a column: its dtypes and sizes."""
+
+    @property
+    def saved(self):
+        # type: () -> int
+        return self.bytes_before - self.bytes_after
+
+
+def compact(df,              # type: pd.DataFrame
+            thresh=0.25,     # type: float
+            integers=True,   # type: bool
+            floats=False,    # type: bool
+            strings=None,    # type: Optional[str]
+            exclude=()       # type: Iterable[str]
+            ):
+    # type: (...) -> Dict[str, Change]
+    """
+    Converts the columns of `df`, in place, to narrower dtypes.
+
+    :param float thresh: string columns in which the distinct values are
+        at most this fraction of the rows become categoricals
+    :param bool integers: narrow integer columns
+    :param bool floats: narrow float64 columns to float32 when every
+        value survives the conversion
+    :param str strings: 'pyarrow' to store the remaining string columns
+        as Arrow strings, if pyarrow is installed
+    :param exclude: columns to leave alone
+    :return: the change made to each converted column, in column order
+    """
+    assert 0 < thresh < 1
+    changes = OrderedDict()  # type: Dict[str, Change]
+    n = len(df)
+    if not n:
+        return changes
+    string_dtype = _string_dtype(strings)
+    exclude = set(exclude)
+
+    for column in list(df.columns):
+        if column in exclude:
+            continue
+        values = df[column]
+        dtype = values.dtype
+        if dtype == object or isinstance(dtype, pd.StringDtype):
+            new = _strings(values, thresh * n, string_dtype)
+        elif integers and pd.api.types.is_integer_dtype(dtype):
+            new = _integers(values)
+        elif floats and dtype == np.float64:
+            new = _floats(values)
+        else:
+            new = None
+        if new is None or new.dtype == dtype:
+            continue
+        changes[column] = Change(str(dtype), str(new.dtype),
+                                 values.memory_usage(index=False, deep=True),
+                                 new.memory_usage(index=False, deep=True))
+        df[column] = new
+
+    if changes:
+        logging.getLogger(__name__).debug(
+            'Saved {:,} bytes in {} column(s).'.format(
+                sum(change.saved for change in changes.values()),
+                len(changes)))
+    return changes
+
+
+def _string_dtype(strings):
+    # type: (Optional[str]) -> Optional[pd.StringDtype]
+    if strings is None:
+        return None
+    if strings != 'pyarrow':
+        raise ValueError('Unknown string storage "{}".'.format(strings))
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logging.getLogger(__name__).debug(
+            'pyarrow is not installed; keeping the string columns.')
+        return None
+    return pd.StringDtype('pyarrow')
+
+
+def _strings(values, max_categories, string_dtype):
+    # type: (pd.Series, float, pd.StringDtype) -> Optional[pd.Series]
+    try:
+        # One hashing pass both counts the values and encodes them.
+        codes, uniques = pd.factorize(values, sort=True)
+    except TypeError:
+        # Values of several types, which cannot be sorted together.
+        return None
+    kind = pd.api.types.infer_dtype(uniques, skipna=True)
+    if kind in ('integer', 'floating', 'mixed-integer-float'):
+        # E.g. numbers read from a spreadsheet.
+        return pd.to_numeric(values)
+    if kind not in ('string', 'empty'):
+        return None
+    if len(uniques) <= max_categories:
+        return pd.Series(pd.Categorical.from_codes(codes, categories=uniques),
+                         index=values.index, name=values.name)
+    if string_dtype is not None and pd.api.types.is_string_dtype(values):
+        return values.astype(string_dtype)
+    return None
+
+
+def _integers(values):
+    # type: (pd.Series) -> Optional[pd.Series]
+    if values.isnull().all():
+        return None
+    low, high = values.min(), values.max()
+    kind = ('unsigned' if pd.api.types.is_unsigned_integer_dtype(values.dtype)
+            else 'signed')
+    for candidate in _INTS[kind]:
+        info = np.iinfo(candidate)
+        if info.min <= low and high <= info.max:
+            break
+    if np.dtype(candidate).itemsize >= values.dtype.itemsize:
+        return None
+    if isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+        # Keep nullable columns nullable, e.g. UInt64 -> UInt16.
+        return values.astype(nullable_dtype(candidate))
+    return values.astype(candidate)
+
+
+def nullable_dtype(dtype):
+    # type: (object) -> str
+    """
+    Maps a NumPy integer dtype, or its name, to pandas' nullable
+    equivalent, e.g. "uint16" to "UInt16". Other dtypes are returned by
+    name, unchanged.
+    """
+    name = str(dtype)
+    if name.startswith('uint'):
+        return 'UInt' + name[len('uint'):]
+    if name.startswith('int'):
+        return 'Int' + name[len('int'):]
+    return name
+
+
+def _floats(values):
+    # type: (pd.Series) -> Optional[pd.Series]
+    narrow = values.to_numpy().astype(np.float32)
+    wide = values.to_numpy()
+    same = (narrow.astype(np.float64) == wide) | np.isnan(wide)
+    if not same.all():
+        return None
+    return pd.Series(narrow, index=values.index, name=values.name)
@@ -0,0 +1,169 @@
+"""
+Writes the scripts' output frames, and reads them back, in one of
+:data:`FORMATS`:
+
+    - csv: plain CSV, as opened by Excel
+    - csv.gz: gzipped CSV
+    - parquet: Apache Parquet, which keeps categories and nullable
+      integers and is far faster to load
+    - feather: Apache Arrow IPC, the fastest to load from pandas
+
+The Parquet and Feather formats need :mod:`pyarrow`. Frames are written
+a chunk of rows at a time, so that no complete text or Arrow copy of a
+large frame is ever held in memory, and are only sorted when they are
+not already in order.
+"""
+
+import gzip
+import os
+from typing import List, Optional
+
+from lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+
+FORMATS = ['csv', 'csv.gz', 'parquet', 'feather']
+CHUNKSIZE = 100000
+
+
+def format_of(path, default='csv'):
+    # type: (str, str) -> str
+    """The format of `path`, judged by its extension."""
+    name = os.path.basename(str(path)).lower()
+    for fmt in sorted(FORMATS, key=len, reverse=True):
+        if name.endswith('.' + fmt):
+            return fmt
+    return default
+
+
+def with_format(path, fmt):
+    # type: (str, str) -> str
+    """Replaces the extension of `path` with that of `fmt`."""
+    path = str(path)
+    current = format_of(path, default=None)
+    if current is not None:
+        path = path[:-len(current) - 1]
+    else:
+        path = os.path.splitext(path)[0]
+    return path + '.' + fmt
+
+
+def is_sorted(df, by):
+    # type: (pd.DataFrame, List[str]) -> bool
+    """
+    Whether `df` is already sorted by the columns `by` in ascending
+    order, as :meth:`pandas.DataFrame.sort_values` would leave it.
+    Missing values count as out of order.
+    """
+    if len(df) < 2:
+        return True
+    return pd.MultiIndex.from_frame(df[by]).is_monotonic_increasing
+
+
+def sort_frame(df, by):
+    # type: (pd.DataFrame, List[str]) -> pd.DataFrame
+    """Sorts `df` by `by`, unless it already is."""
+    if is_sorted(df, by):
+        return df
+    return df.sort_values(by=by)
+
+
+def check_format(fmt):
+    # type: (str) -> None
+    """
+    Checks that frames can be written in `fmt`, so that scripts can fail
+    before doing the work of making them.
+
+    :raises ValueError: if `fmt` is not one of :data:`FORMATS`
+    :raises ImportError: if `fmt` needs :mod:`pyarrow` and it is missing
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown output format "{}".'.format(fmt))
+    if fmt in ('parquet', 'feather'):
+        _pyarrow(fmt)
+
+
+def write_frame(df, path, fmt=None, sort_by=None, chunksize=CHUNKSIZE):
+    # type: (pd.DataFrame, str, str, List[str], int) -> None
+    """
+    Writes `df`, without its index, to `path`. The file is written under
+    a temporary name and then renamed, so that readers never see it half
+    written.
+
+    :param fmt: one of :data:`FORMATS`; by default judged from the
+        extension of `path`
+    :param sort_by: columns to sort by first, if not already sorted
+    :param int chunksize: the number of rows converted at a time
+    """
+    if fmt is None:
+        fmt = format_of(path)
+    check_format(fmt)
+    if sort_by:
+        df = sort_frame(df, sort_by)
+    df = df.reset_index(drop=True)
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        _write(df, tmp_path, fmt, chunksize)
+        os.replace(tmp_path, str(path))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write(df, path, fmt, chunksize):
+    # type: (pd.DataFrame, str, str, int) -> None
+    if fmt in ('csv', 'csv.gz'):
+        opener = gzip.open if fmt == 'csv.gz' else open
+        options = {'compresslevel': 6} if fmt == 'csv.gz' else {}
+        with opener(path, 'wt', newline='', **options) as f:
+            for start in range(0, max(len(df), 1), chunksize):
+                df.iloc[start:start + chunksize].to_csv(
+                    f, index=False, header=start == 0)
+        return
+
+    pa = _pyarrow(fmt)
+    # Taken from the whole frame, so that a column empty in the first
+    # chunk still gets its proper type.
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        # Feather (version 2) files are LZ4-compressed Arrow IPC files.
+        codec = 'lz4' if pa.Codec.is_available('lz4') else None
+        writer = pa.ipc.new_file(
+            path, schema, options=pa.ipc.IpcWriteOptions(compression=codec))
+    try:
+        for start in range(0, len(df), chunksize):
+            writer.write_table(pa.Table.from_pandas(
+                df.iloc[start:start + chunksize], schema=schema,
+                preserve_index=False))
+    finally:
+        writer.close()
+
+
+def read_frame(path, fmt=None, **kwargs):
+    # type: (str, Optional[str], ...) -> pd.DataFrame
+    """
+    Reads a file written by :func:`write_frame`. Extra keyword arguments
+    go to the pandas reader.
+    """
+    if fmt is None:
+        fmt = format_of(path)
+    if fmt in ('csv', 'csv.gz'):
+        return pd.read_csv(path, **kwargs)
+    _pyarrow(fmt)
+    if fmt == 'parquet':
+        return pd.read_parquet(path, **kwargs)
+    return pd.read_feather(path, **kwargs)
+
+
+def _pyarrow(fmt):
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('The {} format needs pyarrow; install it with '
+                          '"pip install pyarrow" or choose csv.'.format(fmt))
+    return pyarrow
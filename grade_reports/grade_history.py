@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+"""
+Keeps every merged grade report in a local SQLite database, so that a
+student's grades can be followed from week to week without opening old
+CSV files.
+
+The database is append-only: each run of `merge_files.py` adds its rows
+as a new run, and triggers refuse any change to rows already stored.
+Rows are indexed by student number, by run and source, and by course,
+so the queries below read only the rows they return. When a day has
+several runs, the queries use the last one of that day.
+
+    history = GradeHistory('grade-history.sqlite')
+    history.append(report)
+    history.trajectory(123456)
+
+It also has a command line:
+
+    python grade_history.py trajectory 123456
+    python grade_history.py failing --date 2020-03-02
+    python grade_history.py distribution --course Algebra
+    python grade_history.py import old/grade-reports.csv --date 2020-01-06
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+from datetime import date, datetime
+from os import path
+from typing import Iterable, Optional, Union
+
+# The modules shared with the other scripts live one directory up.
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+import frame_io  # noqa: E402
+from lazy import lazy_import  # noqa: E402
+
+pd = lazy_import('pandas')
+
+
+HISTORY_PATH = path.join(path.dirname(path.realpath(__file__)),
+                         'grade-history.sqlite')
+COLUMNS = ['student_number', 'student_last', 'student_first', 'course',
+           'source', 'grade', 'letter_grade']
+FAILING = ('F',)
+
+_SCHEMA_VERSION = 1
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    run_date TEXT NOT NULL,
+    recorded_at TEXT NOT NULL,
+    n_rows INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_date ON runs (run_date);
+CREATE TABLE IF NOT EXISTS grades (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    source TEXT NOT NULL,
+    student_number INTEGER,
+    student_last TEXT,
+    student_first TEXT,
+    course TEXT,
+    grade REAL,
+    letter_grade TEXT
+);
+CREATE INDEX IF NOT EXISTS grades_student
+    ON grades (student_number, run_id);
+CREATE INDEX IF NOT EXISTS grades_run_source ON grades (run_id, source);
+CREATE INDEX IF NOT EXISTS grades_course ON grades (course, run_id);
+CREATE TRIGGER IF NOT EXISTS runs_append_only_update
+    BEFORE UPDATE ON runs
+    BEGIN SELECT RAISE(ABORT, 'the grade history is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS runs_append_only_delete
+    BEFORE DELETE ON runs
+    BEGIN SELECT RAISE(ABORT, 'the grade history is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS grades_append_only_update
+    BEFORE UPDATE ON grades
+    BEGIN SELECT RAISE(ABORT, 'the grade history is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS grades_append_only_delete
+    BEFORE DELETE ON grades
+    BEGIN SELECT RAISE(ABORT, 'the grade history is append-only'); END;
+"""
+# The last run of every day.
+_DAILY_RUNS = 'SELECT max(run_id) FROM runs GROUP BY run_date'
+
+
+class GradeHistory(object):
+    """
+    The merged reports of every past run, in a SQLite database.
+
+    :ivar str path: the database file
+    """
+
+    def __init__(self, path=HISTORY_PATH):
+        # type: (str) -> None
+        """
+        :param str path: the database file; created, readable by the owner
+            only, if it does not exist
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version > _SCHEMA_VERSION:
+            raise ValueError('"{}" was written by a newer version of this '
+                             'script.'.format(path))
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+            self.connection.execute('PRAGMA user_version = {}'
+                                    .format(_SCHEMA_VERSION))
+        # The write-ahead log holds grades too. SQLite gives it the
+        # database's mode, but an older database may have been created
+        # readable by everyone.
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.chmod(path + suffix, 0o600)
+
+    def append(self, report, run_date=None):
+        # type: (pd.DataFrame, Optional[date]) -> int
+        """
+        Adds a merged report as a new run.
+
+        :param report: the output of :func:`merge_files.merge_sources`
+        :param run_date: the day the report describes; today by default
+        :return: the new run's ID
+        """
+        run_date = _iso(run_date or date.today())
+        rows = report[COLUMNS].astype(object)
+        rows = rows.where(rows.notnull(), None)
+        # Student numbers may come out of the merge as floats.
+        rows['student_number'] = [None if n is None else int(n)
+                                  for n in rows['student_number']]
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (run_date, recorded_at, n_rows) '
+                'VALUES (?, ?, ?)',
+                (run_date, datetime.now().isoformat(timespec='seconds'),
+                 len(rows)))
+            run_id = cursor.lastrowid
+            self.connection.executemany(
+                'INSERT INTO grades (run_id, {}) VALUES (?{})'.format(
+                    ', '.join(COLUMNS), ', ?' * len(COLUMNS)),
+                ((run_id,) + row for row
+                 in rows.itertuples(index=False, name=None)))
+        return run_id
+
+    def runs(self):
+        # type: () -> pd.DataFrame
+        """Every run stored, oldest first."""
+        return self._query('SELECT run_id, run_date, recorded_at, n_rows '
+                           'FROM runs ORDER BY run_id')
+
+    def run_id(self, run_date=None):
+        # type: (Optional[date]) -> Optional[int]
+        """
+        The last run on or before `run_date`, or the last of all if it is
+        not given; None if there is none.
+        """
+        if run_date is None:
+            row = self.connection.execute('SELECT max(run_id) FROM runs')
+        else:
+            row = self.connection.execute(
+                'SELECT max(run_id) FROM runs WHERE run_date = '
+                '(SELECT max(run_date) FROM runs WHERE run_date <= ?)',
+                (_iso(run_date),))
+        return row.fetchone()[0]
+
+    def trajectory(self, student_number, course=None, since=None):
+        # type: (int, Optional[str], Optional[date]) -> pd.DataFrame
+        """
+        A student's grade in each course on every day a report was run,
+        by course then date.
+
+        :param str course: only courses whose name contains this
+        :param since: only days from this one on
+        """
+        sql = ('SELECT r.run_date, g.source, g.course, g.grade, '
+               'g.letter_grade FROM grades g JOIN runs r USING (run_id) '
+               'WHERE g.student_number = ? AND g.run_id IN ({})'
+               .format(_DAILY_RUNS))
+        params = [int(student_number)]
+        if course:
+            sql += ' AND g.course LIKE ?'
+            params.append('%' + course + '%')
+        if since:
+            sql += ' AND r.run_date >= ?'
+            params.append(_iso(since))
+        return self._query(sql + ' ORDER BY g.course, g.source, r.run_date',
+                           params)
+
+    def failing(self, run_date=None, letters=FAILING, source=None):
+        # type: (Optional[date], Iterable[str], Optional[str]) -> pd.DataFrame
+        """
+        The rows of one run whose letter grade is one of `letters`, by
+        student.
+
+        :param run_date: see :meth:`run_id`
+        :param str source: only this source's rows
+        """
+        letters = list(letters)
+        sql = ('SELECT {} FROM grades WHERE run_id = ? '
+               'AND letter_grade IN ({})'.format(
+                   ', '.join(COLUMNS), ', '.join('?' * len(letters))))
+        params = [self.run_id(run_date)] + letters
+        if source:
+            sql += ' AND source = ?'
+            params.append(source)
+        failing = self._query(sql + ' ORDER BY student_last, '
+                                    'student_first, course', params)
+        # Unknown students have no number, which makes the others floats.
+        failing['student_number'] = failing['student_number'].astype('Int64')
+        return failing
+
+    def distribution(self, run_date=None, course=None, source=None):
+        # type: (Optional[date], Optional[str], Optional[str]) -> pd.DataFrame
+        """
+        For each course in one run, the number of grades, their mean,
+        lowest and highest, and the number of each letter grade. The
+        letters are ordered from the highest average grade down.
+
+        :param run_date: see :meth:`run_id`
+        :param str course: only courses whose name contains this
+        :param str source: only this source's rows
+        """
+        where = 'WHERE run_id = ?'
+        params = [self.run_id(run_date)]
+        if course:
+            where += ' AND course LIKE ?'
+            params.append('%' + course + '%')
+        if source:
+            where += ' AND source = ?'
+            params.append(source)
+        counts = self._query(
+            'SELECT course, letter_grade, count(*) AS n, avg(grade) AS mean, '
+            'min(grade) AS min, max(grade) AS max FROM grades {} '
+            'GROUP BY course, letter_grade'.format(where), params)
+        if counts.empty:
+            return pd.DataFrame(columns=['n', 'mean', 'min', 'max'])
+
+        counts['total'] = counts['mean'] * counts['n']
+        courses = counts.groupby('course').agg(
+            n=('n', 'sum'), total=('total', 'sum'),
+            min=('min', 'min'), max=('max', 'max'))
+        courses.insert(1, 'mean', courses.pop('total') / courses['n'])
+        letters = (counts.dropna(subset=['letter_grade'])
+                   .groupby('letter_grade')['mean'].mean()
+                   .sort_values(ascending=False).index)
+        by_letter = (counts.pivot(index='course', columns='letter_grade',
+                                  values='n')
+                     .reindex(columns=letters)
+                     .fillna(0).astype(int))
+        return courses.join(by_letter)
+
+    def _query(self, sql, params=()):
+        # type: (str, Iterable) -> pd.DataFrame
+        return pd.read_sql_query(sql, self.connection, params=list(params))
+
+    def close(self):
+        # type: () -> None
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _iso(day):
+    # type: (Union[date, str]) -> str
+    if isinstance(day, str):
+        return datetime.strptime(day, '%Y-%m-%d').date().isoformat()
+    return day.isoformat()
+
+
+def parse_args(argv=None):
+    # type: (Optional[list]) -> argparse.Namespace
+    parser = argparse.ArgumentParser(
+        description='Query the grades of past merge_files.py runs.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--history', type=str, default=HISTORY_PATH,
+                        help='the grade history database')
+    parser.add_argument('-o', '--output', type=str,
+                        help='write the result to this file (any format '
+                             'merge_files.py writes) instead of printing it')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    trajectory = commands.add_parser(
+        'trajectory', help="a student's grades on every day")
+    trajectory.add_argument('student_number', type=int)
+    trajectory.add_argument('-c', '--course', type=str,
+                            help='only courses whose name contains this')
+    trajectory.add_argument('--since', type=str, metavar='YYYY-MM-DD',
+                            help='only days from this one on')
+
+    failing = commands.add_parser(
+        'failing', help='the failing grades of one day')
+    failing.add_argument('-d', '--date', type=str, metavar='YYYY-MM-DD',
+                         help='the day (default: the last run)')
+    failing.add_argument('-l', '--letters', type=str,
+                         default=','.join(FAILING),
+                         help='comma-separated letter grades that count as '
+                              'failing')
+    failing.add_argument('-s', '--source', type=str,
+                         help='only this source, e.g. apex')
+
+    distribution = commands.add_parser(
+        'distribution', help='the grades of each course on one day')
+    distribution.add_argument('-d', '--date', type=str, metavar='YYYY-MM-DD',
+                              help='the day (default: the last run)')
+    distribution.add_argument('-c', '--course', type=str,
+                              help='only courses whose name contains this')
+    distribution.add_argument('-s', '--source', type=str,
+                              help='only this source, e.g. apex')
+
+    commands.add_parser('runs', help='every run stored')
+
+    load = commands.add_parser(
+        'import', help='add an old grade-reports file as a run')
+    load.add_argument('report', type=str)
+    load.add_argument('-d', '--date', type=str, metavar='YYYY-MM-DD',
+                      help="the report's day (default: the day the file was "
+                           "last changed)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    # type: (Optional[list]) -> None
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logger = logging.getLogger(__name__)
+
+    with GradeHistory(args.history) as history:
+        if args.command == 'import':
+            run_date = args.date or date.fromtimestamp(
+                path.getmtime(args.report))
+            report = frame_io.read_frame(args.report)
+            run_id = history.append(report, run_date=run_date)
+            logger.info('Added {} rows from "{}" as run {} of {}.'
+                        .format(len(report), args.report, run_id,
+                                _iso(run_date)))
+            return
+        if args.command == 'trajectory':
+            result = history.trajectory(args.student_number,
+                                        course=args.course, since=args.since)
+        elif args.command == 'failing':
+            result = history.failing(args.date,
+                                     letters=args.letters.split(','),
+                                     source=args.source)
+        elif args.command == 'distribution':
+            result = history.distribution(args.date, course=args.course,
+                                          source=args.source).reset_index()
+        else:
+            result = history.runs()
+
+    if args.output:
+        frame_io.write_frame(result, args.output)
+        logger.info('Saved {} rows to "{}".'.format(len(result), args.output))
+    elif result.empty:
+        logger.info('Nothing found.')
+    else:
+        print(result.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,489 @@
+"""
+Matches the students named in the vendor exports to PowerSchool
+student numbers.
+
+Names are first normalized -- accents, case, punctuation, hyphens,
+spacing and middle names are ignored -- and looked up in a hash index of
+the roster. When an export includes the student's email address and
+the roster does too, the email is trusted over the name.
+
+Rows that still do not match can be compared, approximately, with the
+students that share a phonetic block with them, which keeps the
+matching close to linear in the number of rows however large the roster
+is. Approximate matches are only ever suggestions: two students can
+have names a typo apart, so they are left for staff to confirm.
+
+Matches that staff made by hand are remembered in a
+:class:`ResolutionTable` and applied before anything else, so the same
+unknown student never has to be resolved twice.
+"""
+
+import json
+import logging
+import os
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Tuple
+
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+EMAIL_COLUMNS = ('student_email', 'email')
+
+_SOUNDEX_CODES = dict(
+    [(c, '1') for c in 'bfpv'] + [(c, '2') for c in 'cgjkqsxz']
+    + [(c, '3') for c in 'dt'] + [('l', '4')]
+    + [(c, '5') for c in 'mn'] + [('r', '6')]
+)
+
+
+def normalize_names(names):
+    # type: (pd.Series) -> pd.Series
+    """
+    Strips accents, lowercases and replaces everything but letters and
+    digits with single spaces, so that e.g. "  Núñez-Smith " becomes
+    "nunez smith".
+    """
+    names = pd.Series(names, dtype=object).where(pd.notnull(names), '')
+    return (names.astype(str)
+            .str.normalize('NFKD')
+            .str.encode('ascii', 'ignore')
+            .str.decode('ascii')
+            .str.lower()
+            .str.replace("'", '', regex=False)
+            .str.replace(r'[^a-z0-9]+', ' ', regex=True)
+            .str.strip())
+
+
+def soundex(name):
+    # type: (str) -> str
+    """The American Soundex code of a normalized name, e.g. "r163"."""
+    name = name.replace(' ', '')
+    if not name:
+        return ''
+    code = name[0]
+    last = _SOUNDEX_CODES.get(name[0], '')
+    for c in name[1:]:
+        digit = _SOUNDEX_CODES.get(c, '')
+        if digit and digit != last:
+            code += digit
+            if len(code) == 4:
+                break
+        if c not in 'hw':
+            last = digit
+    return code.ljust(4, '0')
+
+
+def edit_distance(a, b):
+    # type: (str, str) -> int
+    """
+    The number of letters inserted, deleted, replaced or swapped with a
+    neighbour needed to turn `a` into `b` (the optimal string alignment
+    distance), e.g. 1 for "hansen" and "hasnen".
+    """
+    # Only the letters between the common prefix and suffix need aligning.
+    start = 0
+    while start < min(len(a), len(b)) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while (end < min(len(a), len(b)) - start
+           and a[-1 - end] == b[-1 - end]):
+        end += 1
+    a, b = a[start:len(a) - end], b[start:len(b) - end]
+    if len(a) < len(b):
+        a, b = b, a
+    before, previous = None, list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        current = [i]
+        for j, y in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1,
+                       previous[j - 1] + (x != y))
+            if i > 1 and j > 1 and x == b[j - 2] and a[i - 2] == y:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        before, previous = previous, current
+    return previous[-1]
+
+
+def _keys(last, first):
+    # type: (pd.Series, pd.Series) -> Tuple[pd.Series, pd.Series]
+    """
+    The full key ignores spacing and hyphens in both names; the short key
+    also drops everything after the first given name.
+    """
+    last = normalize_names(last).str.replace(' ', '', regex=False)
+    first = normalize_names(first)
+    full = last + '|' + first.str.replace(' ', '', regex=False)
+    short = last + '|' + first.str.split(' ', n=1).str[0].fillna('')
+    return full, short
+
+
+class _UniqueIndex(object):
+    """
+    Maps each key to its student, leaving out keys shared by several.
+    Every student of a key is remembered, so that students can be removed
+    again and a key shared by two becomes unique once one of them leaves.
+
+    :ivar dict unique: the keys held by a single student
+    """
+
+    def __init__(self, keys=(), numbers=()):
+        # type: (Iterable[str], Iterable[int]) -> None
+        self.unique = {}  # type: Dict[str, int]
+        self._shared = {}  # type: Dict[str, set]
+        self.add(keys, numbers)
+
+    def add(self, keys, numbers):
+        # type: (Iterable[str], Iterable[int]) -> None
+        unique, shared = self.unique, self._shared
+        for key, number in zip(keys, numbers):
+            if key in shared:
+                shared[key].add(number)
+            elif key not in unique:
+                unique[key] = number
+            elif unique[key] != number:
+                shared[key] = {unique.pop(key), number}
+
+    def remove(self, keys, numbers):
+        # type: (Iterable[str], Iterable[int]) -> None
+        unique, shared = self.unique, self._shared
+        for key, number in zip(keys, numbers):
+            if unique.get(key) == number:
+                del unique[key]
+            elif key in shared:
+                shared[key].discard(number)
+                if len(shared[key]) == 1:
+                    unique[key] = shared.pop(key).pop()
+
+
+class StudentResolver(object):
+    """
+    Resolves student names (and, where available, emails) to PowerSchool
+    student numbers.
+
+    :ivar float threshold: the lowest similarity, between 0 and 1, an
+        approximate match may have
+    :ivar float margin: how much better than the runner-up an approximate
+        match must be to be suggested
+    """
+
+    def __init__(self, students, threshold=0.9, margin=0.05,
+                 resolutions=None):
+        # type: (pd.DataFrame, float, float, ResolutionTable) -> None
+        """
+        :param students: the output of :func:`merge_files.make_student_list`
+            -- indexed by student number, with `last_name` and
+            `first_name` columns
+        :param resolutions: manual matches, applied first to frames with a
+            `source` column. Entries for students no longer on the roster
+            are removed from it.
+        """
+        self.threshold = threshold
+        self.margin = margin
+        self.students = students
+        self.resolutions = resolutions
+        if resolutions is not None:
+            resolutions.prune(students.index.to_numpy())
+        self._full = _UniqueIndex()
+        self._short = _UniqueIndex()
+        self._email = _UniqueIndex()
+        # Approximate matching compares the compact last name and the
+        # first given name.
+        self._names = {}
+        self._blocks = defaultdict(list)
+        self._index(students)
+
+    def update(self, students, removed=(), added=()):
+        # type: (pd.DataFrame, Iterable[int], Iterable[int]) -> None
+        """
+        Brings the resolver up to date with a newer roster, reindexing
+        only the students that left it or joined it. A student whose
+        record changed is both removed and added.
+
+        :param students: the new roster, like the one passed to the
+            constructor
+        :param removed: the numbers of the students to forget
+        :param added: the numbers of the students to index from
+            `students`
+        """
+        old = self.students
+        self._index(old.loc[old.index.intersection(list(removed))],
+                    remove=True)
+        self._index(students.loc[students.index.intersection(list(added))])
+        self.students = students
+        if self.resolutions is not None:
+            self.resolutions.prune(students.index.to_numpy())
+
+    def _index(self, students, remove=False):
+        # type: (pd.DataFrame, bool) -> None
+        """Adds `students` to the lookup indexes, or removes them."""
+        numbers = students.index.to_numpy()
+        full, short = _keys(students['last_name'], students['first_name'])
+        update = 'remove' if remove else 'add'
+        getattr(self._full, update)(full, numbers)
+        getattr(self._short, update)(short, numbers)
+        for column in EMAIL_COLUMNS:
+            if column in students:
+                emails = (students[column].astype(object)
+                          .str.strip().str.lower())
+                known = emails.notnull().to_numpy()
+                getattr(self._email, update)(emails[known], numbers[known])
+                break
+
+        for number, key in zip(numbers, short):
+            last, first = key.split('|', 1)
+            for block in self._block_keys(last, first):
+                if remove:
+                    self._blocks[block].remove(number)
+                    if not self._blocks[block]:
+                        del self._blocks[block]
+                else:
+                    self._blocks[block].append(number)
+            if remove:
+                del self._names[number]
+            else:
+                self._names[number] = (last, first)
+
+    def __getstate__(self):
+        # type: () -> dict
+        # Manual matches are saved to their own file.
+        state = self.__dict__.copy()
+        state['resolutions'] = None
+        return state
+
+    def resolve(self, df, approximate=True):
+        # type: (pd.DataFrame, bool) -> pd.DataFrame
+        """
+        Finds the student number of each row of `df`, which must have
+        `student_last` and `student_first` columns (or a `student` column
+        of "last, first" names) and may have a `student_email` column.
+
+        Each distinct name is only resolved once.
+
+        :param approximate: whether to look for approximate matches to the
+            rows that do not match otherwise
+        :return: a frame indexed like `df` with the `student_number`,
+            the `suggested_number` of an approximate match, the
+            `match_score` (1 for exact matches) and the `match_method` --
+            "manual", "email", "exact" or "fuzzy" -- of each row. An
+            approximate match is only suggested; its `student_number` is
+            left missing, like that of a row that did not match.
+        """
+        if 'student_last' in df and 'student_first' in df:
+            last, first = df['student_last'], df['student_first']
+        else:
+            parts = df['student'].astype(object).str.split(',', n=1,
+                                                           expand=True)
+            last, first = parts[0], parts.reindex(columns=[1])[1]
+        email = df['student_email'] if 'student_email' in df else None
+
+        source = None
+        if self.resolutions is not None and 'source' in df:
+            source = df['source']
+
+        names = pd.DataFrame({
+            'last': pd.Series(last, dtype=object).to_numpy(),
+            'first': pd.Series(first, dtype=object).to_numpy(),
+            'email': (pd.Series(email, dtype=object).to_numpy()
+                      if email is not None else None),
+            'source': (pd.Series(source, dtype=object).to_numpy()
+                       if source is not None else None)
+        })
+        codes = names.groupby(list(names.columns), dropna=False,
+                              sort=False).ngroup().to_numpy()
+        unique = names.drop_duplicates().reset_index(drop=True)
+
+        number, score, method = self._resolve_unique(unique, approximate)
+        suggested = method == 'fuzzy'
+        return pd.DataFrame({
+            'student_number': pd.array(np.where(suggested, None,
+                                                number)[codes],
+                                       dtype='UInt64'),
+            'suggested_number': pd.array(np.where(suggested, number,
+                                                  None)[codes],
+                                         dtype='UInt64'),
+            'match_score': score[codes],
+            'match_method': pd.Categorical(method[codes],
+                                           categories=['manual', 'email',
+                                                       'exact', 'fuzzy'])
+        }, index=df.index)
+
+    def _resolve_unique(self, names, approximate=True):
+        # type: (pd.DataFrame, bool) -> Tuple[np.ndarray, ...]
+        n = len(names)
+        number = np.full(n, None, dtype=object)
+        score = np.full(n, np.nan)
+        method = np.full(n, None, dtype=object)
+
+        if self.resolutions and names['source'].notnull().any():
+            keys = ResolutionTable.keys(names['source'], names['last'],
+                                        names['first'])
+            found = keys.map(self.resolutions.entries).to_numpy()
+            hit = pd.notnull(found)
+            number[hit], score[hit], method[hit] = found[hit], 1., 'manual'
+
+        if self._email.unique and names['email'].notnull().any():
+            emails = names['email'].str.strip().str.lower()
+            found = emails.map(self._email.unique).to_numpy()
+            hit = pd.notnull(found) & pd.isnull(number)
+            number[hit], score[hit], method[hit] = found[hit], 1., 'email'
+
+        full, short = _keys(names['last'], names['first'])
+        for keys, index in ((full, self._full), (short, self._short)):
+            found = keys.map(index.unique).to_numpy()
+            hit = pd.notnull(found) & pd.isnull(number)
+            number[hit], score[hit], method[hit] = found[hit], 1., 'exact'
+
+        if not approximate:
+            return number, score, method
+        for i in np.flatnonzero(pd.isnull(number)):
+            last, _, first = short.iat[i].partition('|')
+            match = self._fuzzy(last, first)
+            if match is not None:
+                number[i], score[i] = match
+                method[i] = 'fuzzy'
+        return number, score, method
+
+    def _fuzzy(self, last, first):
+        # type: (str, str) -> Optional[Tuple[int, float]]
+        if not last or not first:
+            return None
+        candidates = set()
+        for block in self._block_keys(last, first):
+            candidates.update(self._blocks.get(block, ()))
+
+        # Names too different in length to score this high can neither
+        # match nor come close enough to the best to spoil its match.
+        floor = self.threshold - self.margin
+        best, best_score, runner_up = None, 0., 0.
+        for candidate in candidates:
+            other = self._names[candidate]
+            if self._length_bound((last, first), other) < floor:
+                continue
+            score = self.similarity((last, first), other)
+            if score > best_score:
+                best, best_score, runner_up = candidate, score, best_score
+            elif score > runner_up:
+                runner_up = score
+        if best_score < self.threshold or best_score - runner_up < self.margin:
+            return None
+        return best, best_score
+
+    @staticmethod
+    def similarity(a, b):
+        # type: (Tuple[str, str], Tuple[str, str]) -> float
+        """
+        Scores how alike two (last, first) names are, weighting the last
+        name more heavily: each name scores 1 less the fraction of its
+        letters that differ, by :func:`edit_distance`. Initials and
+        shortened first names get no credit beyond that.
+        """
+        def score(x, y):
+            return 1. - edit_distance(x, y) / float(max(len(x), len(y), 1))
+        return .6 * score(a[0], b[0]) + .4 * score(a[1], b[1])
+
+    @staticmethod
+    def _length_bound(a, b):
+        # type: (Tuple[str, str], Tuple[str, str]) -> float
+        """The highest :meth:`similarity` names of these lengths can have."""
+        def bound(x, y):
+            return min(len(x), len(y)) / float(max(len(x), len(y), 1))
+        return .6 * bound(a[0], b[0]) + .4 * bound(a[1], b[1])
+
+    @staticmethod
+    def _block_keys(last, first):
+        # type: (str, str) -> Tuple[tuple, tuple]
+        """
+        A student lands in two blocks, so that a typo in either name
+        still leaves the other to find them by.
+        """
+        return (('last', soundex(last), first[:1]),
+                ('first', soundex(first), last[:1]))
+
+
+class ResolutionTable(object):
+    """
+    A small on-disk store of manual matches, mapping a source and the
+    student's name as written in that source's export to a student
+    number. It is filled from a corrected `unknown-students.csv` -- one
+    in which staff have filled in the `student_number` column -- with
+    :meth:`learn`.
+    """
+
+    def __init__(self, path=None):
+        # type: (Optional[str]) -> None
+        """
+        :param str path: the JSON file backing the table; loaded if it
+            exists
+        """
+        self.path = path
+        self.entries = {}  # type: Dict[str, int]
+        if path is not None and os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.entries = {key: int(number) for key, number
+                                in json.load(f)['entries'].items()}
+
+    @staticmethod
+    def keys(source, last, first):
+        # type: (pd.Series, pd.Series, pd.Series) -> pd.Series
+        """Builds the lookup key of each (source, last, first) triple."""
+        def clean(values):
+            values = pd.Series(values, dtype=object)
+            return values.where(values.notnull(), '').astype(str).str.strip()
+        return (clean(source) + '\t' + clean(last) + ', ' + clean(first))
+
+    def learn(self, path):
+        # type: (str) -> int
+        """
+        Adds the rows of a corrected unknown-students file whose
+        `student_number` has been filled in.
+
+        :return: the number of entries added or changed
+        """
+        corrected = pd.read_csv(path, dtype={'student_last': str,
+                                             'student_first': str,
+                                             'source': str})
+        corrected = corrected[corrected['student_number'].notnull()]
+        keys = self.keys(corrected['source'], corrected['student_last'],
+                         corrected['student_first'])
+        n_changed = 0
+        for key, number in zip(keys, corrected['student_number']):
+            number = int(number)
+            if self.entries.get(key) != number:
+                self.entries[key] = number
+                n_changed += 1
+        return n_changed
+
+    def prune(self, valid_numbers):
+        # type: (Iterable[int]) -> int
+        """
+        Removes the entries whose student is not in `valid_numbers`, e.g.
+        because they left the district.
+
+        :return: the number of entries removed
+        """
+        valid = set(int(number) for number in valid_numbers)
+        stale = [key for key, number in self.entries.items()
+                 if number not in valid]
+        for key in stale:
+            del self.entries[key]
+        if stale:
+            logging.getLogger(__name__).info(
+                'Forgot {} manual match(es) to students no longer in '
+                'PowerSchool.'.format(len(stale)))
+        return len(stale)
+
+    def save(self):
+        # type: () -> None
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'entries': self.entries}, f, indent=1,
+                      sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,19 +1,58 @@
 #!/usr/bin/env python
 # coding: utf-8
 from builtins import input
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import date, datetime
+from functools import wraps
 from numbers import Number
-from os import getcwd, path
+from os import cpu_count, getcwd, path
+from typing import Callable, Dict, Iterable, Optional, Union
 import argparse
+import hashlib
 import logging
+import multiprocessing
+import os
 import platform
 import sys
+import threading
+import time
 
-import numpy as np
-import pandas as pd
+# The modules shared with the other scripts live one directory up.
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+import frame_io  # noqa: E402
+import profiling  # noqa: E402
+from compact import compact  # noqa: E402
+from lazy import lazy_import, load  # noqa: E402
+from profiling import span  # noqa: E402
+from ps_agent import configure_cache, fetch_students  # noqa: E402
+
+from grade_history import HISTORY_PATH, GradeHistory  # noqa: E402
+from matching import ResolutionTable, StudentResolver  # noqa: E402
+from roster import RosterSnapshot  # noqa: E402
+from watching import FileWatcher  # noqa: E402
+from sources import (PROBLEM_COLUMNS, SOURCES, SourceSchema,  # noqa: E402
+                     Split, read_checked, read_source, register)
+
+# Imported when first used, so that the command line answers at once.
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 
 class GradeConverter(object):
+    """
+    Converts percentages to letter grades. Single grades can be converted
+    by calling the converter; whole columns should be passed to
+    :meth:`convert`, which does the work in one vectorized pass.
+
+    Schools that grade on a different scale can be given their own
+    cutoff tables, which :meth:`convert` applies to that school's rows.
+
+    :cvar cutoffs: (lowest percentage, letter) pairs, highest first;
+        anything below the last cutoff is an F
+    :cvar grade_cats: every letter, lowest first; cutoffs may only use
+        these letters
+    """
 
     cutoffs = [
         (96.5, 'A+'), (93.5, 'A'), (89.5, 'A-'),
@@ -24,9 +63,75 @@ class GradeConverter(object):
 
     grade_cats = list(reversed([letter for grade, letter in cutoffs] + ['F']))
 
+    def __init__(self, cutoffs=None, school_cutoffs=None):
+        # type: (list, dict) -> None
+        """
+        :param list cutoffs: replaces the default :attr:`cutoffs`
+        :param dict school_cutoffs: maps a school ID to the cutoffs used
+            for that school's grades in :meth:`convert`
+        :raises ValueError: if a cutoff's letter is not in
+            :attr:`grade_cats`
+        """
+        if cutoffs is not None:
+            self.cutoffs = sorted(cutoffs, reverse=True)
+        self.school_cutoffs = {
+            school: sorted(table, reverse=True)
+            for school, table in (school_cutoffs or {}).items()
+        }
+        for table in [self.cutoffs] + list(self.school_cutoffs.values()):
+            unknown = [letter for _, letter in table
+                       if letter not in self.grade_cats]
+            if unknown:
+                raise ValueError('Unknown letter grade(s) {} in cutoffs; '
+                                 'expected one of {}.'
+                                 .format(unknown, self.grade_cats))
+
+    def convert(self, grades, schools=None):
+        # type: (Union[pd.Series, np.ndarray], pd.Series) -> pd.Series
+        """
+        Converts a column of percentages to an ordered categorical over
+        :attr:`grade_cats`. Missing, non-numeric and infinite percentages
+        become missing letter grades; negative ones are an F, as with
+        calling the converter.
+
+        :param grades: the percentages
+        :param schools: the school ID of each grade, used to look up
+            :attr:`school_cutoffs`
+        :return: the letter grades, indexed like `grades` if it is a
+            Series
+        """
+        values = (pd.to_numeric(pd.Series(np.asarray(grades)),
+                                errors='coerce')
+                  .to_numpy(dtype=float, na_value=np.nan))
+        invalid = ~np.isfinite(values)
+
+        codes = self._codes(values, self.cutoffs)
+        if schools is not None and self.school_cutoffs:
+            schools = np.asarray(schools)
+            for school, table in self.school_cutoffs.items():
+                mask = schools == school
+                if mask.any():
+                    codes[mask] = self._codes(values[mask], table)
+        codes[invalid] = -1
+
+        letters = pd.Categorical.from_codes(codes,
+                                            categories=self.grade_cats,
+                                            ordered=True)
+        index = grades.index if isinstance(grades, pd.Series) else None
+        return pd.Series(letters, index=index, name='letter_grade')
+
+    def _codes(self, values, cutoffs):
+        # type: (np.ndarray, list) -> np.ndarray
+        lows = np.array([low for low, _ in reversed(cutoffs)])
+        letter_codes = np.array(
+            [self.grade_cats.index('F')]
+            + [self.grade_cats.index(letter) for _, letter in reversed(cutoffs)]
+        )
+        return letter_codes[np.searchsorted(lows, values, side='right')]
+
     def __call__(self, grade):
         # type: (Number) -> str
-        if grade < 59.5:
+        if grade < self.cutoffs[-1][0]:
             return 'F'
 
         high = float('inf')
@@ -36,292 +141,978 @@ class GradeConverter(object):
             high = low
 
 
-def to_categories(df, thresh=0.25, inplace=False):
-    # type: (pd.DataFrame, float, bool) -> pd.DataFrame
+# The order of the report's rows.
+REPORT_ORDER = ['student_last', 'student_first', 'source']
+
+SOURCE_CACHE_DIR = path.join(path.dirname(path.realpath(__file__)),
+                             '.source-cache')
+RESOLUTIONS_PATH = path.join(path.dirname(path.realpath(__file__)),
+                             'student-resolutions.json')
+ROSTER_PATH = path.join(path.dirname(path.realpath(__file__)),
+                        '.roster-snapshot.pkl')
+
+
+def cached_source(version, daily=False, key=None):
+    # type: (int, bool, Callable) -> Callable
     """
-    Converts all the string columns in a pandas DataFrame to
-    categories if the number of unique elements in that
-    column comprise less than or equal to `thresh` percent
-    of the total number of elements in the column.
+    Caches the frame a `make_*` function builds from a file. The cache is
+    keyed by a hash of the file's contents, the function's arguments,
+    `version` and the pandas version, so an entry is never served once
+    the export or the parser has changed. Bump `version` whenever the
+    parser's output changes.
+
+    The decorated function takes an extra `cache_dir` keyword argument;
+    caching is skipped unless it is given.
+
+    :param int version: the parser's version
+    :param bool daily: also key the cache by today's date, for parsers
+        whose output depends on it (e.g. filtering out future classes)
+    :param key: a function of the call's arguments returning anything
+        else the cache should be keyed by
     """
-    assert 0 < thresh < 1
-    if not inplace:
-        df = df.copy(deep=True)
+    def decorator(func):
+        @wraps(func)
+        def wrapper(file_path, *args, **kwargs):
+            cache_dir = kwargs.pop('cache_dir', None)
+            if cache_dir is None:
+                return func(file_path, *args, **kwargs)
 
-    n = len(df)
-    obj_cols = df.select_dtypes('object')
-    for c in obj_cols:
-        if df[c].nunique() / n <= thresh:
-            df[c] = df[c].astype('category')
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b''):
+                    digest.update(chunk)
+            extra = key(file_path, *args, **kwargs) if key else None
+            digest.update(repr((version, args, sorted(kwargs.items()),
+                                extra, pd.__version__,
+                                date.today() if daily else None))
+                          .encode('utf-8'))
+            # One entry per parser and file; older ones are replaced.
+            prefix = '{}-{}-'.format(
+                func.__name__,
+                hashlib.sha1(path.abspath(file_path).encode('utf-8'))
+                .hexdigest()[:8])
+            cache_path = path.join(cache_dir,
+                                   prefix + digest.hexdigest() + '.pkl')
 
-    if not inplace:
-        return df
+            if path.isfile(cache_path):
+                try:
+                    return pd.read_pickle(cache_path)
+                except Exception as e:
+                    logging.getLogger(__name__).debug(
+                        'Ignoring unreadable cache "{}": {}'
+                        .format(cache_path, e))
 
+            df = func(file_path, *args, **kwargs)
+            try:
+                if not path.isdir(cache_dir):
+                    # The exports contain student data; keep them private.
+                    os.makedirs(cache_dir, mode=0o700)
+                for name in os.listdir(cache_dir):
+                    if name.startswith(prefix):
+                        os.remove(path.join(cache_dir, name))
+                tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+                pd.to_pickle(df, tmp_path)
+                os.replace(tmp_path, cache_path)
+            except (IOError, OSError) as e:
+                logging.getLogger(__name__).debug(
+                    'Could not cache {}: {}'.format(func.__name__, e))
+            return df
+        return wrapper
+    return decorator
 
-def make_byu(path):
-    # type: (str) -> pd.DataFrame
 
-    byu_to_keep = ['percentage', 'letter grade', 'Student Name',
-                   'Course', 'Teacher Name']
-    byu_cols = ['grade', 'letter_grade', 'student',
-                'course', 'teacher_name']
+def _started(df):
+    # type: (pd.DataFrame) -> pd.Series
+    return df['start_date'] < datetime.now()
 
-    byu = (pd.read_excel(path, usecols=byu_to_keep)
-           .dropna(how='all', axis=0)
-           .replace('?', np.nan))
-    byu.columns = byu_cols
-    to_categories(byu, inplace=True)
 
-    byu['letter_grade'] = pd.Categorical(byu['letter_grade'],
-                                         categories=GradeConverter.grade_cats,
-                                         ordered=True)
-    byu[['student_last', 'student_first']] = (byu['student'].
-                                              str.split(',', expand=True, n=1))
-    return byu
+register(SourceSchema(
+    'byu', 'BYU', 'byu.xlsx', flags=['-b'], reader='excel',
+    columns=OrderedDict([
+        ('percentage', 'grade'),
+        ('letter grade', 'letter_grade'),
+        ('Student Name', 'student'),
+        ('Course', 'course'),
+        ('Teacher Name', 'teacher_name')
+    ]),
+    na_values=['?'],
+    splits=[Split('student', ',', ['student_last', 'student_first'])],
+    dtypes={
+        'letter_grade': lambda: pd.CategoricalDtype(GradeConverter.grade_cats,
+                                                    ordered=True)
+    }
+))
 
+register(SourceSchema(
+    'apex', 'Apex', 'apex.csv', flags=['-a'],
+    columns=OrderedDict([
+        ('ImportClassroomID', 'course_id'),
+        ('ClassroomName', 'course'),
+        ('TeacherName', 'teacher_name'),
+        ('TeacherEmail', 'teacher_email'),
+        ('LastName', 'student_last'),
+        ('FirstName', 'student_first'),
+        ('StudentName', 'student'),
+        ('ClassroomStartDate', 'start_date'),
+        ('TotalPointsAttempted', 'points_attempted'),
+        ('TotalPointsPossible', 'points_possible'),
+        ('GradeToDate', 'grade_to_date'),
+        ('OverallGrade', 'grade')
+    ]),
+    dates=['start_date'],
+    predicates=OrderedDict([
+        ('future', _started),
+        ('null_course_id', lambda df: df['course_id'].notnull()),
+        ('demo', lambda df: ~(df['student'].str.lower()
+                              .str.contains('demo', na=False)))
+    ]),
+    splits=[Split('course', ' - ', ['course', 'section_number'])],
+    dtypes={
+        'course_id': 'UInt64',
+        'section_number': 'uint16',
+        'points_attempted': 'uint',
+        'points_possible': 'uint'
+    },
+    dedupe=True
+))
 
-def make_apex(path, drop_null_course_id=True, filter_future=True):
-    # type: (str, bool, bool) -> pd.DataFrame
+register(SourceSchema(
+    'idla', 'IDLA', 'idla.csv', flags=['-i'],
+    columns=OrderedDict([
+        ('Student', 'student'),
+        ('Course', 'course'),
+        ('Start Date', 'start_date'),
+        ('End Date', 'end_date'),
+        ('Teacher', 'teacher'),
+        ('TeacherEmail', 'teacher_email'),
+        ('Grade', 'grade')
+    ]),
+    dates=['start_date', 'end_date'],
+    drop_empty_rows=False,
+    predicates=OrderedDict([('future', _started)]),
+    splits=[
+        Split('grade', ' as of ', ['grade', 'grade_date']),
+        Split('student', ',', ['student_last', 'student_first'])
+    ],
+    dtypes={'grade': 'float32', 'grade_date': 'datetime64[ns]'}
+))
 
-    apex_to_keep = [
-        'ImportClassroomID', 'ClassroomName', 'TeacherName',
-        'TeacherEmail', 'LastName', 'FirstName', 'StudentName',
-        'ClassroomStartDate', 'TotalPointsAttempted',
-        'TotalPointsPossible', 'GradeToDate', 'OverallGrade'
-    ]
+register(SourceSchema(
+    'schoology', 'Schoology', 'schoology.csv', flags=['-s'],
+    positional=True,
+    columns=['student_first', 'student_last', 'student_email',
+             'course', 'course_code', 'section', 'titles',
+             'grade', 'letter_grade'],
+    drop=['titles'],
+    drop_empty_rows=False,
+    required=['grade'],
+    derived=OrderedDict([
+        ('section', lambda df: df['section'].str.replace('Section ', '',
+                                                         regex=False)),
+        ('student', lambda df: df['student_last'] + ', '
+                               + df['student_first'])
+    ]),
+    dtypes={'section': 'uint8'},
+    dedupe=True
+))
 
-    apex_cols = [
-        'course_id', 'course', 'teacher_name',
-        'teacher_email', 'student_last', 'student_first',
-        'student', 'start_date', 'points_attempted', 'points_possible',
-        'grade_to_date', 'grade'
-    ]
 
-    apex = (pd.read_csv(path, usecols=apex_to_keep)
-            .dropna(how='all', axis=1)
-            .dropna(how='all', axis=0))
-    apex.columns = apex_cols
-
-    apex['start_date'] = pd.to_datetime(apex['start_date'])
-    if filter_future:
-        apex = (apex[apex['start_date'] < datetime.now()]
-                .reset_index(drop=True))
-
-    apex['course_id'] = apex['course_id'].astype('UInt64')
-    if drop_null_course_id:
-        apex = apex[apex['course_id'].notnull()].reset_index(drop=True)
-
-    apex[['course', 'section_number']] = (apex['course']
-                                          .str.split(' - ', expand=True))
-    if apex['course_id'].isnull().sum():
-        # Convert to float first to avoid conversion bug
-        apex['section_number'] = (apex['section_number']
-                                  .astype(float)
-                                  .astype('UInt16'))
-    else:
-        apex['section_number'] = apex['section_number'].astype('uint16')
-
-    point_cols = apex.columns[apex.columns.str.startswith('points')]
-    apex[point_cols] = apex[point_cols].astype('uint')
-
-    apex = apex[~apex['student']
-                .str.lower()
-                .str.contains('demo')].reset_index(drop=True)
-    apex = apex.drop_duplicates().reset_index(drop=True)
-
-    return to_categories(apex)
-
-
-def make_idla(path, filter_future=True):
-    # type (str, bool) -> pd.DataFrame
-    idla_to_keep = ['Student', 'Course', 'Start Date', 'End Date',
-                    'Teacher', 'TeacherEmail', 'Grade']
-    idla_cols = ['student', 'course', 'start_date', 'end_date',
-                 'teacher', 'teacher_email', 'grade']
-
-    date_ind = [idla_to_keep.index(col) for col in ('Start Date', 'End Date')]
-
-    idla = pd.read_csv(path, usecols=idla_to_keep,
-                       parse_dates=date_ind)
-    idla.columns = idla_cols
-
-    if filter_future:
-        idla = idla[idla['start_date'] < datetime.now()].reset_index(drop=True)
-    idla[['grade', 'grade_date']] = (idla['grade']
-                                     .str.split(' as of ', expand=True))
-    idla['grade'] = idla['grade'].astype('float32')
-    idla['grade_date'] = pd.to_datetime(idla['grade_date'])
-    idla[['student_last', 'student_first']] = (idla['student'].
-                                               str.split(',', expand=True))
-
-    return to_categories(idla)
-
-
-def make_schoology(path):
-    # type (str) -> pd.DataFrame
-    schoology_cols = ['student_first', 'student_last', 'student_email',
-                      'course', 'course_code', 'section', 'titles',
-                      'grade', 'letter_grade']
-    school = (pd.read_csv(path, names=schoology_cols,
-                          header=0)
-              .drop(columns='titles')
-              .dropna(how='any', subset=['grade'])
-              .reset_index(drop=True))
-    school['section'] = (school['section']
-                         .str.replace('Section ', '')
-                         .astype('uint8'))
-    school = school.drop_duplicates().reset_index(drop=True)
-
-    school['student'] = school['student_last'] + ', ' + school['student_first']
-    return to_categories(school)
-
-
-def make_student_list():
-    # type () -> pd.DataFrame
-    students = pd.DataFrame(fetch_students())
-    num_cols = ['student_number', 'school_id']
-    students[num_cols] = students[num_cols].astype('uint')
-    students.set_index('student_number', inplace=True)
-    students = (students[students['school_id'].isin(range(615, 617))]
-                .drop(columns='school_id')
-                .sort_index())
-    students['last_first'] = (students['last_name'] + ', '
-                              + students['first_name'])
+@cached_source(version=3, daily=True,
+               key=lambda path, name, **kwargs: SOURCES[name].version)
+def make_source(path, name, skip=(), engine='c', skip_lines=()):
+    # type: (str, str, tuple, str, tuple) -> pd.DataFrame
+    """
+    Reads the file at `path` with the registered schema called `name`
+    (see :mod:`sources`) and narrows its dtypes with
+    :func:`compact.compact`.
+
+    :param skip: names of the schema's predicates not to apply
+    :param str engine: the CSV parsing engine
+    :param tuple skip_lines: lines of the file to leave out (see
+        :func:`validate_sources`)
+    """
+    df = read_source(SOURCES[name], path, skip=skip, engine=engine,
+                     skip_lines=skip_lines)
+    compact(df)
+    return df
+
+
+@cached_source(version=1, daily=True,
+               key=lambda path, name, **kwargs: SOURCES[name].version)
+def make_checked_source(path, name, skip=(), engine='c', quarantine=False):
+    # type: (str, str, tuple, str, bool) -> tuple
+    """
+    Checks the file at `path` against the registered schema called
+    `name` while reading it, with :func:`sources.read_checked`, and
+    narrows the dtypes of what was read like :func:`make_source`.
+
+    :param bool quarantine: leave the invalid rows out rather than not
+        reading the file
+    :return: the problems found, and the frame or None
+    """
+    problems, df = read_checked(SOURCES[name], path, skip=skip,
+                                engine=engine, quarantine=quarantine)
+    if df is not None:
+        compact(df)
+    return problems, df
+
+
+def check_source(file_path, name, quarantine=False, **kwargs):
+    # type: (str, str, bool, ...) -> tuple
+    """Calls :func:`make_checked_source` in a span of its own."""
+    with span('check_' + name, path=file_path) as s:
+        problems, df = make_checked_source(file_path, name,
+                                           quarantine=quarantine, **kwargs)
+        s.set(problems=len(problems), rows=0 if df is None else len(df))
+    return problems, df
+
+
+def make_byu(path, **kwargs):
+    # type: (str, ...) -> pd.DataFrame
+    return make_source(path, 'byu', **kwargs)
+
+
+def make_apex(path, drop_null_course_id=True, filter_future=True, **kwargs):
+    # type: (str, bool, bool, ...) -> pd.DataFrame
+    skip = []
+    if not drop_null_course_id:
+        skip.append('null_course_id')
+    if not filter_future:
+        skip.append('future')
+    return make_source(path, 'apex', skip=tuple(skip), **kwargs)
+
+
+def make_idla(path, filter_future=True, **kwargs):
+    # type: (str, bool, ...) -> pd.DataFrame
+    skip = () if filter_future else ('future',)
+    return make_source(path, 'idla', skip=skip, **kwargs)
+
+
+def make_schoology(path, **kwargs):
+    # type: (str, ...) -> pd.DataFrame
+    return make_source(path, 'schoology', **kwargs)
+
+
+def make_student_list(roster=None):
+    # type (RosterSnapshot) -> pd.DataFrame
+    """
+    Downloads the students of the online schools from PowerSchool.
+
+    :param roster: the student list of the last run; if given, only the
+        students added or changed since are prepared again, and the
+        snapshot is brought up to date
+    """
+    with span('make_student_list') as s:
+        students = fetch_students.fetch_frame()
+        students.set_index('student_number', inplace=True)
+        students = students[students['school_id'].isin(range(615, 617))]
+        if roster is None:
+            students = _prepare_students(students).sort_index()
+        else:
+            students = roster.refresh(students, _prepare_students)
+            if roster.changes is not None:
+                s.set(added=len(roster.changes.added),
+                      removed=len(roster.changes.removed),
+                      changed=len(roster.changes.changed))
+        s.set(rows=len(students))
     return students
 
 
-def merge_sources(byu,      # type: pd.DataFrame
-                  apex,     # type: pd.DataFrame
-                  idla,     # type: pd.DataFrame
-                  school,   # type: pd.DataFrame
-                  students  # type: pd.DataFrame
+def request_student_list(roster=None):
+    # type: (RosterSnapshot) -> Future
+    """
+    Starts downloading the student list with :func:`make_student_list`
+    on a thread of its own, so that the files can be checked and parsed
+    meanwhile. The thread is a daemon: a run that fails before it needs
+    the list does not wait for the download to finish.
+
+    :return: a future of the student list
+    """
+    logging.getLogger(__name__).info('Requesting student list from '
+                                     'PowerSchool. This may take a moment.')
+    # Not in the student list's thread while the process pools fork.
+    load(np, pd)
+    students = Future()
+    make = profiling.bind(make_student_list)
+
+    def download():
+        try:
+            students.set_result(make(roster))
+        except BaseException as e:
+            students.set_exception(e)
+    threading.Thread(target=download, name='make_student_list',
+                     daemon=True).start()
+    return students
+
+
+def _prepare_students(students):
+    # type: (pd.DataFrame) -> pd.DataFrame
+    # The names may be categoricals, which cannot be added.
+    students['last_first'] = students['last_name'].str.cat(
+        students['first_name'], sep=', ')
+    return students
+
+
+def parse_source(file_path, name, **kwargs):
+    # type: (str, str, ...) -> pd.DataFrame
+    """Calls :func:`make_source` in a span of its own."""
+    with span('make_' + name, path=file_path) as s:
+        df = make_source(file_path, name, **kwargs)
+        s.set(rows=len(df))
+    return df
+
+
+def merge_sources(sources,        # type: Dict[str, pd.DataFrame]
+                  students,       # type: pd.DataFrame
+                  converter=None,  # type: GradeConverter
+                  resolver=None   # type: StudentResolver
                   ):
     # type: (...) -> pd.DataFrame
-    source_map = {
-        'byu': byu,
-        'apex': apex,
-        'idla': idla,
-        'schoology': school
-    }
-
+    """
+    :param sources: the frame of each source, keyed by the source's name
+    :param students: the output of :func:`make_student_list`
+    :param converter: converts percentages to letter grades
+    :param resolver: matches rows to students; one is built from
+        `students` if not given
+    """
     out_order = [
         'student_number', 'student_last', 'student_first',
         'course', 'source', 'grade', 'letter_grade'
     ]
 
-    out = pd.concat([
-        df.assign(source=source) for source, df in source_map.items()
-    ], join='inner').reset_index(drop=True)
+    # Keep the student's email, where a source has one, for matching.
+    frames = [df.assign(source=source) for source, df in sources.items()]
+    for df in frames:
+        if 'student_email' not in df:
+            df['student_email'] = None
+    out = pd.concat(frames, join='inner').reset_index(drop=True)
 
-    out = (out.merge(students['last_first'].reset_index(),
-                     left_on='student',
-                     right_on='last_first', how='left')
-           .drop(columns='last_first')
+    if converter is None:
+        converter = GradeConverter()
+    if resolver is None:
+        resolver = StudentResolver(students)
+
+    # Approximate matches are only suggested, for the unknown students.
+    with span('resolve students', rows=len(out)) as s:
+        matches = resolver.resolve(out, approximate=False)
+        s.set(unmatched=int(matches['student_number'].isnull().sum()))
+    out['student_number'] = matches['student_number']
+    out['school_id'] = (students['school_id']
+                        .reindex(out['student_number'].astype(float))
+                        .to_numpy())
+    out = (out.drop(columns='student_email')
            .drop_duplicates()
            .reset_index(drop=True))
-    out['student_number'] = out['student_number'].astype('UInt64')
-    out['letter_grade'] = pd.Categorical(out['grade'].apply(GradeConverter()),
-                                         categories=GradeConverter.grade_cats,
-                                         ordered=True)
-    return (to_categories(out)[out_order]
-            .sort_values(by=['student_last', 'student_first', 'source'])
+    out['letter_grade'] = converter.convert(out['grade'],
+                                            schools=out['school_id'])
+    compact(out)
+    return (out[out_order]
+            .sort_values(by=REPORT_ORDER)
             .reset_index(drop=True))
 
 
-def to_csv(df, path):
-    # type: (pd.DataFrame, str)
-    (df.sort_values(by=['student_last', 'student_first', 'source'])
-     .reset_index(drop=True)
-     .to_csv(path, index=False))
+def combine_slices(slices):
+    # type: (Dict[str, pd.DataFrame]) -> pd.DataFrame
+    """
+    Joins reports made by :func:`merge_sources` from disjoint sets of
+    sources into the report it would have made from all of them.
+    """
+    out = pd.concat(list(slices.values()), ignore_index=True)
+    # Slices whose categories differ are joined as strings.
+    compact(out)
+    return out.sort_values(by=REPORT_ORDER).reset_index(drop=True)
+
+
+class SourceError(Exception):
+    """Raised when one or more sources could not be loaded."""
+
+    def __init__(self, errors):
+        # type: (dict) -> None
+        self.errors = errors
+
+    def __str__(self):
+        return '\n'.join('Could not load {}: {}'.format(source, e)
+                         for source, e in self.errors.items())
+
+
+class InvalidRows(ValueError):
+    """
+    Raised when a file has rows that cannot be read correctly.
+
+    :ivar problems: the problems found by :func:`sources.read_checked`
+    """
+
+    shown = 10
+
+    def __init__(self, problems):
+        # type: (pd.DataFrame) -> None
+        self.problems = problems
+
+    def __str__(self):
+        n_rows = self.problems['line'].nunique()
+        lines = ['{} invalid row(s):'.format(n_rows)]
+        for problem in self.problems.head(self.shown).itertuples():
+            lines.append('  line {}, {} "{}": {}'.format(
+                problem.line, problem.column, problem.value, problem.problem))
+        if len(self.problems) > self.shown:
+            lines.append('  and {} more problem(s)'
+                         .format(len(self.problems) - self.shown))
+        return '\n'.join(lines)
+
 
+def validate_sources(args,                       # type: argparse.Namespace
+                     names,                      # type: Iterable[str]
+                     report_path=None,           # type: Optional[str]
+                     jobs=1,                     # type: int
+                     cache_dir=SOURCE_CACHE_DIR  # type: Optional[str]
+                     ):
+    # type: (...) -> tuple
+    """
+    Checks and parses the files of the sources `names` with
+    :func:`check_source`, before anything is downloaded, so that a bad
+    value stops the run at once rather than after the slowest stages.
+    Each file is parsed once, checked a chunk at a time as it is read.
+
+    With `args.quarantine`, the invalid rows are left out instead; the
+    lines returned are those left out.
+
+    :param str report_path: where to write every problem found, with
+        its source and file, as CSV
+    :param int jobs: how many processes check files
+    :raises SourceError: listing the sources whose files could not be
+        checked or, unless quarantining, have invalid rows
+    :return: the lines left out of each source's file, and the frame of
+        each source, both keyed by name
+    """
+    logger = logging.getLogger(__name__)
+    checks = [(schema, getattr(args, name),
+               source_options(args, schema, cache_dir))
+              for name, schema in SOURCES.items() if name in names]
+    results = OrderedDict()
+    if jobs > 1 and len(checks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [(schema, pool.submit(profiling.call, check_source,
+                                            file_path, schema.name,
+                                            args.quarantine,
+                                            profile=profiling.settings(),
+                                            **kwargs))
+                       for schema, file_path, kwargs in checks]
+            for schema, future in futures:
+                try:
+                    results[schema.name], spans = future.result()
+                    profiling.merge(spans)
+                except Exception as e:
+                    results[schema.name] = e
+    else:
+        for schema, file_path, kwargs in checks:
+            try:
+                results[schema.name] = check_source(
+                    file_path, schema.name, args.quarantine, **kwargs)
+            except Exception as e:
+                results[schema.name] = e
+
+    errors = OrderedDict()
+    found = []
+    skip_lines = OrderedDict()
+    sources = OrderedDict()
+    for schema, file_path, _ in checks:
+        result = results[schema.name]
+        if isinstance(result, Exception):
+            errors[schema.label] = result
+            continue
+        problems, df = result
+        if df is not None:
+            sources[schema.name] = df
+        skip_lines[schema.name] = tuple(int(line) for line
+                                        in problems['line'].unique())
+        if not len(problems):
+            continue
+        found.append(problems.assign(source=schema.name, file=file_path))
+        if args.quarantine:
+            logger.warning('Leaving {} invalid row(s) of the {} file out '
+                           'of the report.'
+                           .format(len(skip_lines[schema.name]),
+                                   schema.label))
+        else:
+            errors[schema.label] = InvalidRows(problems)
+
+    if found and report_path:
+        (pd.concat(found, ignore_index=True)
+         [['source', 'file'] + PROBLEM_COLUMNS]
+         .to_csv(report_path, index=False))
+        logger.info('Every invalid row is listed in "{}".'
+                    .format(path.relpath(report_path)))
+    if errors:
+        raise SourceError(errors)
+    return skip_lines, sources
+
+
+def load_sources(args,                        # type: argparse.Namespace
+                 jobs=None,                   # type: Optional[int]
+                 cache_dir=SOURCE_CACHE_DIR,  # type: Optional[str]
+                 skip_lines=None,             # type: Optional[dict]
+                 parsed=None,                 # type: Optional[dict]
+                 roster=None,                 # type: Optional[RosterSnapshot]
+                 students=None                # type: Optional[Future]
+                 ):
+    # type: (...) -> tuple
+    """
+    Parses every registered source's file not already `parsed` in a
+    process pool while the student list is downloaded from PowerSchool
+    on a thread, so that the whole stage takes about as long as its
+    slowest source.
+
+    :param args: the parsed command line arguments
+    :param int jobs: how many processes parse files; with 1 everything
+        runs in this process, one source after another
+    :param str cache_dir: where parsed files are cached (see
+        :func:`cached_source`); None disables the cache
+    :param dict skip_lines: lines to leave out of each source's file,
+        from :func:`validate_sources`
+    :param dict parsed: frames of sources already parsed, which are not
+        parsed again
+    :param roster: passed on to :func:`make_student_list`
+    :param students: the student list's download, if it was already
+        started with :func:`request_student_list`
+    :raises SourceError: listing every source that failed, once all of
+        them have finished
+    :return: the frame of each source, keyed by its name, and the
+        student list
+    """
+    logger = logging.getLogger(__name__)
+    skip_lines = skip_lines or {}
+    parsed = parsed or {}
+    parsers = [(schema, getattr(args, name),
+                source_options(args, schema, cache_dir,
+                               skip_lines.get(name, ())))
+               for name, schema in SOURCES.items() if name not in parsed]
+    if jobs is None:
+        jobs = min(len(parsers), cpu_count() or 1)
+    if students is None:
+        students = request_student_list(roster)
+    sources = OrderedDict()
+    errors = OrderedDict()
+    for name in parsed:
+        logger.info('Found {} file at "{}".'
+                    .format(SOURCES[name].label, getattr(args, name)))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [(schema, file_path,
+                        pool.submit(profiling.call, parse_source,
+                                    file_path, schema.name,
+                                    profile=profiling.settings(),
+                                    **kwargs))
+                       for schema, file_path, kwargs in parsers]
+            for schema, file_path, future in futures:
+                try:
+                    sources[schema.name], spans = future.result()
+                    profiling.merge(spans)
+                    logger.info('Found {} file at "{}".'
+                                .format(schema.label, file_path))
+                except Exception as e:
+                    errors[schema.label] = e
+    else:
+        for schema, file_path, kwargs in parsers:
+            try:
+                sources[schema.name] = parse_source(file_path,
+                                                    schema.name, **kwargs)
+                logger.info('Found {} file at "{}".'
+                            .format(schema.label, file_path))
+            except Exception as e:
+                errors[schema.label] = e
+
+    try:
+        students = students.result()
+        logger.info('Student list retrieved.')
+    except Exception as e:
+        errors['PowerSchool'] = e
+
+    if errors:
+        raise SourceError(errors)
+    sources.update(parsed)
+    return OrderedDict((name, sources[name]) for name in SOURCES), students
 
-def parse_args():
-    # type: () -> argparse.Namespace
+
+def source_options(args, schema, cache_dir=SOURCE_CACHE_DIR, skip_lines=()):
+    # type: (argparse.Namespace, SourceSchema, str, tuple) -> dict
+    """
+    The keyword arguments :func:`make_source` is called with; without
+    `skip_lines`, also those :func:`make_checked_source` is called with.
+    """
+    skip = ()
+    if args.keep_future and 'future' in schema.predicates:
+        skip = ('future',)
+    options = {'skip': skip, 'cache_dir': cache_dir,
+               'engine': args.csv_engine}
+    if skip_lines:
+        options['skip_lines'] = skip_lines
+    return options
+
+
+def check_inputs(args):
+    # type: (argparse.Namespace) -> None
+    """
+    Checks that the input files exist, and that the report can be written
+    in its format, before any file is read or anything downloaded, so
+    that a mistyped path or a missing library fails at once.
+
+    :raises SourceError: listing every problem found
+    """
+    errors = OrderedDict()
+    for name, schema in SOURCES.items():
+        file_path = getattr(args, name)
+        if not path.isfile(file_path):
+            errors[schema.label] = IOError('No file at "{}".'
+                                           .format(file_path))
+    if args.learn and not path.isfile(args.learn):
+        errors['--learn'] = IOError('No file at "{}".'.format(args.learn))
+    try:
+        frame_io.check_format(args.format
+                              or frame_io.format_of(args.output_path))
+    except (ImportError, ValueError) as e:
+        errors['--format'] = e
+    if errors:
+        raise SourceError(errors)
+
+
+def write_report(df, path, fmt=None):
+    # type: (pd.DataFrame, str, str) -> None
+    """
+    Writes the merged report in :data:`REPORT_ORDER`, sorting it only if
+    it is not already, as it is when it comes from :func:`merge_sources`.
+
+    :param str fmt: one of :data:`frame_io.FORMATS`; by default judged
+        from the extension of `path`
+    """
+    frame_io.write_frame(df, path, fmt=fmt, sort_by=REPORT_ORDER)
+
+
+def parse_args(argv=None):
+    # type: (list) -> argparse.Namespace
     default = 'reports'
     formatter = argparse.ArgumentDefaultsHelpFormatter
 
     parser = argparse.ArgumentParser(description='Merge grade reports into '
                                                  'one file.',
                                      formatter_class=formatter)
-    parser.add_argument('-b', '--byu', type=str, nargs=1,
-                        default=path.join(default, 'byu.xlsx'),
-                        help='path to the BYU file')
-    parser.add_argument('-a', '--apex', type=str, nargs=1,
-                        default=path.join(default, 'apex.csv'),
-                        help='path to the Apex file')
-    parser.add_argument('-i', '--idla', type=str, nargs=1,
-                        default=path.join(default, 'idla.csv'),
-                        help='path to the IDLA file')
-    parser.add_argument('-s', '--schoology', type=str, nargs=1,
-                        default=path.join(default, 'schoology.csv'),
-                        help='path to the Schoology file')
-    parser.add_argument('-o', '--output-path', type=str, nargs=1,
+    for name, schema in SOURCES.items():
+        parser.add_argument(*schema.flags + ('--' + name,), type=str,
+                            default=path.join(default, schema.default_file),
+                            help='path to the {} file'.format(schema.label))
+    parser.add_argument('-o', '--output-path', type=str,
                         default=getcwd(),
-                        help='where to write the output CSV file')
+                        help='where to write the output file')
+    parser.add_argument('--format', choices=frame_io.FORMATS,
+                        help='the output file format; parquet and feather '
+                             'need pyarrow (default: judged from the '
+                             'output path, else csv)')
     parser.add_argument('-f', '--keep-future', action='store_true',
                         help='exclude classes that start in the future')
     parser.add_argument('-q', '--silence-output', action='store_true',
                         help='silence/quiet any console output')
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument('--refresh', action='store_true',
+                       help='ignore cached PowerSchool results and download '
+                            'them again')
+    cache.add_argument('--offline', action='store_true',
+                       help='use only cached PowerSchool results')
+    parser.add_argument('--cache-ttl', type=float, default=600,
+                        help='seconds for which cached PowerSchool results '
+                             'are reused')
+    parser.add_argument('--csv-engine', default='c',
+                        choices=['c', 'python', 'pyarrow'],
+                        help='the pandas CSV parser to use; pyarrow is '
+                             'fastest if installed')
+    parser.add_argument('--no-source-cache', action='store_true',
+                        help='parse every file again, even if it has not '
+                             'changed since the last run')
+    parser.add_argument('--quarantine', action='store_true',
+                        help='leave rows with invalid values out of the '
+                             'report, rather than stopping; they are listed '
+                             'in invalid-rows.csv')
+    parser.add_argument('-r', '--resolutions', type=str,
+                        default=RESOLUTIONS_PATH,
+                        help='the file remembering students matched by hand')
+    parser.add_argument('-l', '--learn', type=str, metavar='UNKNOWNS',
+                        help='a copy of unknown-students.csv with the '
+                             'student_number column filled in, to remember '
+                             'for this and future runs')
+    history = parser.add_mutually_exclusive_group()
+    history.add_argument('--history', type=str, default=HISTORY_PATH,
+                         help='the database every report is added to (see '
+                              'grade_history.py)')
+    history.add_argument('--no-history', action='store_true',
+                         help='do not add this report to the history')
+    roster = parser.add_mutually_exclusive_group()
+    roster.add_argument('--roster', type=str, default=ROSTER_PATH,
+                        help='the snapshot of the student list the next '
+                             'run compares its own with')
+    roster.add_argument('--no-roster', action='store_true',
+                        help='neither compare the student list with the '
+                             "last run's nor save it")
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='keep running, and update the report whenever '
+                             'one of the files changes')
+    parser.add_argument('--settle', type=float, default=2.,
+                        help='with --watch, seconds a changed file must stay '
+                             'unchanged before it is read')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='how many files to parse at once; 1 parses '
+                             'them one after another (default: one per '
+                             'file, up to the number of CPUs)')
+    parser.add_argument('--profile', type=str, metavar='TRACE',
+                        help='write how long each stage took, and how much '
+                             'memory and data it used, to this JSON file')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='with --profile, also measure the memory '
+                             'allocated by each stage (slow)')
+    parser.add_argument('--worker', action='store_true',
+                        help='run in the worker started by worker.py, '
+                             'which has everything loaded already; runs '
+                             'here if there is none')
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
-def main():
-    args = parse_args()
+def main(argv=None, interactive=True):
+    # type: (list, bool) -> None
+    """
+    :param list argv: the command line arguments; sys.argv by default
+    :param bool interactive: whether someone may be waiting at a console
+        that closes when the script exits
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
 
     level = logging.ERROR if args.silence_output else logging.INFO
     logging.basicConfig(level=level, format='%(message)s')
 
     logger = logging.getLogger(__name__)
+    check_inputs(args)
+    if args.worker:
+        import worker
+        status = worker.submit('merge_files',
+                               [a for a in argv if a != '--worker'])
+        if status is not None:
+            sys.exit(status)
+        logger.info('No worker is running; running here.')
+
+    if args.profile:
+        profiling.enable(trace_memory=args.profile_memory)
+    try:
+        with span('merge_files'):
+            run(args)
+    finally:
+        if args.profile:
+            profiling.write(args.profile)
+            logger.info('Profile saved to "{}".'.format(args.profile))
+
+    if interactive and platform.system() == 'Windows':
+        logger.info('Operation completed')
+        input('Press ENTER to exit')
+
+
+def run(args):
+    # type: (argparse.Namespace) -> None
+    logger = logging.getLogger(__name__)
+    configure_cache(ttl=args.cache_ttl, refresh=args.refresh,
+                    offline=args.offline)
     out_path = args.output_path
+    fmt = args.format or frame_io.format_of(out_path)
     if path.isdir(out_path):
-        out_path = path.join(out_path, 'grade-reports.csv')
-
-    byu = make_byu(args.byu)
-    logger.info('Found BYU file at "{}".'.format(args.byu))
-    apex = make_apex(args.apex, filter_future=not args.keep_future)
-    logger.info('Found Apex file at "{}".'.format(args.apex))
-    idla = make_idla(args.idla, filter_future=not args.keep_future)
-    logger.info('Found IDLA file at "{}".'.format(args.idla))
-    school = make_schoology(args.schoology)
-    logger.info('Found Schoology file at "{}".'.format(args.schoology))
-    logger.info('Requesting student list from PowerSchool. '
-                'This may take a moment.')
-    students = make_student_list()
-    logger.info('Student list retrieved.')
+        out_path = path.join(out_path, 'grade-reports.' + fmt)
+    elif args.format:
+        out_path = frame_io.with_format(out_path, fmt)
+
+    cache_dir = None if args.no_source_cache else SOURCE_CACHE_DIR
+    roster = None if args.no_roster else RosterSnapshot(args.roster)
+    # Downloaded while the files are checked; if one is invalid, the
+    # download is left to finish in the background and its list unused.
+    students = request_student_list(roster)
+    with span('check sources'):
+        report_path = path.join(path.dirname(out_path), 'invalid-rows.csv')
+        jobs = args.jobs or min(len(SOURCES), cpu_count() or 1)
+        skip_lines, parsed = validate_sources(args, SOURCES, report_path,
+                                              jobs=jobs, cache_dir=cache_dir)
+    with span('load sources'):
+        sources, students = load_sources(args, jobs=args.jobs,
+                                         cache_dir=cache_dir,
+                                         skip_lines=skip_lines,
+                                         parsed=parsed, students=students)
+    if roster is not None:
+        report_roster_changes(roster, out_path)
+
+    resolutions = ResolutionTable(args.resolutions)
+    if args.learn:
+        n_learned = resolutions.learn(args.learn)
+        logger.info('Learned {} student match(es) from "{}".'
+                    .format(n_learned, args.learn))
 
     logger.info('Merging and standardizing files.')
-    out = merge_sources(byu, apex, idla, school, students)
+    with span('merge') as s:
+        if roster is not None:
+            resolver = roster.resolver(resolutions)
+        else:
+            resolver = StudentResolver(students, resolutions=resolutions)
+        out = merge_sources(sources, students, resolver=resolver)
+        s.set(rows=len(out))
+    resolutions.save()
+    if roster is not None:
+        with span('save roster'):
+            roster.save()
+
+    write_outputs(args, out, out_path, fmt, resolver=resolver)
+    if args.watch:
+        out = watch(args, out, students, resolver, out_path, fmt)
+    if not args.no_history:
+        with span('record history', rows=len(out)):
+            with GradeHistory(args.history) as history:
+                run_id = history.append(out)
+        logger.info('Report added to the grade history as run {}.'
+                    .format(run_id))
+    logger.info('Printing 10 random rows from output as an example:')
+    if not args.silence_output:
+        print(out.sample(10).to_string(index=False))
+
+
+def report_roster_changes(roster, out_path):
+    # type: (RosterSnapshot, str) -> None
+    """
+    Lists the students added, removed or changed in PowerSchool since the
+    last run in `roster-changes.csv`, next to the output file.
+
+    :param roster: the snapshot, refreshed by :func:`make_student_list`
+    """
+    logger = logging.getLogger(__name__)
+    changes = roster.changes
+    if changes is None:
+        logger.info('Saved the student list; the next run will list the '
+                    'students added, removed or changed since.')
+        return
+    if not changes:
+        logger.info('No students were added, removed or changed in '
+                    'PowerSchool since {:%Y-%m-%d %H:%M}.'
+                    .format(changes.since))
+        return
+    changes_path = path.join(path.dirname(out_path), 'roster-changes.csv')
+    changes.report().to_csv(changes_path, index=False)
+    logger.info(changes.summary() + ' Saving the changes to "{}".'
+                .format(path.relpath(changes_path)))
 
+
+def write_outputs(args,          # type: argparse.Namespace
+                  out,           # type: pd.DataFrame
+                  out_path,      # type: str
+                  fmt,           # type: str
+                  resolver=None  # type: StudentResolver
+                  ):
+    # type: (...) -> None
+    """
+    Writes the report and, if any, the unknown students.
+
+    :param resolver: if given, suggests a student for each unknown one
+        whose name is close to a student's
+    """
+    logger = logging.getLogger(__name__)
     unknowns = out[out['student_number'].isnull()]
     n_unknown = len(unknowns)
     if n_unknown and not args.silence_output:
-        unknown_path = path.join(out_path, 'unknown-students.csv')
-        unknown_path = path.dirname(unknown_path)
-        unknown_path = path.relpath(unknown_path)
+        unknown_path = path.join(path.dirname(out_path),
+                                 'unknown-students.csv')
         logger.info('{} student were not found in student file.'
                     .format(n_unknown)
-                    + ' Saving those entries to "{}".'
-                    .format(unknown_path))
-        (unknowns.drop(columns='student_number')
-         .to_csv(unknown_path, index=False))
+                    + ' Saving those entries to "{}". Fill in their '
+                      'student_number column and pass the file to '
+                      '--learn to remember them.'
+                    .format(path.relpath(unknown_path)))
+        if resolver is not None:
+            with span('suggest students', rows=n_unknown) as s:
+                matches = resolver.resolve(unknowns)
+                n_suggested = int(matches['suggested_number'].notnull()
+                                  .sum())
+                s.set(suggested=n_suggested)
+            unknowns = unknowns.assign(**{
+                column: matches[column] for column in
+                ('suggested_number', 'match_score', 'match_method')})
+            if n_suggested:
+                logger.info('{} of them have a suggested_number: a '
+                            'student with a similar name. Check it before '
+                            'copying it to student_number.'
+                            .format(n_suggested))
+        unknowns.to_csv(unknown_path, index=False)
 
-    out.to_csv(out_path, index=False)
+    with span('write report', rows=len(out), format=fmt):
+        write_report(out, out_path, fmt=fmt)
     logger.info('Output file saved to "{}".'
                 .format(path.relpath(out_path)))
-    logger.info('Printing 10 random rows from output as an example:')
-    if not args.silence_output:
-        print(out.sample(10).to_string(index=False))
 
-    if platform.system() == 'Windows':
-        logger.info('Operation completed')
-        input('Press ENTER to exit')
 
+def watch(args,      # type: argparse.Namespace
+          out,       # type: pd.DataFrame
+          students,  # type: pd.DataFrame
+          resolver,  # type: StudentResolver
+          out_path,  # type: str
+          fmt        # type: str
+          ):
+    # type: (...) -> pd.DataFrame
+    """
+    Rewrites the report whenever a source's file changes, until stopped
+    with CTRL+C. Only the changed source is parsed and merged again; the
+    rows of the others are kept. The student list is the one downloaded
+    at the start.
 
-if __name__ == '__main__':
-    sys.path.insert(0, '..')
-    from ps_agent import fetch_students
+    :param out: the report of all the sources
+    :return: the last report written
+    """
+    logger = logging.getLogger(__name__)
+    cache_dir = None if args.no_source_cache else SOURCE_CACHE_DIR
+    slices = OrderedDict((name, out[out['source'] == name])
+                         for name in SOURCES)
+    watcher = FileWatcher(OrderedDict((name, getattr(args, name))
+                                      for name in SOURCES),
+                          settle=args.settle)
+    logger.info('Watching the files for changes. Press CTRL+C to stop.')
+    try:
+        while True:
+            changed = watcher.wait()
+            start = time.perf_counter()
+            for name in changed:
+                schema = SOURCES[name]
+                file_path = watcher.paths[name]
+                try:
+                    with span('update ' + name):
+                        _, parsed = validate_sources(
+                            args, [name], cache_dir=cache_dir)
+                        df = parsed[name]
+                        slices[name] = merge_sources({name: df}, students,
+                                                     resolver=resolver)
+                except Exception as e:
+                    if isinstance(e, SourceError):
+                        e = e.errors[schema.label]
+                    logger.warning('Could not load the {} file at "{}", '
+                                   'keeping its previous rows: {}'
+                                   .format(schema.label, file_path, e))
+                    continue
+                logger.info('Reloaded the {} file ({} rows).'
+                            .format(schema.label, len(slices[name])))
+            with span('combine', rows=sum(map(len, slices.values()))):
+                out = combine_slices(slices)
+            try:
+                write_outputs(args, out, out_path, fmt, resolver=resolver)
+            except (IOError, OSError) as e:
+                # E.g. the report is open in Excel, which locks it.
+                logger.warning('Could not write the report; it will be '
+                               'written on the next change: {}'.format(e))
+                continue
+            logger.info('Report updated in {:.1f} s.'
+                        .format(time.perf_counter() - start))
+    except KeyboardInterrupt:
+        logger.info('Stopped watching.')
+    return out
 
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
     try:
         main()
     except Exception as e:
@@ -0,0 +1,254 @@
+"""
+Keeps the student list downloaded from PowerSchool between runs, so
+that each run can tell which students joined, left or changed since the
+last one and only has to process those.
+
+Every student's record is hashed. A new download is compared with the
+snapshot by those hashes, keyed by student number: the students whose
+hash has not changed keep the rows, and the name indexes of the
+:class:`matching.StudentResolver`, built on an earlier run, and only the
+others are prepared and indexed again. What changed is described by a
+:class:`RosterChanges`.
+"""
+
+import logging
+import os
+import pickle
+from datetime import datetime
+from typing import Callable, Iterable, Optional
+
+from lazy import lazy_import
+from matching import ResolutionTable, StudentResolver
+
+pd = lazy_import('pandas')
+
+
+# Bump whenever what is saved, including the resolver's indexes, changes.
+SNAPSHOT_VERSION = 1
+CHANGE_COLUMNS = ['student_number', 'change', 'column', 'before', 'after']
+
+
+def record_hashes(students, columns):
+    # type: (pd.DataFrame, Iterable[str]) -> pd.Series
+    """
+    A 64-bit hash of each student's record, indexed by student number.
+    The hashes depend on the values only, not on the dtypes they are
+    stored in.
+    """
+    return pd.Series(pd.util.hash_pandas_object(students[list(columns)],
+                                                index=False).to_numpy(),
+                     index=students.index)
+
+
+class RosterChanges(object):
+    """
+    The students added to, removed from and changed on the roster since
+    the snapshot was taken.
+
+    :ivar pd.Index added: the numbers of the students who joined
+    :ivar pd.Index removed: the numbers of the students who left
+    :ivar pd.Index changed: the numbers of the students whose record
+        changed
+    :ivar datetime since: when the snapshot was taken
+    """
+
+    def __init__(self,
+                 before,   # type: pd.DataFrame
+                 after,    # type: pd.DataFrame
+                 columns,  # type: list
+                 added,    # type: pd.Index
+                 removed,  # type: pd.Index
+                 changed,  # type: pd.Index
+                 since     # type: datetime
+                 ):
+        # type: (...) -> None
+        """
+        :param before: the student list in the snapshot
+        :param after: the new download
+        :param columns: the columns compared
+        """
+        self.before = before
+        self.after = after
+        self.columns = columns
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.since = since
+
+    def summary(self):
+        # type: () -> str
+        return ('{} student(s) added, {} removed and {} changed in '
+                'PowerSchool since {:%Y-%m-%d %H:%M}.'
+                .format(len(self.added), len(self.removed),
+                        len(self.changed), self.since))
+
+    def report(self):
+        # type: () -> pd.DataFrame
+        """
+        Lists the changes one value per row, with the columns of
+        :data:`CHANGE_COLUMNS`: every value of the students added (under
+        `after`) and removed (under `before`), and the values of the
+        changed students that differ.
+        """
+        added = self._melt(self.after, self.added, 'after')
+        removed = self._melt(self.before, self.removed, 'before')
+        changed = self._melt(self.before, self.changed, 'before').merge(
+            self._melt(self.after, self.changed, 'after'),
+            on=['student_number', 'column'])
+        differs = ((changed['before'] != changed['after'])
+                   & ~(changed['before'].isnull()
+                       & changed['after'].isnull()))
+        report = pd.concat([added.assign(change='added'),
+                            removed.assign(change='removed'),
+                            changed[differs].assign(change='changed')],
+                           ignore_index=True)
+        return (report.reindex(columns=CHANGE_COLUMNS)
+                .sort_values('student_number', kind='stable')
+                .reset_index(drop=True))
+
+    def _melt(self, students, numbers, side):
+        # type: (pd.DataFrame, pd.Index, str) -> pd.DataFrame
+        values = students.loc[numbers, self.columns].astype(object)
+        values.index.name = 'student_number'
+        return values.reset_index().melt(id_vars='student_number',
+                                         var_name='column', value_name=side)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+
+class RosterSnapshot(object):
+    """
+    The student list as it was on the last run, saved to a file along
+    with the hash of every student's record and the name indexes built
+    from it. The file is only read by :meth:`refresh` and only written
+    by :meth:`save`.
+
+    :ivar pd.DataFrame students: the student list after the last
+        :meth:`refresh`
+    :ivar RosterChanges changes: what the last :meth:`refresh` found;
+        None if there was no snapshot to compare with
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = path
+        self.students = None  # type: Optional[pd.DataFrame]
+        self.changes = None  # type: Optional[RosterChanges]
+        self._hashes = None  # type: Optional[pd.Series]
+        self._columns = None  # type: Optional[list]
+        self._taken_at = None  # type: Optional[datetime]
+        self._resolver = None  # type: Optional[StudentResolver]
+        self._dirty = False
+
+    def refresh(self, fresh, prepare):
+        # type: (pd.DataFrame, Callable) -> pd.DataFrame
+        """
+        Brings the snapshot up to date with a new download of the
+        student list, and the saved name indexes with it.
+
+        :param fresh: the downloaded records, indexed by student number
+        :param prepare: turns downloaded records into rows of the student
+            list, e.g. adding derived columns; it is only given the
+            records that were added or changed
+        :return: the student list, sorted by student number, the same as
+            `prepare(fresh)` would have made it
+        """
+        self._load()
+        columns = sorted(fresh.columns)
+        hashes = record_hashes(fresh, columns)
+        before = self.students
+        if before is None or self._columns != columns:
+            self.students = prepare(fresh).sort_index()
+            self.changes = None
+            self._resolver = None
+        else:
+            old_hashes = self._hashes
+            added = fresh.index.difference(old_hashes.index)
+            removed = old_hashes.index.difference(fresh.index)
+            kept = fresh.index.intersection(old_hashes.index)
+            changed = kept[hashes.loc[kept].to_numpy()
+                           != old_hashes.loc[kept].to_numpy()]
+            self.changes = RosterChanges(before, fresh, columns, added,
+                                         removed, changed, self._taken_at)
+            if len(self.changes):
+                rows = prepare(fresh.loc[added.append(changed)])
+                # A download's categoricals may have other categories than
+                # the last one's; take the new download's.
+                self.students = (pd.concat([before.drop(removed.append(
+                    changed)), rows]).sort_index().astype(rows.dtypes))
+                if self._resolver is not None:
+                    self._resolver.update(self.students,
+                                          removed=removed.append(changed),
+                                          added=added.append(changed))
+            elif self._resolver is not None:
+                # Nothing to save; the changes are still since the same
+                # snapshot.
+                return self.students
+        self._hashes = hashes
+        self._columns = columns
+        self._taken_at = datetime.now()
+        self._dirty = True
+        return self.students
+
+    def resolver(self, resolutions=None):
+        # type: (Optional[ResolutionTable]) -> StudentResolver
+        """
+        A :class:`matching.StudentResolver` for the refreshed student
+        list: the one saved with the snapshot, brought up to date by
+        :meth:`refresh`, or a new one if there is none.
+        """
+        if self._resolver is None:
+            self._resolver = StudentResolver(self.students,
+                                             resolutions=resolutions)
+            self._dirty = True
+        else:
+            self._resolver.resolutions = resolutions
+            if resolutions is not None:
+                resolutions.prune(self.students.index.to_numpy())
+        return self._resolver
+
+    def save(self):
+        # type: () -> None
+        """
+        Writes the refreshed snapshot, readable by the owner only, unless
+        nothing has changed since it was read.
+        """
+        if not self._dirty:
+            return
+        state = {'version': SNAPSHOT_VERSION, 'pandas': pd.__version__,
+                 'students': self.students, 'hashes': self._hashes,
+                 'columns': self._columns, 'taken_at': self._taken_at,
+                 'resolver': self._resolver}
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except (IOError, OSError) as e:
+            logging.getLogger(__name__).warning(
+                'Could not save the student list snapshot: {}'.format(e))
+
+    def _load(self):
+        # type: () -> None
+        if self.students is not None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+            if (state['version'] != SNAPSHOT_VERSION
+                    or state['pandas'] != pd.__version__):
+                raise ValueError('made by another version')
+        except Exception as e:
+            logging.getLogger(__name__).debug(
+                'Ignoring the student list snapshot "{}": {}'
+                .format(self.path, e))
+            return
+        self.students = state['students']
+        self._hashes = state['hashes']
+        self._columns = state['columns']
+        self._taken_at = state['taken_at']
+        self._resolver = state['resolver']
@@ -0,0 +1,604 @@
+"""
+Declarative descriptions of the vendor exports merged by
+:mod:`merge_files`, and the engine that reads them.
+
+Each export is described by a :class:`SourceSchema`: which columns to
+keep and what to call them, which are dates, what dtypes they end up
+with, which strings to split into several columns and which rows to
+throw away. :func:`read_source` applies all of that while the file is
+being parsed -- a chunk at a time, with rows filtered out before any
+casting or splitting is done -- rather than copying the whole frame
+once per fix-up.
+
+Schemas are kept in the :data:`SOURCES` registry, in the order they are
+merged, with :func:`register`. Supporting a new export only takes a new
+schema.
+
+:func:`validate` checks a file against its schema before it is read,
+without casting anything, and reports the rows that :func:`read_source`
+would fail on or read wrongly by their line in the file, so that they
+can be fixed or left out with `skip_lines`. :func:`read_checked` does
+both in one pass, checking each chunk before casting it.
+"""
+
+import os
+from collections import OrderedDict, namedtuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from compact import nullable_dtype
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# The columns of the frames returned by :func:`validate`.
+PROBLEM_COLUMNS = ['line', 'column', 'value', 'problem']
+
+# The last sheet validated, keyed by what it was read from, so that
+# validating a sheet and then reading it costs one read.
+_sheets = {}  # type: Dict[tuple, pd.DataFrame]
+
+
+class Split(namedtuple('Split', ['column', 'sep', 'into', 'n'])):
+    """
+    Splits the strings in `column` on `sep` into the columns `into`. A
+    column in `into` may be `column` itself, in which case it is
+    overwritten with the first part.
+    """
+
+    def __new__(cls, column, sep, into, n=None):
+        # type: (str, str, List[str], int) -> Split
+        if n is None:
+            n = len(into) - 1
+        return super(Split, cls).__new__(cls, column, sep, into, n)
+
+    def apply(self, df):
+        # type: (pd.DataFrame) -> None
+        parts = df[self.column].str.split(self.sep, n=self.n, expand=True,
+                                          regex=False)
+        if parts.shape[1] < len(self.into):
+            # No value contained the separator; the extra parts are empty.
+            for i in range(parts.shape[1], len(self.into)):
+                parts[i] = np.nan
+        df[self.into] = parts
+
+
+class SourceSchema(object):
+    """
+    Describes how to read one vendor export.
+
+    :ivar str name: the source's name, as written to the `source` column
+    :ivar str label: the source's name as shown to people
+    :ivar str default_file: the file's name inside the reports directory
+    :ivar tuple flags: the short command line flag(s) for the file's path
+    :ivar str reader: `'csv'` or `'excel'`
+    :ivar columns: for files read by header, an ordered mapping of the
+        header names to keep onto the names to give them; for files read
+        by position (`positional`), the list of names for every column
+    :ivar bool positional: whether `columns` names every column in order
+        rather than selecting them by header
+    :ivar list drop: columns not to keep at all
+    :ivar list dates: columns parsed as dates while reading
+    :ivar list na_values: extra strings read as missing values
+    :ivar bool drop_empty_rows: drop rows in which every value is missing
+    :ivar list required: drop rows missing a value in any of these
+    :ivar OrderedDict predicates: named functions of a chunk returning a
+        boolean mask of the rows to keep; they run before any split or
+        cast, so rejected rows cost nothing more
+    :ivar list splits: the :class:`Split` objects to apply, in order
+    :ivar OrderedDict derived: functions of a chunk computing new (or
+        replacing existing) columns, applied after the splits
+    :ivar dict dtypes: the final dtype of each column, applied last.
+        Integer columns that contain missing values get the nullable
+        dtype instead. A dtype that needs pandas to build can be given
+        as a function returning it, so that registering the schema does
+        not import pandas.
+    :ivar bool dedupe: drop duplicate rows once the file is read
+    :ivar int version: bumped whenever the schema's output changes
+    """
+
+    def __init__(self,
+                 name,                  # type: str
+                 label,                 # type: str
+                 default_file,          # type: str
+                 flags,                 # type: Iterable[str]
+                 columns,               # type: Dict[str, str]
+                 reader='csv',          # type: str
+                 positional=False,      # type: bool
+                 drop=(),               # type: Iterable[str]
+                 dates=(),              # type: Iterable[str]
+                 na_values=None,        # type: Optional[List[str]]
+                 drop_empty_rows=True,  # type: bool
+                 required=(),           # type: Iterable[str]
+                 predicates=None,       # type: Optional[OrderedDict]
+                 splits=(),             # type: Iterable[Split]
+                 dtypes=None,           # type: Optional[dict]
+                 derived=None,          # type: Optional[OrderedDict]
+                 dedupe=False,          # type: bool
+                 version=1              # type: int
+                 ):
+        # type: (...) -> None
+        if reader not in ('csv', 'excel'):
+            raise ValueError('Unknown reader "{}".'.format(reader))
+        self.name = name
+        self.label = label
+        self.default_file = default_file
+        self.flags = tuple(flags)
+        self.reader = reader
+        self.positional = positional
+        if positional:
+            columns = OrderedDict((c, c) for c in columns)
+        self.columns = OrderedDict(columns)
+        self.drop = list(drop)
+        self.dates = list(dates)
+        self.na_values = na_values
+        self.drop_empty_rows = drop_empty_rows
+        self.required = list(required)
+        self.predicates = OrderedDict(predicates or {})
+        self.splits = list(splits)
+        self.dtypes = dict(dtypes or {})
+        self.derived = OrderedDict(derived or {})
+        self.dedupe = dedupe
+        self.version = version
+
+    @property
+    def raw_columns(self):
+        # type: () -> List[str]
+        """The names of the columns to read, as they appear in the file."""
+        return [raw for raw, col in self.columns.items()
+                if col not in self.drop]
+
+    def __repr__(self):
+        return 'SourceSchema({!r})'.format(self.name)
+
+
+SOURCES = OrderedDict()  # type: Dict[str, SourceSchema]
+
+
+def register(schema):
+    # type: (SourceSchema) -> SourceSchema
+    """Adds a schema to :data:`SOURCES`, replacing any of the same name."""
+    SOURCES[schema.name] = schema
+    return schema
+
+
+def read_source(schema,         # type: SourceSchema
+                path,           # type: str
+                skip=(),        # type: Iterable[str]
+                chunksize=50000,  # type: Optional[int]
+                engine='c',     # type: str
+                skip_lines=()   # type: Iterable[int]
+                ):
+    # type: (...) -> pd.DataFrame
+    """
+    Reads a file as described by `schema`.
+
+    CSV files are read `chunksize` rows at a time. Each chunk is renamed,
+    filtered by the schema's predicates, then split, extended with
+    derived columns and cast, before the chunks are concatenated and
+    deduplicated. With the `'pyarrow'` engine, which parses in parallel
+    but cannot read in chunks, the whole file is read at once.
+
+    :param schema: the schema describing the file
+    :param str path: the file's path
+    :param skip: names of predicates not to apply
+    :param int chunksize: rows per chunk; None reads the file at once
+    :param str engine: the :func:`pandas.read_csv` engine
+    :param skip_lines: lines of the file to leave out, numbered as by
+        :func:`validate`
+    :return: a frame with a default index
+    """
+    _check_skip(schema, skip)
+    chunks = [_transform(schema, chunk, set(skip))
+              for chunk in _read_chunks(schema, path, chunksize, engine,
+                                        sorted(skip_lines))]
+    if len(chunks) == 1:
+        df = chunks[0]
+    else:
+        df = pd.concat(chunks, ignore_index=True)
+    if schema.dedupe:
+        df = df.drop_duplicates()
+    return df.reset_index(drop=True)
+
+
+def _check_skip(schema, skip):
+    # type: (SourceSchema, Iterable[str]) -> None
+    missing = set(skip) - set(schema.predicates)
+    if missing:
+        raise KeyError('Unknown predicate(s) {} for source "{}".'
+                       .format(sorted(missing), schema.name))
+
+
+def _read_chunks(schema, path, chunksize, engine, skip_lines):
+    # type: (SourceSchema, str, Optional[int], str, List[int]) -> Iterable
+    if schema.reader == 'excel':
+        df = _read_sheet(schema, path, keep=False)
+        df = df[~df.index.isin(skip_lines)]
+        for column in schema.dates:
+            raw = _raw_name(schema, column)
+            df[raw] = pd.to_datetime(df[raw])
+        return [df]
+
+    options = {
+        'usecols': schema.raw_columns,
+        'na_values': schema.na_values,
+        'parse_dates': [_raw_name(schema, c) for c in schema.dates],
+        'engine': engine
+    }
+    if schema.positional:
+        options.update(names=list(schema.columns), header=0)
+    if skip_lines:
+        # Lines counted from 0, as read_csv does; the pyarrow engine
+        # cannot skip them.
+        options['skiprows'] = [line - 1 for line in skip_lines]
+        if engine == 'pyarrow':
+            options['engine'] = 'c'
+    if options['engine'] == 'pyarrow' or chunksize is None:
+        return [pd.read_csv(path, **options)]
+    return pd.read_csv(path, chunksize=chunksize, **options)
+
+
+def _transform(schema, df, skip):
+    # type: (SourceSchema, pd.DataFrame, set) -> pd.DataFrame
+    # Restore the schema's column order; usecols keeps the file's.
+    df = df[schema.raw_columns]
+    df.columns = [schema.columns[c] for c in schema.raw_columns]
+
+    if schema.drop_empty_rows:
+        df = df.dropna(how='all')
+    if schema.required:
+        df = df.dropna(how='any', subset=schema.required)
+
+    if schema.predicates:
+        keep = np.ones(len(df), dtype=bool)
+        for name, predicate in schema.predicates.items():
+            if name not in skip:
+                keep &= np.asarray(predicate(df), dtype=bool)
+        df = df[keep]
+    df = df.copy()
+
+    for split in schema.splits:
+        split.apply(df)
+    for column, func in schema.derived.items():
+        df[column] = func(df)
+    return _cast(schema, df)
+
+
+def _cast(schema, df):
+    # type: (SourceSchema, pd.DataFrame) -> pd.DataFrame
+    for column, dtype in schema.dtypes.items():
+        if column in df:
+            df[column] = cast(df[column], dtype)
+    return df
+
+
+def read_checked(schema,           # type: SourceSchema
+                 path,             # type: str
+                 skip=(),          # type: Iterable[str]
+                 chunksize=50000,  # type: int
+                 engine='c',       # type: str
+                 quarantine=False  # type: bool
+                 ):
+    # type: (...) -> Tuple[pd.DataFrame, Optional[pd.DataFrame]]
+    """
+    Checks a file as :func:`validate` does and reads it as
+    :func:`read_source` does, parsing a CSV file only once: the values
+    that need checking are parsed as text, a chunk at a time, checked,
+    and only then cast. Rows with none of the schema's values, such as
+    blank lines, are left out.
+
+    Sheets, which are read whole and only once either way, and files
+    read with the `'pyarrow'` engine, which cannot number the lines, are
+    validated first and then read.
+
+    :param quarantine: leave the invalid rows out rather than not
+        reading the file
+    :raises ValueError: if the file lacks some of the schema's columns
+    :return: the problems found, as returned by :func:`validate`, and
+        the frame read; None if problems were found and not
+        `quarantine`
+    """
+    _check_skip(schema, skip)
+    if schema.reader == 'excel' or engine == 'pyarrow':
+        problems = validate(schema, path, skip=skip, engine=engine)
+        if len(problems) and not quarantine:
+            return problems, None
+        return problems, read_source(
+            schema, path, skip=skip, chunksize=chunksize, engine=engine,
+            skip_lines=[int(line) for line in problems['line'].unique()])
+
+    text = set(schema.dates) | set(schema.dtypes)
+    text.update(split.column for split in schema.splits)
+    chunks = []
+    found = []
+    for df in _read_raw(schema, path, engine, chunksize=chunksize,
+                        text=[raw for raw in schema.raw_columns
+                              if schema.columns[raw] in text]):
+        df, problems = _check(schema, df.dropna(how='all'), set(skip))
+        found += problems
+        if found and not quarantine:
+            # Only the problems matter now.
+            continue
+        if problems:
+            df = df.drop(pd.concat([p['line'] for p in problems]).unique(),
+                         errors='ignore')
+        chunks.append(_cast(schema, df))
+
+    problems = _problem_frame(found)
+    if len(problems) and not quarantine:
+        return problems, None
+    if not chunks:
+        # An empty file has no chunks; read_source builds its empty frame.
+        return problems, read_source(schema, path, skip=skip)
+    df = chunks[0] if len(chunks) == 1 else pd.concat(chunks)
+    if schema.dedupe:
+        df = df.drop_duplicates()
+    return problems, df.reset_index(drop=True)
+
+
+def validate(schema,     # type: SourceSchema
+             path,       # type: str
+             skip=(),    # type: Iterable[str]
+             engine='c'  # type: str
+             ):
+    # type: (...) -> pd.DataFrame
+    """
+    Checks a file against `schema` without casting anything, one column
+    at a time, and finds the values that :func:`read_source` would fail
+    on or read wrongly:
+
+        - dates that cannot be parsed
+        - numbers that cannot be parsed, are not whole numbers where the
+          dtype is an integer one, or do not fit in the dtype
+        - values to be split that lack the separator, whose other parts
+          would be left empty
+
+    The columns made by the schema's splits and derived columns are
+    checked as they would be made, so that, say, a section number after
+    " - " that is not a number is found. Rows that the schema drops
+    anyway are not checked.
+
+    Lines are numbered as in a text editor or spreadsheet, the header
+    being line 1, as long as no value in a CSV file spans several lines.
+
+    :param skip: names of predicates not to apply
+    :raises ValueError: if the file lacks some of the schema's columns
+    :return: a frame of :data:`PROBLEM_COLUMNS` with a row per problem,
+        sorted by line; `value` is the value as found in the file
+    """
+    _check_skip(schema, skip)
+    _, problems = _check(schema, _read_raw(schema, path, engine), set(skip))
+    return _problem_frame(problems)
+
+
+def _check(schema, df, skip):
+    # type: (SourceSchema, pd.DataFrame, set) -> Tuple[pd.DataFrame, list]
+    """
+    Applies `schema` to a frame of a file's values, indexed by line,
+    short of casting them, and checks the values that need checking.
+
+    :return: the frame, dates parsed but not cast, and a frame of
+        :data:`PROBLEM_COLUMNS` for each problem found in a column
+    """
+    df = df[schema.raw_columns]
+    df.columns = [schema.columns[c] for c in schema.raw_columns]
+    if schema.drop_empty_rows:
+        df = df.dropna(how='all')
+    if schema.required:
+        df = df.dropna(how='any', subset=schema.required)
+    # The file's value behind each column, for the report.
+    raw = df.copy()
+    origin = {column: column for column in raw}
+    problems = []
+
+    def report(column, bad, problem):
+        # type: (str, pd.Series, str) -> None
+        if bad.any():
+            lines = bad.index[bad.to_numpy()]
+            problems.append(pd.DataFrame({
+                'line': lines,
+                'column': column,
+                'value': raw.loc[lines, origin[column]].astype(str).to_numpy(),
+                'problem': problem
+            }))
+
+    for column in schema.dates:
+        dates = pd.to_datetime(df[column], errors='coerce')
+        report(column, df[column].notnull() & dates.isnull(), 'not a date')
+        df[column] = dates
+
+    if schema.predicates:
+        keep = np.ones(len(df), dtype=bool)
+        for name, predicate in schema.predicates.items():
+            if name not in skip:
+                keep &= np.asarray(predicate(df), dtype=bool)
+        df = df[keep].copy()
+    for split in schema.splits:
+        values = df[split.column]
+        report(split.column, values.notnull() & ~values.str.contains(
+            split.sep, regex=False, na=False), 'no {!r}'.format(split.sep))
+        split.apply(df)
+        for column in split.into:
+            origin[column] = origin[split.column]
+    for column, func in schema.derived.items():
+        df[column] = func(df)
+        if column not in raw:
+            raw[column] = df[column]
+        origin.setdefault(column, column)
+    for column, dtype in schema.dtypes.items():
+        if column in df:
+            for bad, problem in invalid(df[column], dtype):
+                report(column, bad, problem)
+    return df, problems
+
+
+def _problem_frame(problems):
+    # type: (List[pd.DataFrame]) -> pd.DataFrame
+    if not problems:
+        return pd.DataFrame(columns=PROBLEM_COLUMNS)
+    return (pd.concat(problems, ignore_index=True)
+            .sort_values('line', kind='stable')
+            .reset_index(drop=True))
+
+
+def _read_raw(schema, path, engine, chunksize=None, text=None):
+    # type: (...) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]
+    """
+    Reads a file's columns as they are, indexed by line number.
+
+    :param chunksize: if given, the rows read at a time; an iterator of
+        frames is then returned
+    :param text: the file's columns to read as text; by default all of
+        them. The others are parsed as :func:`read_source` parses them.
+    """
+    if schema.reader == 'excel':
+        return _read_sheet(schema, path, keep=True)
+
+    header = list(pd.read_csv(path, nrows=0).columns)
+    if schema.positional:
+        if len(header) < len(schema.columns):
+            raise ValueError('Expected {} columns but found {}.'
+                             .format(len(schema.columns), len(header)))
+    else:
+        missing = [c for c in schema.raw_columns if c not in header]
+        if missing:
+            raise ValueError('Missing the column(s) {}.'.format(
+                ', '.join('"{}"'.format(c) for c in missing)))
+    options = {
+        'usecols': schema.raw_columns,
+        'na_values': schema.na_values,
+        'dtype': str if text is None else dict.fromkeys(text, str),
+        # Blank lines are rows too, so that rows match lines.
+        'skip_blank_lines': False,
+        'engine': 'c' if engine == 'pyarrow' else engine
+    }
+    if schema.positional:
+        options.update(names=list(schema.columns), header=0)
+    if chunksize is not None:
+        return (_numbered(df) for df in pd.read_csv(
+            path, chunksize=chunksize, **options))
+    return _numbered(pd.read_csv(path, **options))
+
+
+def _numbered(df):
+    # type: (pd.DataFrame) -> pd.DataFrame
+    # The header is line 1; chunks carry on the numbering.
+    df.index = df.index + 2
+    return df
+
+
+def _read_sheet(schema, path, keep):
+    # type: (SourceSchema, str, bool) -> pd.DataFrame
+    """
+    Reads the columns of an Excel export, with the schema's missing
+    values replaced, indexed by line number.
+
+    :param bool keep: keep the frame for the next call without `keep`,
+        which takes it rather than reading the file again; the frame
+        must then not be changed
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size,
+           tuple(schema.raw_columns), tuple(schema.na_values or ()))
+    df = _sheets.pop(key, None)
+    _sheets.clear()
+    if df is None or keep:
+        df = read_excel_columns(path, schema.raw_columns)
+        if schema.na_values:
+            df = df.replace(schema.na_values, np.nan)
+        # The header is line 1.
+        df.index = df.index + 2
+    if keep:
+        _sheets[key] = df
+    return df
+
+
+def invalid(series, dtype):
+    # type: (pd.Series, object) -> List[Tuple[pd.Series, str]]
+    """
+    Finds the values that :func:`cast` would fail on or change.
+
+    :return: (mask of the bad values, what is wrong with them) pairs
+    """
+    if callable(dtype) and not isinstance(dtype, type):
+        dtype = dtype()
+    dtype = pd.api.types.pandas_dtype(dtype)
+    present = series.notnull()
+    if isinstance(dtype, np.dtype) and dtype.kind == 'M':
+        return [(present & pd.to_datetime(series, errors='coerce').isnull(),
+                 'not a date')]
+    if not pd.api.types.is_numeric_dtype(dtype):
+        return []
+
+    numbers = pd.to_numeric(series, errors='coerce')
+    checks = [(present & numbers.isnull(), 'not a number')]
+    if pd.api.types.is_integer_dtype(dtype):
+        info = np.iinfo(getattr(dtype, 'numpy_dtype', dtype))
+        checks += [
+            (numbers.notnull() & (numbers % 1 != 0), 'not a whole number'),
+            ((numbers < info.min) | (numbers > info.max),
+             'not between {:,} and {:,}'.format(info.min, info.max))
+        ]
+    return checks
+
+
+def read_excel_columns(file_path, usecols):
+    # type: (str, list) -> pd.DataFrame
+    """
+    Reads only `usecols` from the first sheet of an Excel file, streaming
+    its rows with openpyxl's read-only mode rather than loading the whole
+    workbook. Like :func:`pandas.read_excel`, the columns are returned
+    in the order they appear in the file.
+    """
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        return pd.read_excel(file_path, usecols=usecols)
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        missing = [c for c in usecols if c not in header]
+        if missing:
+            raise ValueError('Usecols do not match columns, columns '
+                             'expected but not found: {}'.format(missing))
+        indices = sorted(header.index(c) for c in usecols)
+        data = [[] for _ in indices]
+        for row in rows:
+            for values, i in zip(data, indices):
+                values.append(row[i] if i < len(row) else None)
+    finally:
+        workbook.close()
+    return pd.DataFrame({header[i]: values
+                         for i, values in zip(indices, data)})
+
+
+def _raw_name(schema, column):
+    # type: (SourceSchema, str) -> str
+    for raw, col in schema.columns.items():
+        if col == column:
+            return raw
+    raise KeyError(column)
+
+
+def cast(series, dtype):
+    # type: (pd.Series, object) -> pd.Series
+    """
+    Casts `series` to `dtype`, parsing strings first for numeric dtypes
+    and switching integer dtypes to their nullable counterpart when
+    there are missing values.
+
+    :param dtype: a dtype, or a function returning one
+    """
+    if callable(dtype) and not isinstance(dtype, type):
+        dtype = dtype()
+    dtype = pd.api.types.pandas_dtype(dtype)
+    if isinstance(dtype, np.dtype) and dtype.kind == 'M':
+        return pd.to_datetime(series)
+    if isinstance(dtype, np.dtype) and dtype.kind in 'iuf':
+        if not pd.api.types.is_numeric_dtype(series):
+            series = pd.to_numeric(series)
+        if dtype.kind in 'iu' and series.isnull().any():
+            dtype = nullable_dtype(dtype)
+    return series.astype(dtype)
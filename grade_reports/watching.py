@@ -0,0 +1,82 @@
+"""
+Notices when the vendor exports are replaced, for `merge_files.py
+--watch`.
+
+Files are polled rather than watched through the operating system, so
+this works the same on Windows, macOS, Linux and network drives. A
+change is only reported once the file's size and modification time have
+stayed the same for a settling period, so that an export still being
+copied or saved is not read half-written.
+"""
+
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+Signature = Tuple[int, int]
+
+
+def signature(file_path):
+    # type: (str) -> Optional[Signature]
+    """The modification time and size of a file; None if it is missing."""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class FileWatcher(object):
+    """
+    Polls a set of files for changes.
+
+    :ivar dict paths: the files watched, keyed by a name
+    :ivar float settle: seconds a changed file must stay unchanged before
+        it is reported
+    :ivar float interval: seconds between polls in :meth:`wait`
+    """
+
+    def __init__(self, paths, settle=2., interval=.5):
+        # type: (Dict[str, str], float, float) -> None
+        self.paths = paths
+        self.settle = settle
+        self.interval = interval
+        self._seen = {name: signature(file_path)
+                      for name, file_path in paths.items()}
+        # The signature a changed file was last seen with, and since when.
+        self._pending = {}  # type: Dict[str, Tuple[Signature, float]]
+
+    def poll(self):
+        # type: () -> List[str]
+        """
+        Checks every file once.
+
+        :return: the names of the files that changed and have since
+            settled. Missing files are never reported; they are reported
+            once they are back and differ from what was last seen.
+        """
+        now = time.monotonic()
+        ready = []
+        for name, file_path in self.paths.items():
+            current = signature(file_path)
+            if current == self._seen[name]:
+                self._pending.pop(name, None)
+                continue
+            pending = self._pending.get(name)
+            if pending is None or pending[0] != current:
+                self._pending[name] = (current, now)
+            elif current is not None and now - pending[1] >= self.settle:
+                self._seen[name] = current
+                del self._pending[name]
+                ready.append(name)
+        return ready
+
+    def wait(self):
+        # type: () -> List[str]
+        """Polls until at least one file has changed and settled."""
+        while True:
+            ready = self.poll()
+            if ready:
+                return ready
+            time.sleep(self.interval)
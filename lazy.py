@@ -0,0 +1,51 @@
+"""
+Defers importing the heavy libraries -- pandas, NumPy, requests -- until
+they are first used, so that the scripts can parse their arguments,
+check their input files and answer `--help` without waiting for them:
+
+    from lazy import lazy_import
+    pd = lazy_import('pandas')
+
+The module returned is an ordinary module whose code only runs when one
+of its attributes is first looked up. Code run at import time, such as
+annotations and class bodies, must therefore not touch it, and code that
+starts threads or forks processes which use it should :func:`load` it
+first: a process forked while another thread is half-way through loading
+a module inherits the half-loaded module.
+"""
+
+import importlib.util
+import sys
+import threading
+from types import ModuleType
+
+
+_lock = threading.Lock()
+
+
+def lazy_import(name):
+    # type: (str) -> ModuleType
+    """
+    Returns the module `name`, loading it on first use. A module that is
+    already imported is returned as is.
+    """
+    with _lock:
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            raise ImportError('No module named {!r}'.format(name), name=name)
+        loader = importlib.util.LazyLoader(spec.loader)
+        spec.loader = loader
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        loader.exec_module(module)
+        return module
+
+
+def load(*modules):
+    # type: (*ModuleType) -> None
+    """Finishes loading modules returned by :func:`lazy_import`."""
+    for module in modules:
+        getattr(module, '__name__')
@@ -0,0 +1,400 @@
+"""
+Lightweight stage timings for the scripts.
+
+Code marks its stages with :func:`span`:
+
+    with span('merge', sources=4) as s:
+        out = merge(...)
+        s.set(rows=len(out))
+
+When profiling is off -- the default -- :func:`span` returns a shared
+do-nothing object, so instrumented code costs no more than a function
+call. Once :func:`enable` has been called, every span records its wall
+time, the CPU time of its thread, the process's peak resident memory
+and, if asked, the peak memory allocated by Python while it was open.
+Counters such as the HTTP bytes received (see :meth:`Span.add`) are
+added up into the enclosing spans.
+
+:func:`write` saves the spans in the Trace Event format, which can be
+opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+ROLLUP_COUNTERS = frozenset(['http_bytes', 'http_requests', 'http_retries'])
+
+
+def _max_rss():
+    # type: () -> Optional[int]
+    """The process's peak resident set size in bytes, if known."""
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes.
+        return rss if sys.platform == 'darwin' else rss * 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss)
+
+
+class Span(object):
+    """
+    One timed stage. A span opened while another is open on the same
+    thread (or in a function wrapped with :func:`bind` there) is its
+    child.
+
+    :ivar str name: what the stage is
+    :ivar dict attrs: what is known about the stage, e.g. `rows`
+    :ivar dict counters: totals gathered while it was open, including
+        those of its children
+    """
+
+    __slots__ = ('tracer', 'id', 'parent', 'name', 'attrs', 'counters',
+                 'start', 'wall', 'cpu', 'max_rss', 'alloc_peak', 'pid',
+                 'thread', '_start_perf', '_start_cpu', '_start_alloc')
+
+    def __init__(self, tracer, id, name, parent, attrs):
+        # type: (Tracer, int, str, Optional[Span], dict) -> None
+        self.tracer = tracer
+        self.id = id
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.counters = {}  # type: Dict[str, int]
+        self.start = 0.
+        self.wall = None  # type: Optional[float]
+        self.cpu = None  # type: Optional[float]
+        self.max_rss = None  # type: Optional[int]
+        self.alloc_peak = None  # type: Optional[int]
+        self._start_alloc = 0
+        self.pid = os.getpid()
+        self.thread = threading.current_thread().name
+
+    def set(self, **attrs):
+        # type: (...) -> None
+        """Records facts about the stage, e.g. ``rows=len(df)``."""
+        self.attrs.update(attrs)
+
+    def add(self, counter, n=1):
+        # type: (str, int) -> None
+        """Adds `n` to one of the stage's counters."""
+        with self.tracer._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def __enter__(self):
+        self.tracer._open(self)
+        self.start = time.time()
+        self._start_perf = time.perf_counter()
+        self._start_cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self._start_perf
+        self.cpu = time.thread_time() - self._start_cpu
+        self.max_rss = _max_rss()
+        if exc[0] is not None:
+            self.attrs['error'] = exc[0].__name__
+        self.tracer._close(self)
+
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        return {
+            'id': self.id,
+            'parent': self.parent.id if self.parent is not None else None,
+            'name': self.name,
+            'start': self.start,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'max_rss': self.max_rss,
+            'alloc_peak': (self.alloc_peak - self._start_alloc
+                           if self.alloc_peak is not None else None),
+            'pid': self.pid,
+            'thread': self.thread,
+            'attrs': self.attrs,
+            'counters': self.counters
+        }
+
+
+class _NullSpan(object):
+    """Stands in for a :class:`Span` while profiling is off."""
+
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def add(self, counter, n=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """
+    Collects the spans of one run.
+
+    :ivar bool trace_memory: also measure Python's allocations with
+        :mod:`tracemalloc`, which slows the code down considerably
+    """
+
+    def __init__(self, trace_memory=False):
+        # type: (bool) -> None
+        self.trace_memory = trace_memory
+        self.spans = []  # type: List[Span]
+        self.records = []  # type: List[dict]
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._open_spans = set()
+        self._next_id = 0
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def span(self, name, **attrs):
+        # type: (str, ...) -> Span
+        with self._lock:
+            self._next_id += 1
+            return Span(self, self._next_id, name, self.current(), attrs)
+
+    def current(self):
+        # type: () -> Optional[Span]
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def merge(self, records):
+        # type: (List[dict]) -> None
+        """
+        Adopts spans recorded by another process (see :func:`call`),
+        rolling their counters up into the current span.
+        """
+        parent = self.current()
+        with self._lock:
+            ids = {}
+            for record in records:
+                self._next_id += 1
+                ids[record['id']] = self._next_id
+            for record in records:
+                record['id'] = ids[record['id']]
+                if record['parent'] is not None:
+                    record['parent'] = ids.get(record['parent'])
+                elif parent is not None:
+                    record['parent'] = parent.id
+                    _rollup(parent, record['counters'])
+                self.records.append(record)
+
+    def _push(self, span):
+        # type: (Span) -> None
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(span)
+
+    def _pop(self, span):
+        # type: (Span) -> None
+        stack = self._local.stack
+        if span in stack:
+            stack.remove(span)
+
+    def _open(self, span):
+        # type: (Span) -> None
+        self._push(span)
+        if self.trace_memory:
+            with self._lock:
+                self._fold_peak()
+                span._start_alloc = tracemalloc.get_traced_memory()[0]
+                span.alloc_peak = span._start_alloc
+                self._open_spans.add(span)
+
+    def _close(self, span):
+        # type: (Span) -> None
+        self._pop(span)
+        with self._lock:
+            if self.trace_memory:
+                self._fold_peak()
+                self._open_spans.discard(span)
+            if span.parent is not None:
+                _rollup(span.parent, span.counters)
+            self.spans.append(span)
+
+    def _fold_peak(self):
+        # type: () -> None
+        """
+        Credits the allocation peak since the last fold to every open
+        span, then starts measuring the next one.
+        """
+        peak = tracemalloc.get_traced_memory()[1]
+        for span in self._open_spans:
+            span.alloc_peak = max(span.alloc_peak or 0, peak)
+        tracemalloc.reset_peak()
+
+    def to_dicts(self):
+        # type: () -> List[dict]
+        with self._lock:
+            return ([span.to_dict() for span in self.spans]
+                    + list(self.records))
+
+    def trace(self):
+        # type: () -> dict
+        """The spans as a Trace Event document."""
+        events = []
+        for record in sorted(self.to_dicts(), key=lambda r: r['start']):
+            args = dict(record['attrs'])
+            args.update(record['counters'])
+            for key in ('cpu', 'max_rss', 'alloc_peak'):
+                if record[key] is not None:
+                    args[key] = record[key]
+            events.append({
+                'name': record['name'],
+                'ph': 'X',
+                'ts': record['start'] * 1e6,
+                'dur': (record['wall'] or 0.) * 1e6,
+                'pid': record['pid'],
+                'tid': record['thread'],
+                'args': args
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'spans': self.to_dicts()}
+
+
+def _rollup(span, counters):
+    # type: (Span, Dict[str, int]) -> None
+    for counter, n in counters.items():
+        if counter in ROLLUP_COUNTERS:
+            span.counters[counter] = span.counters.get(counter, 0) + n
+
+
+_tracer = None  # type: Optional[Tracer]
+
+
+def enable(trace_memory=False):
+    # type: (bool) -> Tracer
+    """Starts recording spans, returning the tracer that holds them."""
+    global _tracer
+    _tracer = Tracer(trace_memory=trace_memory)
+    return _tracer
+
+
+def disable():
+    # type: () -> None
+    global _tracer
+    if _tracer is not None and _tracer.trace_memory:
+        tracemalloc.stop()
+    _tracer = None
+
+
+def enabled():
+    # type: () -> bool
+    return _tracer is not None
+
+
+def span(name, **attrs):
+    # type: (str, ...) -> Span
+    """
+    Returns a context manager timing the stage `name`, nested in the
+    innermost span open on this thread.
+
+    :param attrs: facts about the stage, e.g. `rows`
+    """
+    if _tracer is None:
+        return NULL_SPAN
+    return _tracer.span(name, **attrs)
+
+
+def current():
+    # type: () -> Span
+    """The innermost span open on this thread, if profiling."""
+    if _tracer is None:
+        return NULL_SPAN
+    return _tracer.current() or NULL_SPAN
+
+
+def bind(func):
+    # type: (Callable) -> Callable
+    """
+    Wraps `func`, before handing it to a thread pool, so that the spans
+    it opens nest in the span open on this thread.
+    """
+    tracer = _tracer
+    parent = tracer.current() if tracer is not None else None
+    if parent is None:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        tracer._push(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            tracer._pop(parent)
+    return wrapper
+
+
+def merge(records):
+    # type: (Optional[List[dict]]) -> None
+    """
+    Adds the spans returned by :func:`call` in a worker process to this
+    process's, nested in the current span.
+    """
+    if _tracer is not None and records:
+        _tracer.merge(records)
+
+
+def settings():
+    # type: () -> Optional[dict]
+    """
+    How this process is profiling, to pass to :func:`call` in worker
+    processes; None if it is not.
+    """
+    if _tracer is None:
+        return None
+    return {'trace_memory': _tracer.trace_memory}
+
+
+def call(func, *args, **kwargs):
+    # type: (Callable, ...) -> Tuple[Any, Optional[List[dict]]]
+    """
+    Runs ``func(*args, **kwargs)`` in a worker process, profiling it with
+    the :func:`settings` given as the `profile` keyword argument, if any.
+
+    :return: the result and, if profiled, the spans it recorded, for the
+        parent process's :meth:`Tracer.merge`
+    """
+    profile = kwargs.pop('profile', None)
+    if profile is None:
+        return func(*args, **kwargs), None
+    tracer = enable(**profile)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        disable()
+    return result, tracer.to_dicts()
+
+
+def write(path):
+    # type: (str) -> None
+    """Writes the spans recorded so far to `path` as a JSON trace."""
+    if _tracer is None:
+        return
+    with open(path, 'w') as f:
+        json.dump(_tracer.trace(), f, indent=1, default=str)
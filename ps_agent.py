@@ -10,18 +10,79 @@ compose the API.
 The :data:`course2program_code`, aptly named, maps a course code as
 defined in the documentation provided by Apex Learning to their
 respective program codes.
+
+Access tokens are handed out by a :class:`TokenManager`, which keeps
+the token in memory (and, optionally, on disk) until it is about to
+expire, so that consecutive queries -- and consecutive runs of the
+scripts -- do not each pay for an OAuth handshake. All HTTP traffic
+goes through a :class:`PSClient`, a pooled keep-alive session that
+retries transient failures; every :class:`PowerQuery` shares the
+module's default client unless it is given its own.
+
+Every request waits its turn in the process-wide
+:class:`RequestScheduler`, which keeps to a rate limit, backs off when
+the server throttles or slows down (honoring `Retry-After`), and lets
+interactive queries ahead of bulk downloads. :meth:`RequestScheduler.stats`
+reports how many requests were sent, waited and were throttled.
+
+Several queries can be run at once from :mod:`asyncio` code with
+:class:`AsyncPowerQuery` and :func:`gather_queries`, or from ordinary
+code with :func:`fetch_many`.
+
+Once :func:`configure_cache` is called, as the scripts do, complete
+query results are kept for a while in a :class:`QueryCache` on disk, so
+that rerunning a script moments later does not download the same
+records again, and so that the scripts keep working while the server
+is unreachable.
+
+Results can also be decoded straight into a :class:`pandas.DataFrame`
+with :meth:`PowerQuery.fetch_frame`, which builds one array per column
+instead of one dict per record and applies the dtypes declared for the
+query. Responses are parsed with :mod:`orjson` when it is installed.
 """
 
+import asyncio
+import datetime
+import email.utils
+import gzip
+import hashlib
+import heapq
 import json
 import logging
 import os
+import random
 import sys
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import count, islice
+from typing import AsyncIterator, Iterable, Iterator, Optional, Union
+from urllib.parse import urljoin
+
 try:
-    from urllib.parse import urljoin
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
 except ImportError:
-    from urlparse import urljoin
+    _loads = json.loads
+
+    def _dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+import profiling
+from compact import nullable_dtype
+from lazy import lazy_import
+from profiling import span
+
+requests = lazy_import('requests')
 
-import requests
+# The priorities of requests, most urgent first (see RequestScheduler).
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+PRIORITIES = {INTERACTIVE: 'interactive', NORMAL: 'normal', BULK: 'bulk'}
 
 
 course2program_code = {
@@ -48,82 +109,1349 @@ class PowerQuery(object):
     These stock PowerQuery objects are defined in this :mod:`ps_agent`
     module.
 
+    :cvar PS_URL: the PowerSchool server; overridden by the `PS_URL`
+        environment variable, e.g. to use a local stand-in
     :cvar BASE_QUERY_URL: the base URL schema for location the Apex
         PowerQueries.
+    :cvar PAGE_SIZE: the default number of records per page when a
+        query is fetched in pages
+    :cvar MAX_WORKERS: the default number of pages fetched in parallel
+    :ivar dict dtypes: the dtype of each column in :meth:`fetch_frame`
+    :ivar int priority: the priority of the query's requests
     """
 
-    PS_URL = 'https://powerschool.sd351.k12.id.us/'
+    PS_URL = os.environ.get('PS_URL', 'https://powerschool.sd351.k12.id.us/')
     BASE_QUERY_URL = '/ws/schema/query/com.classchoice.school.'
+    PAGE_SIZE = 1000
+    MAX_WORKERS = 4
 
-    def __init__(self, url_ext, description=None):
-        # type: (str, str)
+    def __init__(self, url_ext, description=None, client=None, dtypes=None,
+                 priority=None):
+        # type: (str, str, PSClient, dict, int)
         """
         :param str url_ext: the extension that, appended to the `PS_URL`
             environment variable and `BASE_URL` as defined above,
             composes the URL
+        :param PSClient client: the client to send the query with; by
+            default the one returned by :func:`get_default_client`
+        :param dict dtypes: maps column names to the dtypes they are cast
+            to by :meth:`fetch_frame`
+        :param int priority: the :class:`RequestScheduler` priority of
+            its requests; :data:`INTERACTIVE` for queries someone is
+            waiting on, :data:`BULK` for large downloads that can wait,
+            and :data:`NORMAL` if None
         """
         self.url_ext = url_ext
+        self._client = client
+        self.dtypes = dtypes or {}
+        if priority is None:
+            priority = NORMAL
+        self.priority = priority
         if description is not None:
             self.__doc__ = description
 
+    @property
+    def client(self):
+        # type: () -> PSClient
+        if self._client is not None:
+            return self._client
+        return get_default_client()
+
     def fetch(self, page_size=0):
-        # type: (int) -> dict
+        # type: (int) -> list
         """
         Obtains an access token and calls a PowerQuery at a given url,
-        limiting it to `page_size` results.
+        limiting it to `page_size` results. When every result is
+        requested, the query is fetched page by page in parallel through
+        :meth:`iter_records`.
 
         :param int page_size: how many results to return, 0 = all
         :raises PSEmptyQueryException: when no results are returned
-        :return: the JSON object returned by the PowerQuery
+        :return: the records returned by the PowerQuery
         """
         logger = logging.getLogger(__name__)
         logger.debug('Fetching PowerQuery with extension ' + str(self.url_ext))
-        token = get_ps_token()
-        header = get_header(token,
-                            custom_args={'Content-Type': 'application/json'})
-        payload = {'pagesize': page_size}
-        url = urljoin(self.PS_URL, self.BASE_QUERY_URL + self.url_ext)
+        cache = get_query_cache()
+        if cache is not None:
+            columns = cache.lookup(self, page_size)
+            if columns is not None:
+                return columns_to_records(columns)
+
+        with span('query ' + self.url_ext) as s:
+            try:
+                if page_size:
+                    records = self.fetch_page(1, page_size)
+                else:
+                    records = list(self.iter_records())
+            except (PSNoConnectionError, PSQueryError) as e:
+                if cache is None or not _is_outage(e):
+                    raise
+                return columns_to_records(cache.fallback(self, page_size, e))
+            s.set(rows=len(records))
+
+        if not records:
+            raise PSEmptyQueryException(self.url)
+        if cache is not None:
+            cache.store(self, page_size, records_to_columns(records))
+        return records
+
+    def fetch_frame(self, page_size=0, optimize=True):
+        # type: (int, bool) -> pd.DataFrame
+        """
+        Like :meth:`fetch`, but returns a DataFrame. Each page is decoded
+        straight into per-column lists, flattening PowerSchool's nested
+        `tables` as it goes, and the query's :attr:`dtypes` are applied.
+        Columns that contain nulls are given the nullable counterpart of
+        their integer dtype.
+
+        :param int page_size: how many results to return, 0 = all
+        :param bool optimize: narrow the dtypes of the other columns with
+            :func:`compact.compact`, e.g. turning repetitive strings into
+            categoricals
+        :raises PSEmptyQueryException: when no results are returned
+        :return: a frame with one row per record
+        """
+        import pandas as pd
+
+        logger = logging.getLogger(__name__)
+        logger.debug('Fetching PowerQuery frame with extension '
+                     + str(self.url_ext))
+        cache = get_query_cache()
+        columns = None
+        if cache is not None:
+            columns = cache.lookup(self, page_size, flat=True)
+
+        if columns is None:
+            with span('query ' + self.url_ext) as s:
+                try:
+                    if page_size:
+                        pages = [self.fetch_page(1, page_size)]
+                    else:
+                        pages = self.iter_pages()
+                    columns = records_to_columns(
+                        (record for page in pages for record in page),
+                        flat=True)
+                except (PSNoConnectionError, PSQueryError) as e:
+                    if cache is None or not _is_outage(e):
+                        raise
+                    columns = cache.fallback(self, page_size, e, flat=True)
+                else:
+                    if not columns:
+                        raise PSEmptyQueryException(self.url)
+                    s.set(rows=len(next(iter(columns.values()))))
+                    if cache is not None:
+                        cache.store(self, page_size, columns, flat=True)
+
+        frame = pd.DataFrame(columns)
+        for column, dtype in self.dtypes.items():
+            if column not in frame:
+                continue
+            values = frame[column]
+            if pd.api.types.is_numeric_dtype(pd.api.types.pandas_dtype(dtype)):
+                values = pd.to_numeric(values)
+            if values.isnull().any():
+                dtype = nullable_dtype(dtype)
+            frame[column] = values.astype(dtype)
+        if optimize:
+            from compact import compact
+            compact(frame, exclude=self.dtypes)
+        return frame
+
+    def count(self):
+        # type: () -> int
+        """
+        Asks the server how many records the query returns without
+        fetching them.
+
+        :raises PSQueryError: if the server cannot count the query
+        :return: the number of records
+        """
+        r = self._query(self.url + '/count', {})
+        if r.status_code != 200:
+            raise PSQueryError(self.url + '/count', r.status_code)
+        return int(_loads(r.content)['count'])
+
+    def fetch_page(self, page, page_size=None):
+        # type: (int, int) -> list
+        """
+        Fetches a single page of the query's results.
+
+        :param int page: the 1-based page number
+        :param int page_size: records per page; :attr:`PAGE_SIZE` if None
+        :return: the records on the page, empty past the last page
+        """
+        if page_size is None:
+            page_size = self.PAGE_SIZE
+        with span('page', query=self.url_ext, page=page) as s:
+            r = self._query(self.url, {'pagesize': page_size, 'page': page})
+            logging.getLogger(__name__).debug(
+                'Page {} of "{}" returns with status {}'
+                .format(page, self.url_ext, r.status_code))
+            if r.status_code != 200:
+                raise PSQueryError(self.url, r.status_code)
+            records = _loads(r.content).get('record', [])
+            s.set(rows=len(records))
+        return records
+
+    def iter_pages(self, page_size=None, max_workers=None, ordered=True):
+        # type: (int, int, bool) -> Iterator[list]
+        """
+        Fetches the query's results one page at a time, downloading up to
+        `max_workers` pages in parallel and yielding each as soon as it
+        can. At most twice `max_workers` pages are held in memory at once.
+
+        If the server cannot count the query, pages are instead fetched
+        one after another until a short page is returned.
+
+        :param int page_size: records per page; :attr:`PAGE_SIZE` if None
+        :param int max_workers: the number of parallel requests;
+            :attr:`MAX_WORKERS` if None
+        :param bool ordered: yield pages in page order rather than in the
+            order they arrive
+        :return: an iterator over lists of records
+        """
+        if page_size is None:
+            page_size = self.PAGE_SIZE
+        if max_workers is None:
+            max_workers = self.MAX_WORKERS
 
-        r = requests.post(url, headers=header, params=payload)
-        logger.debug('PowerQuery returns with status ' + str(r.status_code))
         try:
-            return r.json()['record']
-        except KeyError as e:
-            if e.args[0] == 'record':
-                raise PSEmptyQueryException(url)
-            raise e
+            n_pages = -(-self.count() // page_size)
+        except PSQueryError:
+            logging.getLogger(__name__).debug(
+                'Could not count "{}"; fetching pages sequentially.'
+                .format(self.url_ext))
+            for records in self._iter_pages_sequential(page_size):
+                yield records
+            return
+
+        pages = iter(range(1, n_pages + 1))
+        fetch_page = profiling.bind(self.fetch_page)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            pending = deque(pool.submit(fetch_page, page, page_size)
+                            for page in islice(pages, 2 * max_workers))
+            try:
+                while pending:
+                    if ordered:
+                        done = [pending.popleft()]
+                    else:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            pending.remove(future)
+
+                    for future in done:
+                        for page in islice(pages, 1):
+                            pending.append(pool.submit(fetch_page,
+                                                       page, page_size))
+                        yield future.result()
+            finally:
+                # Don't download the rest if the caller stops early.
+                for future in pending:
+                    future.cancel()
+
+    def iter_records(self, page_size=None, max_workers=None, ordered=True):
+        # type: (int, int, bool) -> Iterator[dict]
+        """
+        Like :meth:`iter_pages`, but yields individual records.
+        """
+        for records in self.iter_pages(page_size=page_size,
+                                       max_workers=max_workers,
+                                       ordered=ordered):
+            for record in records:
+                yield record
+
+    @property
+    def url(self):
+        # type: () -> str
+        """The absolute URL of the PowerQuery on the client's server."""
+        return self.client.url_for(self.BASE_QUERY_URL + self.url_ext)
+
+    def _iter_pages_sequential(self, page_size):
+        # type: (int) -> Iterator[list]
+        page = 1
+        while True:
+            records = self.fetch_page(page, page_size)
+            if records:
+                yield records
+            if len(records) < page_size:
+                return
+            page += 1
+
+    def _query(self, url, payload):
+        # type: (str, dict) -> requests.Response
+        client = self.client
+        r = self._post(client, url, payload, self.priority)
+        if r.status_code == 401:
+            # The server may revoke a token before its advertised expiry.
+            logging.getLogger(__name__).debug(
+                'Token rejected; requesting a new one.')
+            client.token_manager.invalidate()
+            r = self._post(client, url, payload, self.priority)
+        return r
 
     def __call__(self, page_size=0):
-        # type: (int) -> dict
+        # type: (int) -> list
         """Calls the fetch method."""
         return self.fetch(page_size=page_size)
 
+    @staticmethod
+    def _post(client, url, payload, priority=None):
+        # type: (PSClient, str, dict, int) -> requests.Response
+        header = get_header(client.token_manager.get_token(),
+                            custom_args={'Content-Type': 'application/json'})
+        # PowerQueries only read, so they are safe to retry.
+        return client.request('POST', url, idempotent=True,
+                              priority=priority, headers=header,
+                              params=payload)
+
 
-fetch_sections = PowerQuery('sections')
-fetch_students = PowerQuery('students')
+# The class choice script is run interactively, while the student list is
+# a bulk download that can give way to it.
+fetch_sections = PowerQuery('sections', dtypes={
+    'termid': 'uint16',
+    'school_id': 'uint16',
+    'max_enrollment': 'uint16',
+    'teacher_id': 'uint16'
+}, priority=INTERACTIVE)
+fetch_students = PowerQuery('students', dtypes={
+    'student_number': 'uint32',
+    'school_id': 'uint16'
+}, priority=BULK)
 fetch_all_courses = PowerQuery('current_courses')
 
 
+class AsyncPowerQuery(object):
+    """
+    The :mod:`asyncio` counterpart of a :class:`PowerQuery`. Requests are
+    still sent through the wrapped query's :class:`PSClient`, so every
+    async query shares the same token and connection pool as the
+    synchronous API; they are simply run on the event loop's executor so
+    that many pages, of many queries, can be in flight at once.
+
+    The number of concurrent requests is bounded by a semaphore, which
+    can be shared between queries (see :func:`gather_queries`).
+    """
+
+    def __init__(self, query, concurrency=None):
+        # type: (Union[PowerQuery, str], int) -> None
+        """
+        :param query: a :class:`PowerQuery` or the URL extension of one
+        :param int concurrency: how many requests this query may have in
+            flight when no semaphore is passed to it;
+            :attr:`PowerQuery.MAX_WORKERS` if None
+        """
+        if not isinstance(query, PowerQuery):
+            query = PowerQuery(query)
+        self.query = query
+        if concurrency is None:
+            concurrency = query.MAX_WORKERS
+        self.concurrency = concurrency
+
+    async def count(self, semaphore=None):
+        # type: (asyncio.Semaphore) -> int
+        """See :meth:`PowerQuery.count`."""
+        return await self._run(semaphore, self.query.count)
+
+    async def fetch_page(self, page, page_size=None, semaphore=None):
+        # type: (int, int, asyncio.Semaphore) -> list
+        """See :meth:`PowerQuery.fetch_page`."""
+        return await self._run(semaphore, self.query.fetch_page,
+                               page, page_size)
+
+    async def iter_pages(self, page_size=None, semaphore=None):
+        # type: (int, asyncio.Semaphore) -> AsyncIterator[list]
+        """
+        Yields the query's pages in order, downloading later pages while
+        earlier ones are consumed. As with :meth:`PowerQuery.iter_pages`,
+        at most twice :attr:`concurrency` pages are scheduled at once.
+        """
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+        if page_size is None:
+            page_size = self.query.PAGE_SIZE
+
+        try:
+            n_pages = -(-(await self.count(semaphore)) // page_size)
+        except PSQueryError:
+            page = 1
+            while True:
+                records = await self.fetch_page(page, page_size, semaphore)
+                if records:
+                    yield records
+                if len(records) < page_size:
+                    return
+                page += 1
+
+        pages = iter(range(1, n_pages + 1))
+        tasks = deque(
+            asyncio.ensure_future(self.fetch_page(page, page_size, semaphore))
+            for page in islice(pages, 2 * self.concurrency)
+        )
+        try:
+            while tasks:
+                records = await tasks.popleft()
+                for page in islice(pages, 1):
+                    tasks.append(asyncio.ensure_future(
+                        self.fetch_page(page, page_size, semaphore)))
+                yield records
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def fetch(self, page_size=0, semaphore=None):
+        # type: (int, asyncio.Semaphore) -> list
+        """
+        The async equivalent of :meth:`PowerQuery.fetch`.
+
+        :raises PSEmptyQueryException: when no results are returned
+        """
+        cache = get_query_cache()
+        if cache is not None:
+            columns = cache.lookup(self.query, page_size)
+            if columns is not None:
+                return columns_to_records(columns)
+
+        try:
+            if page_size:
+                records = await self.fetch_page(1, page_size, semaphore)
+            else:
+                records = []
+                async for page in self.iter_pages(semaphore=semaphore):
+                    records.extend(page)
+        except (PSNoConnectionError, PSQueryError) as e:
+            if cache is None or not _is_outage(e):
+                raise
+            return columns_to_records(
+                cache.fallback(self.query, page_size, e))
+
+        if not records:
+            raise PSEmptyQueryException(self.query.url)
+        if cache is not None:
+            cache.store(self.query, page_size, records_to_columns(records))
+        return records
+
+    async def _run(self, semaphore, func, *args):
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, partial(func, *args))
+
+
+async def gather_queries(*queries, **kwargs):
+    # type: (*Union[PowerQuery, str], **int) -> list
+    """
+    Fetches several PowerQueries at once, pages included, with no more
+    than `concurrency` requests in flight in total.
+
+    :param queries: :class:`PowerQuery` objects or URL extensions
+    :param int concurrency: the total number of concurrent requests;
+        8 by default
+    :return: a list with the records of each query, in argument order
+    """
+    concurrency = kwargs.pop('concurrency', 8)
+    if kwargs:
+        raise TypeError('Unexpected keyword arguments: {}'
+                        .format(', '.join(kwargs)))
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[
+        AsyncPowerQuery(query).fetch(semaphore=semaphore)
+        for query in queries
+    ])
+
+
+def fetch_many(*queries, **kwargs):
+    # type: (*Union[PowerQuery, str], **int) -> list
+    """
+    A synchronous facade over :func:`gather_queries`, e.g.::
+
+        sections, students = fetch_many(fetch_sections, fetch_students)
+    """
+    return asyncio.run(gather_queries(*queries, **kwargs))
+
+
+class QueryCache(object):
+    """
+    Stores complete PowerQuery results on disk, keyed by the server, the
+    query's URL extension and its parameters. Results are handled in a
+    compact columnar layout -- one list of values per field rather than
+    one object per record (see :func:`records_to_columns`) -- and
+    written gzipped.
+
+    An entry is served for `ttl` seconds. In `refresh` mode the cache is
+    never read (but still written); in `offline` mode entries are served
+    regardless of their age and the server is never contacted. Whenever
+    the server cannot be reached, times out or fails with a 5xx status,
+    an expired entry is served rather than failing; a query the server
+    rejects (a 4xx status) still fails. Once the directory grows past
+    `max_bytes`, the least recently used entries are removed.
+    """
+
+    SUFFIX = '.json.gz'
+
+    def __init__(self,
+                 directory,                 # type: str
+                 ttl=600,                   # type: float
+                 max_bytes=256 * 2 ** 20,   # type: int
+                 refresh=False,             # type: bool
+                 offline=False              # type: bool
+                 ):
+        # type: (...) -> None
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.offline = offline
+        self._lock = threading.Lock()
+
+    def key(self, query, page_size=0, flat=False):
+        # type: (PowerQuery, int, bool) -> str
+        """Hashes everything that determines a query's result."""
+        ident = json.dumps([query.client.base_url, query.url_ext, page_size,
+                            flat])
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    def lookup(self, query, page_size=0, flat=False):
+        # type: (PowerQuery, int, bool) -> Optional[dict]
+        """
+        Returns the cached columns for a query, or None if they must be
+        downloaded.
+
+        :raises PSCacheMissError: in offline mode, if nothing is cached
+        """
+        key = self.key(query, page_size, flat)
+        if self.offline:
+            columns = self._read(key, max_age=None)
+            if columns is None:
+                raise PSCacheMissError(query.url_ext)
+            return columns
+        if self.refresh:
+            return None
+        return self._read(key, max_age=self.ttl)
+
+    def fallback(self, query, page_size, error, flat=False):
+        # type: (PowerQuery, int, PSException, bool) -> dict
+        """
+        Returns cached columns of any age for a query that could not be
+        downloaded because PowerSchool was unavailable, re-raising the
+        download's `error` if there are none.
+        """
+        columns = self._read(self.key(query, page_size, flat), max_age=None)
+        if columns is None:
+            raise error
+        logging.getLogger(__name__).warning(
+            '{} Using cached results for "{}".'.format(error, query.url_ext))
+        return columns
+
+    def store(self, query, page_size, columns, flat=False):
+        # type: (PowerQuery, int, dict, bool) -> None
+        """Writes a query's columns to the cache, then evicts if needed."""
+        entry = {'created': time.time(), 'columns': columns}
+        path = self._path(self.key(query, page_size, flat))
+        tmp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        try:
+            if not os.path.isdir(self.directory):
+                # Rosters contain student data; keep them private.
+                os.makedirs(self.directory, mode=0o700)
+            with gzip.open(tmp_path, 'wb') as f:
+                f.write(_dumps(entry))
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as e:
+            logging.getLogger(__name__).debug(
+                'Could not cache "{}": {}'.format(query.url_ext, e))
+            return
+        self.evict()
+
+    def evict(self):
+        # type: () -> None
+        """Removes least recently used entries until under `max_bytes`."""
+        with self._lock:
+            try:
+                entries = [os.path.join(self.directory, name)
+                           for name in os.listdir(self.directory)
+                           if name.endswith(self.SUFFIX)]
+                stats = sorted((os.stat(p).st_atime, os.stat(p).st_size, p)
+                               for p in entries)
+            except OSError:
+                return
+            total = sum(size for _, size, _ in stats)
+            for _, size, path in stats:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+    def clear(self):
+        # type: () -> None
+        """Removes every cached result."""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(self.SUFFIX):
+                os.remove(os.path.join(self.directory, name))
+
+    def _path(self, key):
+        # type: (str) -> str
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def _read(self, key, max_age):
+        # type: (str, Optional[float]) -> Optional[dict]
+        path = self._path(key)
+        try:
+            with gzip.open(path, 'rb') as f:
+                entry = _loads(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+        if max_age is not None and time.time() - entry['created'] > max_age:
+            return None
+        # Mark the entry as recently used for eviction.
+        os.utime(path, None)
+        return entry['columns']
+
+
+def records_to_columns(records, flat=False):
+    # type: (Iterable[dict], bool) -> dict
+    """
+    Transposes PowerQuery records into one list of values per field in a
+    single pass. Fields missing from a record are filled with None.
+
+    :param records: the records, e.g. as yielded by
+        :meth:`PowerQuery.iter_records`
+    :param bool flat: merge each record's nested `tables` into its
+        top-level fields, as :func:`flatten_ps_json` does
+    :return: a dict mapping each field to its list of values
+    """
+    columns = {}
+    n = 0
+    for record in records:
+        if flat and 'tables' in record:
+            fields = [item for table in record['tables'].values()
+                      for item in table.items()]
+        else:
+            fields = record.items()
+        for field, value in fields:
+            column = columns.get(field)
+            if column is None:
+                column = columns[field] = [None] * n
+            elif len(column) > n:
+                # Repeated field (e.g. in two tables); the last one wins.
+                column.pop()
+            column.append(value)
+        n += 1
+        for column in columns.values():
+            if len(column) < n:
+                column.append(None)
+    return columns
+
+
+def columns_to_records(columns):
+    # type: (dict) -> list
+    """
+    The inverse of :func:`records_to_columns`. Since PowerSchool omits
+    null fields from its records, None values are left out.
+    """
+    names = list(columns)
+    return [{c: v for c, v in zip(names, values) if v is not None}
+            for values in zip(*[columns[c] for c in names])]
+
+
+def _is_outage(error):
+    # type: (PSException) -> bool
+    """
+    Whether a failed query means PowerSchool was unavailable -- it could
+    not be reached, timed out or failed with a 5xx status -- rather than
+    that it rejected the query.
+    """
+    return (isinstance(error, PSNoConnectionError)
+            or (isinstance(error, PSQueryError) and error.status_code >= 500))
+
+
+_query_cache = None
+
+
+def get_query_cache():
+    # type: () -> Optional[QueryCache]
+    """
+    Returns the cache consulted by :meth:`PowerQuery.fetch`: None, so that
+    nothing is cached, until :func:`configure_cache` is called.
+    """
+    return _query_cache
+
+
+def configure_cache(enabled=True, directory=None, **kwargs):
+    # type: (bool, str, **...) -> Optional[QueryCache]
+    """
+    Replaces the module's :class:`QueryCache`.
+
+    :param bool enabled: whether results are cached at all
+    :param str directory: where to store results; `.ps-cache` next to
+        this module by default
+    :param kwargs: passed on to :class:`QueryCache`, e.g. `ttl`,
+        `refresh` or `offline`
+    :return: the new cache, or None if disabled
+    """
+    global _query_cache
+    if directory is None:
+        directory = os.path.join(get_script_path(), '.ps-cache')
+    _query_cache = QueryCache(directory, **kwargs) if enabled else None
+    return _query_cache
+
+
+class RequestScheduler(object):
+    """
+    Decides when each request to PowerSchool may be sent, so that a
+    process does not send more than the server is willing to take. One
+    scheduler is shared by every :class:`PSClient` in the process (see
+    :func:`get_scheduler`).
+
+    Requests are held back in two ways. A token bucket lets through
+    `rate` requests a second on average, in bursts of up to `burst`, and
+    no more than :attr:`concurrency` requests are in flight at once. The
+    concurrency limit adapts to the server, AIMD-style: while it is used
+    up, it grows by one after a full window of successful responses, and
+    it is halved when the server answers 429 or 503, a request times
+    out, or responses become slower than `latency_target` on average. A
+    `Retry-After` sent with a response holds back every request until it
+    has passed.
+
+    Waiting requests are let through by priority -- :data:`INTERACTIVE`
+    before :data:`NORMAL` before :data:`BULK` -- and otherwise in the
+    order they arrived, so that a query someone is waiting on is not
+    stuck behind the pages of a large download.
+
+    :cvar THROTTLE_STATUSES: the HTTP statuses that mean the server is
+        overloaded
+    :ivar int concurrency: the current limit on requests in flight
+    """
+
+    THROTTLE_STATUSES = frozenset([429, 503])
+
+    def __init__(self,
+                 rate=50.,              # type: Optional[float]
+                 burst=20,              # type: int
+                 concurrency=8,         # type: int
+                 min_concurrency=1,     # type: int
+                 max_concurrency=32,    # type: int
+                 latency_target=10.     # type: float
+                 ):
+        # type: (...) -> None
+        """
+        :param float rate: the average number of requests sent a second;
+            None for no limit
+        :param int burst: how many requests may be sent at once after a
+            quiet spell
+        :param int concurrency: the initial limit on requests in flight
+        :param int min_concurrency: the limit is never lowered below this
+        :param int max_concurrency: the limit is never raised above this
+        :param float latency_target: the average response time, in
+            seconds, above which the limit is lowered
+        """
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.counters = Counter()
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.
+        self._in_flight = 0
+        self._waiting = []  # type: list
+        self._tickets = count()
+        self._successes = 0
+        self._latency = None  # type: Optional[float]
+        self._decreased_at = 0.
+
+    def acquire(self, priority=NORMAL):
+        # type: (int) -> float
+        """
+        Waits until a request of the given priority may be sent. Every
+        call must be followed by one to :meth:`release`.
+
+        :param int priority: one of :data:`INTERACTIVE`, :data:`NORMAL`
+            and :data:`BULK`
+        :return: the time the request was let through, to be passed on
+            to :meth:`release`
+        """
+        start = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            # A new head of the queue may be able to go at once.
+            self._cond.notify_all()
+            try:
+                delay = self._delay(ticket)
+                while delay:
+                    self._cond.wait(None if delay < 0 else delay)
+                    delay = self._delay(ticket)
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._in_flight += 1
+            if self.rate is not None:
+                self._tokens -= 1
+            now = time.monotonic()
+            self.counters['requests'] += 1
+            self.counters[PRIORITIES.get(priority, 'normal')] += 1
+            if now - start > 0.001:
+                self.counters['waits'] += 1
+                self.counters['wait_ms'] += int(1000 * (now - start))
+            # The next in line may be able to go as well.
+            self._cond.notify_all()
+        return now
+
+    def release(self, started, status=None, retry_after=None,
+                timed_out=False):
+        # type: (float, int, Optional[float], bool) -> None
+        """
+        Records the outcome of a request let through by :meth:`acquire`.
+
+        :param float started: the time returned by :meth:`acquire`
+        :param int status: the HTTP status of the response; None if none
+            was received
+        :param float retry_after: the seconds the server asked to wait
+        :param bool timed_out: whether the request timed out
+        """
+        now = time.monotonic()
+        latency = now - started
+        with self._cond:
+            # Only grow the limit while it is being used up.
+            saturated = self._in_flight >= self.concurrency
+            self._in_flight -= 1
+            if retry_after:
+                self.counters['pauses'] += 1
+                self._paused_until = max(self._paused_until,
+                                         now + retry_after)
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency = 0.8 * self._latency + 0.2 * latency
+
+            throttled = status in self.THROTTLE_STATUSES
+            if throttled:
+                self.counters['throttled'] += 1
+            if timed_out:
+                self.counters['timeouts'] += 1
+            if status is None and not timed_out:
+                self.counters['errors'] += 1
+            if throttled or timed_out or self._latency > self.latency_target:
+                self._decrease(now)
+            elif status is not None and status < 500 and saturated:
+                self._successes += 1
+                if (self._successes >= self.concurrency
+                        and self.concurrency < self.max_concurrency):
+                    self._successes = 0
+                    self.concurrency += 1
+                    self.counters['increases'] += 1
+            self._cond.notify_all()
+
+    def stats(self):
+        # type: () -> dict
+        """
+        Returns the scheduler's counters -- how many requests were sent,
+        at which priority, how many had to wait and for how long in total
+        (`wait_ms`), how many the server throttled -- along with its
+        current state, e.g. for monitoring a long-running worker.
+        """
+        with self._cond:
+            stats = dict(self.counters)
+            stats.update(concurrency=self.concurrency,
+                         in_flight=self._in_flight,
+                         waiting=len(self._waiting),
+                         latency=(None if self._latency is None
+                                  else round(self._latency, 3)),
+                         paused=round(max(0., self._paused_until
+                                          - time.monotonic()), 3))
+        return stats
+
+    def _delay(self, ticket):
+        # type: (tuple) -> float
+        """
+        How long `ticket` has to wait: 0 if it may go now, -1 if until
+        another request finishes or goes, and otherwise the seconds until
+        the server's `Retry-After` has passed or a token is available.
+        """
+        if self._waiting[0] != ticket or self._in_flight >= self.concurrency:
+            return -1
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.rate is None:
+            return 0
+        self._tokens = min(float(self.burst), self._tokens
+                           + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def _decrease(self, now):
+        # type: (float) -> None
+        # The requests already in flight were sent before the server
+        # pushed back; only react to them once per round trip.
+        if now - self._decreased_at < (self._latency or 0):
+            return
+        self._decreased_at = now
+        self._successes = 0
+        if self.concurrency > self.min_concurrency:
+            self.concurrency = max(self.min_concurrency,
+                                   self.concurrency // 2)
+            self.counters['decreases'] += 1
+
+
+def parse_retry_after(value):
+    # type: (Optional[str]) -> Optional[float]
+    """
+    Converts a `Retry-After` header, either a number of seconds or an
+    HTTP date, to seconds from now; None if it is missing or malformed.
+    """
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0., (when - datetime.datetime.now(datetime.timezone.utc))
+               .total_seconds())
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    # type: () -> RequestScheduler
+    """
+    Returns the scheduler shared by every :class:`PSClient` that was not
+    given one of its own, creating it on first use.
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RequestScheduler()
+    return _scheduler
+
+
+def configure_scheduler(**kwargs):
+    # type: (**...) -> RequestScheduler
+    """
+    Replaces the process-wide :class:`RequestScheduler`.
+
+    :param kwargs: passed on to :class:`RequestScheduler`, e.g. `rate`
+        or `max_concurrency`
+    :return: the new scheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = RequestScheduler(**kwargs)
+    return _scheduler
+
+
+def _body_bytes(r):
+    # type: (requests.Response) -> int
+    """
+    The size of a response's body on the wire, i.e. still compressed:
+    its Content-Length or, without one, what urllib3 counted reading it.
+    urllib3 does not count chunked bodies, which are counted decoded
+    instead, overstating compressed ones.
+    """
+    length = r.headers.get('Content-Length')
+    if length:
+        return int(length)
+    read = getattr(r.raw, 'tell', None)
+    return (read() if read is not None else 0) or len(r.content)
+
+
+class PSClient(object):
+    """
+    A pooled, keep-alive HTTP session for talking to PowerSchool. The
+    underlying connections are reused between requests, responses are
+    requested gzipped, and every request is given a timeout.
+
+    Requests that fail with a connection error, a timeout or one of
+    :attr:`RETRY_STATUSES` are retried up to `max_retries` times with
+    jittered exponential backoff, provided they are idempotent. A
+    client can be pointed at a different server (e.g. a local stand-in
+    during tests) with `base_url`.
+
+    Every attempt is first let through by a :class:`RequestScheduler`,
+    which keeps the process within the server's rate limits.
+
+    :cvar RETRY_STATUSES: the HTTP statuses considered transient
+    :cvar IDEMPOTENT_METHODS: the methods retried by default
+    """
+
+    RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS',
+                                    'PUT', 'DELETE'])
+
+    def __init__(self,
+                 base_url=None,       # type: str
+                 timeout=(5, 60),     # type: tuple
+                 max_retries=3,       # type: int
+                 backoff=0.5,         # type: float
+                 max_backoff=30,      # type: float
+                 pool_size=10,        # type: int
+                 token_manager=None,  # type: TokenManager
+                 session=None,        # type: requests.Session
+                 scheduler=None       # type: RequestScheduler
+                 ):
+        # type: (...) -> None
+        """
+        :param str base_url: the server to send requests to; by default
+            :attr:`PowerQuery.PS_URL`
+        :param timeout: seconds to wait for a connection and for a
+            response, as accepted by :mod:`requests`
+        :param int max_retries: how many times a failed request is retried
+        :param float backoff: the base, in seconds, of the backoff between
+            retries
+        :param float max_backoff: the longest to wait between retries
+        :param int pool_size: how many connections are kept alive
+        :param TokenManager token_manager: the source of access tokens for
+            this server; a fresh in-memory one if not given
+        :param requests.Session session: a preconfigured session to use
+        :param RequestScheduler scheduler: paces this client's requests;
+            by default the one returned by :func:`get_scheduler`
+        """
+        self._base_url = base_url
+        self._scheduler = scheduler
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if token_manager is None:
+            token_manager = TokenManager(client=self)
+        self.token_manager = token_manager
+
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                'Connection': 'keep-alive'})
+        self.session = session
+
+    @property
+    def base_url(self):
+        # type: () -> str
+        if self._base_url is not None:
+            return self._base_url
+        return PowerQuery.PS_URL
+
+    @property
+    def scheduler(self):
+        # type: () -> RequestScheduler
+        if self._scheduler is not None:
+            return self._scheduler
+        return get_scheduler()
+
+    def url_for(self, path):
+        # type: (str) -> str
+        """Joins `path` onto the client's base URL."""
+        return urljoin(self.base_url, path)
+
+    def request(self, method, url, idempotent=None, priority=None,
+                **kwargs):
+        # type: (str, str, bool, int, ...) -> requests.Response
+        """
+        Sends a request through the pooled session, retrying transient
+        failures. Relative URLs are resolved against :attr:`base_url`.
+
+        :param str method: the HTTP method
+        :param str url: an absolute URL or a path on the server
+        :param bool idempotent: whether the request may be retried; by
+            default, whether `method` is in :attr:`IDEMPOTENT_METHODS`
+        :param int priority: the request's :class:`RequestScheduler`
+            priority; :data:`NORMAL` if None
+        :raises PSNoConnectionError: when the server cannot be reached
+        :return: the last response received
+        """
+        logger = logging.getLogger(__name__)
+        if idempotent is None:
+            idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.timeout)
+        url = self.url_for(url)
+        retries = self.max_retries if idempotent else 0
+        scheduler = self.scheduler
+        if priority is None:
+            priority = NORMAL
+
+        for attempt in range(retries + 1):
+            trace = profiling.current()
+            if attempt:
+                trace.add('http_retries')
+            queued = time.monotonic()
+            started = scheduler.acquire(priority)
+            waited = int(1000 * (started - queued))
+            if waited:
+                trace.add('http_wait_ms', waited)
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                scheduler.release(started, timed_out=isinstance(
+                    e, requests.exceptions.Timeout))
+                if attempt == retries:
+                    raise PSNoConnectionError()
+                logger.debug('Request to {} failed ({}); retrying.'
+                             .format(url, e))
+                self._sleep(attempt)
+                continue
+            except BaseException:
+                scheduler.release(started)
+                raise
+
+            retry_after = None
+            if r.status_code in self.RETRY_STATUSES:
+                retry_after = parse_retry_after(r.headers.get('Retry-After'))
+            scheduler.release(started, r.status_code, retry_after)
+            if trace is not profiling.NULL_SPAN:
+                trace.add('http_requests')
+                if r.status_code in scheduler.THROTTLE_STATUSES:
+                    trace.add('http_throttled')
+                trace.add('http_bytes', _body_bytes(r))
+            if r.status_code not in self.RETRY_STATUSES or attempt == retries:
+                return r
+            logger.debug('Request to {} returned {}; retrying.'
+                         .format(url, r.status_code))
+            self._sleep(attempt, retry_after)
+
+    def post(self, url, **kwargs):
+        # type: (str, ...) -> requests.Response
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        # type: () -> None
+        self.session.close()
+
+    def _sleep(self, attempt, retry_after=None):
+        # type: (int, float) -> None
+        """Waits before the next attempt using "full jitter" backoff."""
+        delay = random.uniform(0, min(self.max_backoff,
+                                      self.backoff * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(self.max_backoff, retry_after))
+        time.sleep(delay)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client():
+    # type: () -> PSClient
+    """
+    Returns the client shared by every :class:`PowerQuery` that was not
+    given one of its own, creating it on first use.
+    """
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = PSClient(token_manager=token_manager)
+    return _default_client
+
+
+def set_default_client(client):
+    # type: (PSClient) -> None
+    """
+    Replaces the shared client, e.g. with one pointed at a local server
+    during tests. Passing None restores the stock client on next use.
+    """
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
+
+
+class TokenManager(object):
+    """
+    Caches a PowerSchool access token for as long as the server says it
+    is valid. The token is only requested again once it comes within
+    `leeway` seconds of its expiry, and only one thread performs the
+    refresh when several share the manager.
+
+    If `cache_path` is given, the token is also written to that file
+    (readable by the owner only) so that the next run of a script can
+    skip the handshake entirely.
+
+    :ivar float leeway: how many seconds before expiry a token is
+        considered stale
+    """
+
+    def __init__(self, cache_path=None, leeway=60, client=None):
+        # type: (str, float, PSClient)
+        self.cache_path = cache_path
+        self.leeway = leeway
+        self._client = client
+        self._token = None
+        self._expires_at = 0.
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # type: () -> PSClient
+        if self._client is not None:
+            return self._client
+        return get_default_client()
+
+    def get_token(self, force=False):
+        # type: (bool) -> str
+        """
+        Returns a valid access token, requesting a new one from the
+        server only if the cached one is missing or about to expire.
+
+        :param bool force: request a new token regardless of the cache
+        :return: an access token for the PowerSchool server
+        """
+        if not force and self._is_fresh():
+            return self._token
+
+        with self._lock:
+            # Another thread may have refreshed while we were waiting.
+            if not force and self._is_fresh():
+                return self._token
+            if not force and self._load():
+                return self._token
+
+            creds = get_ps_credentials()
+            with span('token fetch'):
+                token, expires_in = request_ps_token(creds, self.client)
+            self._token = token
+            self._expires_at = time.time() + expires_in
+            self._save(creds)
+            return self._token
+
+    def invalidate(self):
+        # type: () -> None
+        """Forgets the cached token, both in memory and on disk."""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.
+            if self.cache_path is not None and os.path.isfile(self.cache_path):
+                os.remove(self.cache_path)
+
+    def _is_fresh(self):
+        # type: () -> bool
+        return (self._token is not None
+                and time.time() < self._expires_at - self.leeway)
+
+    def _load(self):
+        # type: () -> bool
+        """Reads a previously saved token, returning whether it is usable."""
+        if self.cache_path is None or not os.path.isfile(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, 'r') as f:
+                cached = json.load(f)
+            creds = get_ps_credentials()
+            if (cached['url'] != self.client.base_url
+                    or cached['client_id'] != creds['PS_CLIENT_ID']):
+                return False
+            self._token = cached['access_token']
+            self._expires_at = float(cached['expires_at'])
+        except (ValueError, KeyError, IOError, OSError):
+            return False
+        return self._is_fresh()
+
+    def _save(self, creds):
+        # type: (dict) -> None
+        if self.cache_path is None:
+            return
+        cached = {
+            'url': self.client.base_url,
+            'client_id': creds['PS_CLIENT_ID'],
+            'access_token': self._token,
+            'expires_at': self._expires_at
+        }
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.cache_path)
+        except (IOError, OSError) as e:
+            # Persisting is only an optimization; never fail a query on it.
+            logging.getLogger(__name__).debug(
+                'Could not save PowerSchool token: {}'.format(e))
+
+
 def get_ps_token():
     # type: () -> str
     """
-    Gets the PowerSchool access token from the PowerSchool server using
-    the following environment variables:
+    Returns a PowerSchool access token from the default client's
+    :class:`TokenManager`, which only contacts the server when the
+    cached token is missing or about to expire.
+
+    :return: an access token for the PowerSchool server
+    """
+    return get_default_client().token_manager.get_token()
+
+
+def get_ps_credentials():
+    # type: () -> dict
+    """
+    Reads the `powerschool-credentials.json` file that sits next to this
+    module, or the file named by the `PS_CREDENTIALS` environment
+    variable if it is set. It must define the following keys:
 
         - PS_CLIENT_ID: the given client ID for the PowerSchool plugin
         - PS_CLIENT_SECRET: the secret code
 
-    :return: an access token for the PowerSchool server
+    :return: the parsed credentials
     """
-    header = {
-        'Content-Type': "application/x-www-form-urlencoded;charset=UTF-8'"
-    }
-    cred_path = os.path.join(get_script_path(), 'powerschool-credentials.json')
+    cred_path = os.environ.get('PS_CREDENTIALS') or os.path.join(
+        get_script_path(), 'powerschool-credentials.json')
     if not os.path.isfile(cred_path):
         raise EnvironmentError('PowerSchool credentials are not in the '
                                'environment.')
-    creds = json.load(open(cred_path, 'r'))
-    url = urljoin(PowerQuery.PS_URL, '/oauth/access_token')
+    with open(cred_path, 'r') as f:
+        return json.load(f)
+
+
+# How long a token is assumed to be valid when the server does not say.
+DEFAULT_TOKEN_TTL = 3600
+
+
+def request_ps_token(creds, client=None):
+    # type: (dict, PSClient) -> tuple
+    """
+    Performs the OAuth handshake with the PowerSchool server.
+
+    :param dict creds: the credentials returned by
+        :func:`get_ps_credentials`
+    :param PSClient client: the client to send the request with
+    :return: the access token and the number of seconds it is valid for,
+        :data:`DEFAULT_TOKEN_TTL` if the server does not say
+    """
+    if client is None:
+        client = get_default_client()
+    header = {
+        'Content-Type': "application/x-www-form-urlencoded;charset=UTF-8'"
+    }
 
     payload = {
         'grant_type': 'client_credentials',
@@ -131,13 +1459,24 @@ def get_ps_token():
         'client_secret': creds['PS_CLIENT_SECRET']
     }
 
-    r = requests.post(url, headers=header, data=payload)
+    # Every query is waiting on the token.
+    r = client.request('POST', '/oauth/access_token', idempotent=True,
+                       priority=INTERACTIVE,
+                       headers=header, data=payload)
     try:
         r.raise_for_status()
     except requests.exceptions.HTTPError:
         raise PSNoConnectionError()
 
-    return r.json()['access_token']
+    body = r.json()
+    # PowerSchool sends `expires_in` as a string of seconds.
+    expires_in = body.get('expires_in')
+    if expires_in in (None, ''):
+        logging.getLogger(__name__).debug(
+            'The token came without an expiry; assuming {} seconds.'
+            .format(DEFAULT_TOKEN_TTL))
+        return body['access_token'], float(DEFAULT_TOKEN_TTL)
+    return body['access_token'], float(expires_in)
 
 
 def get_header(token, custom_args=None):
@@ -159,6 +1498,11 @@ def get_script_path():
         return os.path.dirname(os.path.realpath(sys.argv[0]))
 
 
+token_manager = TokenManager(
+    cache_path=os.path.join(get_script_path(), '.powerschool-token.json')
+)
+
+
 def flatten_ps_json(json_obj):
     # type: (dict) -> dict
     """Takes the 3D dict returned by PowerSchool and flattens it into 1D."""
@@ -184,6 +1528,27 @@ class PSEmptyQueryException(PSException):
         return 'Query to URL "{}" returned no results.'.format(self.url)
 
 
+class PSQueryError(PSException):
+
+    def __init__(self, url, status_code):
+        self.url = url
+        self.status_code = status_code
+
+    def __str__(self):
+        return 'Query to URL "{}" failed with status {}.'.format(
+            self.url, self.status_code)
+
+
+class PSCacheMissError(PSException):
+
+    def __init__(self, url_ext):
+        self.url_ext = url_ext
+
+    def __str__(self):
+        return 'No cached results for query "{}" are available offline.' \
+            .format(self.url_ext)
+
+
 class PSNoConnectionError(PSException):
 
     def __str__(self):
@@ -0,0 +1,51 @@
+"""
+Fixtures shared by the tests. Importing :mod:`benchmarks` puts the
+scripts' directories on the path, so that their modules can be imported
+as the scripts import them.
+"""
+
+import pytest
+
+import benchmarks  # noqa: F401
+import ps_agent
+from benchmarks.fake_powerschool import FakePowerSchool
+from benchmarks.synthetic import Synthetic
+
+
+@pytest.fixture(autouse=True)
+def isolated_ps_agent(monkeypatch, tmp_path):
+    """
+    Gives every test its own client and scheduler and no query cache, so
+    that nothing reaches the real server or the cache next to the module.
+    A cache the scripts configure is kept in the test's directory.
+    """
+    monkeypatch.setattr(ps_agent, 'get_script_path', lambda: str(tmp_path))
+    monkeypatch.setattr(ps_agent, '_default_client', None)
+    monkeypatch.setattr(ps_agent, '_scheduler', None)
+    monkeypatch.setattr(ps_agent, '_query_cache', None)
+    monkeypatch.delenv('PS_URL', raising=False)
+    monkeypatch.delenv('PS_CREDENTIALS', raising=False)
+
+
+@pytest.fixture(scope='session')
+def synthetic():
+    return Synthetic(2000, seed=0)
+
+
+@pytest.fixture
+def fake_server(monkeypatch, synthetic):
+    """
+    A :class:`FakePowerSchool` that :mod:`ps_agent` is pointed at, through
+    a default client that keeps its token in memory and barely backs off.
+    Tests may change the server's latency and errors while it runs.
+    """
+    tables = {'students': synthetic.student_records(),
+              'sections': synthetic.section_records(500)}
+    with FakePowerSchool(tables) as server:
+        for name, value in server.environ().items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.setattr(ps_agent.PowerQuery, 'PS_URL', server.url)
+        client = ps_agent.PSClient(backoff=0.01)
+        ps_agent.set_default_client(client)
+        yield server
+        client.close()
@@ -0,0 +1,179 @@
+import argparse
+
+import pandas as pd
+import pytest
+
+import make_classchoice
+from compact import compact
+from make_classchoice import (EXPANSION_RULES, OUT_COLS, SECTION_KEY,
+                              ExpansionRule, build_df, expand_sections,
+                              finish_sections, partition)
+
+
+@pytest.fixture
+def sections():
+    periods = [1, 4, 5, 7, 2]
+    return pd.DataFrame({
+        'course_number': ['C1', 'C2', 'C3', 'C4', 'C1'],
+        'course_name': ['Algebra', 'Biology', 'Chemistry', 'Drama',
+                        'Algebra'],
+        'section_number': [1, 2, 3, 10099, 5],
+        'expression': ['{}(A)'.format(p) for p in periods],
+        'period': pd.array(periods, dtype='uint16'),
+        'semester': ['A'] * 5,
+        'max_enrollment': pd.array([30] * 5, dtype='uint16'),
+        'termid': pd.array([3000] * 5, dtype='uint16'),
+        'school_id': pd.array([616] * 5, dtype='uint16'),
+        'room': ['101', '102', '103', '104', '105'],
+        'teacher_id': pd.array([201, 202, 203, 204, 201], dtype='uint16'),
+        'teacher_name': ['Ames, Al', 'Bo, Bea', 'Cruz, Cy', 'Dee, Di',
+                         'Ames, Al']
+    })
+
+
+def copies(expanded, n_original):
+    return expanded.iloc[n_original:].reset_index(drop=True)
+
+
+def test_sections_in_periods_1_to_4_are_copied_to_period_7(sections):
+    expanded, n_added = expand_sections(sections)
+    assert n_added == 3
+    new = copies(expanded, len(sections))
+    assert list(new['course_number']) == ['C1', 'C2', 'C1']
+    assert list(new['expression']) == ['7(A)'] * 3
+    assert list(new['period']) == [7] * 3
+    assert list(new['section_number']) == [10099] * 3
+    pd.testing.assert_frame_equal(expanded.iloc[:len(sections)], sections)
+    assert (expanded.dtypes == sections.dtypes).all()
+
+
+def test_copies_identical_to_a_section_are_dropped(sections):
+    # Drama already runs in period 7 as section 10099.
+    drama = sections.iloc[[3]].assign(course_number='C1',
+                                      course_name='Algebra', room='101',
+                                      teacher_id=201, teacher_name='Ames, Al')
+    sections = pd.concat([sections, drama], ignore_index=True)
+    expanded, n_added = expand_sections(sections)
+    assert n_added == 2
+    assert len(expanded) == len(sections) + 2
+    assert not expanded[OUT_COLS].duplicated().any()
+
+
+def test_several_rules_apply_to_the_original_sections(sections):
+    rules = [ExpansionRule.parse('1-2:7:10099'),
+             ExpansionRule.parse('5:8:20000')]
+    expanded, n_added = expand_sections(sections, rules)
+    new = copies(expanded, len(sections))
+    assert n_added == 3
+    assert list(zip(new['expression'], new['section_number'])) == [
+        ('7(A)', 10099), ('7(A)', 10099), ('8(A)', 20000)]
+
+
+def test_categorical_expressions_stay_categorical(sections):
+    plain, _ = expand_sections(sections)
+    sections['expression'] = sections['expression'].astype('category')
+    expanded, _ = expand_sections(sections)
+    assert isinstance(expanded['expression'].dtype, pd.CategoricalDtype)
+    assert list(expanded['expression']) == list(plain['expression'])
+
+
+def test_no_rules_adds_nothing(sections):
+    expanded, n_added = expand_sections(sections, [])
+    assert n_added == 0
+    pd.testing.assert_frame_equal(expanded, sections)
+
+
+def test_expansion_rules_parse():
+    assert ExpansionRule.parse('1-4:7:10099') == EXPANSION_RULES[0]
+    assert ExpansionRule.parse('3:6:1').periods == (3,)
+    assert str(EXPANSION_RULES[0]) == 'periods 1-4 -> period 7, section 10099'
+    with pytest.raises(argparse.ArgumentTypeError):
+        ExpansionRule.parse('1-4:7')
+
+
+def test_finish_sections_sets_class_size_and_sorts(sections):
+    finished = finish_sections(sections, class_size=25)
+    assert list(finished.columns) == OUT_COLS
+    assert len(finished) == len(sections) + 3
+    assert (finished['max_enrollment'] == 25).all()
+    assert finished['course_number'].is_monotonic_increasing
+
+
+def test_partition_splits_by_school_and_term(sections):
+    sections.loc[[1, 2], 'termid'] = 3001
+    sections.loc[[4], 'school_id'] = 615
+    parts = partition(sections)
+    assert sorted(parts) == [(615, 3000), (616, 3000), (616, 3001)]
+    assert [len(parts[key]) for key in sorted(parts)] == [1, 2, 2]
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_batch_mode_writes_a_file_per_school_and_term(tmp_path, fake_server,
+                                                      jobs):
+    make_classchoice.main(['--batch', '-o', str(tmp_path / 'out'),
+                           '-t', '3000,3001', '--school-ids', '615,616',
+                           '-j', str(jobs), '-q'], interactive=False)
+    parts = partition(build_df(current_terms=[3000, 3001],
+                               school_ids=[615, 616]))
+    assert len(parts) == 4
+    assert sorted(path.name for path in (tmp_path / 'out').iterdir()) == [
+        'class-choice-{}-{}.csv'.format(*key) for key in sorted(parts)]
+    for key, part in parts.items():
+        written = pd.read_csv(tmp_path / 'out' /
+                              'class-choice-{}-{}.csv'.format(*key))
+        expected = finish_sections(part)
+        assert list(written.columns) == list(expected.columns)
+        assert len(written) == len(expected)
+        assert (written['termid'] == key[1]).all()
+
+
+def test_matches_copying_row_by_row(fake_server):
+    sections = build_df(current_terms=[3000, 3001],
+                        school_ids=[615, 616, 617])
+    assert 0 < len(sections) < len(fake_server.tables['sections'])
+    expanded, n_added = expand_sections(sections)
+
+    to_copy = sections[sections['period'].isin(range(1, 5))].copy()
+    to_copy['period'] = 7
+    to_copy['expression'] = '7' + to_copy['expression'].astype(str).str[1:]
+    to_copy['section_number'] = 10099
+    # The copies' expressions are new categories, kept by expand_sections.
+    dtypes = dict(sections.dtypes, expression=str)
+    expected = (pd.concat([sections.astype(dtypes), to_copy.astype(dtypes)])
+                .drop_duplicates(subset=SECTION_KEY)
+                .reset_index(drop=True))
+    assert n_added == len(expected) - len(sections)
+    pd.testing.assert_frame_equal(expanded.astype(dtypes), expected)
+
+
+@pytest.mark.parametrize('rules', [None, []])
+def test_compacted_sections_are_sorted_by_value(rules):
+    # Enough rows for compact() to make categoricals, first seen out of
+    # alphabetical order.
+    expressions = ['5(B)', '2(A)', '7(A)', '1(B)']
+    n = 10 * len(expressions)
+    sections = pd.DataFrame({
+        'course_number': ['C2', 'C1'] * (n // 2),
+        'course_name': ['Biology', 'Algebra'] * (n // 2),
+        'section_number': [str(i) for i in range(1, n + 1)],
+        'expression': expressions * (n // len(expressions)),
+        'period': pd.array([int(e[0]) for e in expressions]
+                           * (n // len(expressions)), dtype='uint16'),
+        'semester': [e[2] for e in expressions] * (n // len(expressions)),
+        'max_enrollment': pd.array([30] * n, dtype='uint16'),
+        'termid': pd.array([3000] * n, dtype='uint16'),
+        'school_id': pd.array([616] * n, dtype='uint16'),
+        'room': ['101'] * n,
+        'teacher_id': pd.array(range(200 + n, 200, -1), dtype='uint16'),
+        'teacher_name': ['Ames, Al'] * n
+    })
+    compact(sections)
+    assert isinstance(sections['expression'].dtype, pd.CategoricalDtype)
+
+    finished = finish_sections(sections, rules=rules)
+    expression = finished['expression']
+    assert isinstance(expression.dtype, pd.CategoricalDtype)
+    assert list(expression.cat.categories) == sorted(expression.cat.categories)
+    keys = list(zip(finished['course_number'].astype(str),
+                    expression.astype(str), finished['teacher_id']))
+    assert keys == sorted(keys)
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from compact import compact, nullable_dtype
+
+
+def test_repetitive_strings_become_sorted_categoricals():
+    df = pd.DataFrame({'course': ['Biology', 'Algebra', 'Biology',
+                                  'Algebra'] * 5,
+                       'name': ['student {}'.format(i) for i in range(20)]})
+    changes = compact(df)
+    assert list(changes) == ['course']
+    assert changes['course'].saved > 0
+    assert list(df['course'].cat.categories) == ['Algebra', 'Biology']
+    assert df['course'].cat.ordered is False
+    assert (df.sort_values('course')['course'].astype(str).tolist()
+            == ['Algebra'] * 10 + ['Biology'] * 10)
+    assert df['name'].dtype != 'category'
+
+
+def test_integers_keep_their_signedness_and_nullability():
+    df = pd.DataFrame({'small': np.array([0, 200], dtype='uint64'),
+                       'negative': [-1, 1000],
+                       'nullable': pd.array([1, None], dtype='Int64'),
+                       'wide': [0, 2 ** 40]})
+    changes = compact(df)
+    assert df['small'].dtype == 'uint8'
+    assert df['negative'].dtype == 'int16'
+    assert df['nullable'].dtype == 'Int8'
+    assert df['nullable'].isnull().tolist() == [False, True]
+    assert 'wide' not in changes
+    assert compact(df, integers=False) == {}
+
+
+def test_floats_are_narrowed_only_without_loss():
+    df = pd.DataFrame({'exact': [0.5, np.nan], 'inexact': [0.1, 0.2]})
+    assert compact(df) == {}
+    changes = compact(df, floats=True)
+    assert list(changes) == ['exact']
+    assert df['exact'].dtype == 'float32'
+    assert df['inexact'].dtype == 'float64'
+
+
+def test_numbers_stored_as_objects_become_numeric():
+    df = pd.DataFrame({'grade': pd.Series([90, 85.5, 90], dtype=object),
+                       'mixed': pd.Series([1, 'a', 1], dtype=object)})
+    changes = compact(df, exclude=['mixed'])
+    assert changes['grade'].after == 'float64'
+    assert df['mixed'].dtype == object
+
+
+def test_unknown_string_storage_is_refused():
+    with pytest.raises(ValueError):
+        compact(pd.DataFrame({'a': ['x']}), strings='python')
+    # Without pyarrow, or with it, the strings are kept as text.
+    df = pd.DataFrame({'a': ['x', 'y', 'z', 'w']})
+    compact(df, strings='pyarrow')
+    assert df['a'].tolist() == ['x', 'y', 'z', 'w']
+
+
+def test_nullable_dtypes():
+    assert nullable_dtype('uint16') == 'UInt16'
+    assert nullable_dtype(np.dtype('int8')) == 'Int8'
+    assert nullable_dtype('float32') == 'float32'
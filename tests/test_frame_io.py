@@ -0,0 +1,79 @@
+import gzip
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import frame_io
+
+
+@pytest.fixture
+def frame():
+    n = 250
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'student_number': pd.array(rng.integers(100000, 200000, n),
+                                   dtype='UInt64'),
+        'course': pd.Categorical(rng.choice(['Algebra', 'Biology'], n)),
+        'grade': np.round(rng.uniform(0, 100, n), 2),
+        'name': rng.choice(['Lee, Kim', 'Núñez, Ana', '"Q", Q'], n)
+    }, index=np.arange(n) * 2)
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'csv.gz'])
+def test_text_round_trip(tmp_path, frame, fmt):
+    path = str(tmp_path / ('out.' + fmt))
+    frame_io.write_frame(frame, path, chunksize=100)
+    back = frame_io.read_frame(path)
+    expected = frame.reset_index(drop=True).astype({
+        'student_number': 'int64', 'course': object})
+    pd.testing.assert_frame_equal(back.astype({'course': object}), expected,
+                                  check_dtype=False)
+    if fmt == 'csv.gz':
+        with gzip.open(path, 'rt') as f:
+            assert f.readline().strip() == ','.join(frame.columns)
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+def test_arrow_round_trip_keeps_dtypes(tmp_path, frame, fmt):
+    pytest.importorskip('pyarrow')
+    path = str(tmp_path / ('out.' + fmt))
+    frame_io.write_frame(frame, path, chunksize=100)
+    pd.testing.assert_frame_equal(frame_io.read_frame(path),
+                                  frame.reset_index(drop=True))
+
+
+def test_empty_frame_round_trip(tmp_path, frame):
+    path = str(tmp_path / 'out.csv')
+    frame_io.write_frame(frame.iloc[:0], path)
+    assert list(frame_io.read_frame(path).columns) == list(frame.columns)
+
+
+def test_write_frame_sorts_only_when_asked(tmp_path, frame):
+    path = str(tmp_path / 'out.csv')
+    frame_io.write_frame(frame, path, sort_by=['course', 'grade'])
+    back = frame_io.read_frame(path)
+    assert frame_io.is_sorted(back, ['course', 'grade'])
+    assert not frame_io.is_sorted(frame, ['course', 'grade'])
+    assert list(tmp_path.iterdir()) == [tmp_path / 'out.csv']
+
+
+def test_formats_are_judged_by_extension():
+    assert frame_io.format_of('report.CSV.GZ') == 'csv.gz'
+    assert frame_io.format_of('report.parquet') == 'parquet'
+    assert frame_io.format_of('report.txt') == 'csv'
+    assert frame_io.with_format('out/r.csv.gz', 'feather') == 'out/r.feather'
+    assert frame_io.with_format('report.txt', 'csv') == 'report.csv'
+
+
+def test_check_format():
+    frame_io.check_format('csv.gz')
+    with pytest.raises(ValueError):
+        frame_io.check_format('xlsx')
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        with pytest.raises(ImportError, match='pyarrow'):
+            frame_io.check_format('parquet')
+    else:
+        frame_io.check_format('parquet')
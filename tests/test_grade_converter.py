@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from merge_files import GradeConverter
+
+
+@pytest.fixture
+def percentages():
+    # Every cutoff, either side of it, and a sweep across the scale.
+    lows = [low for low, _ in GradeConverter.cutoffs]
+    edges = [x + d for x in lows for d in (-.01, 0, .01)]
+    return np.concatenate([edges, np.linspace(-5, 105, 1101)])
+
+
+def test_convert_agrees_with_calling_the_converter(percentages):
+    converter = GradeConverter()
+    letters = converter.convert(pd.Series(percentages))
+    assert list(letters) == [converter(p) for p in percentages]
+    assert letters.cat.ordered
+    assert list(letters.cat.categories) == GradeConverter.grade_cats
+
+
+def test_custom_cutoffs_agree_too(percentages):
+    converter = GradeConverter(cutoffs=[(60, 'D'), (90, 'A'), (80, 'B'),
+                                        (70, 'C')])
+    assert list(converter.convert(percentages)) == [converter(p) for p
+                                                    in percentages]
+    assert converter(90) == 'A' and converter(89.99) == 'B'
+
+
+def test_invalid_percentages_have_no_letter():
+    converter = GradeConverter()
+    grades = pd.Series(['95', 'n/a', None, np.inf, -np.inf, np.nan, -3],
+                       index=list('abcdefg'))
+    letters = converter.convert(grades)
+    assert list(letters.index) == list('abcdefg')
+    assert letters.isnull().tolist() == [False] + [True] * 5 + [False]
+    assert list(letters[['a', 'g']]) == ['A', 'F']
+
+
+def test_schools_can_have_their_own_cutoffs():
+    converter = GradeConverter(school_cutoffs={616: [(50, 'C'), (80, 'A')]})
+    letters = converter.convert(pd.Series([85., 85., 55., 55.]),
+                                schools=pd.Series([615, 616, 615, 616]))
+    assert list(letters) == ['B', 'A', 'F', 'C']
+    # Without the schools, the default cutoffs apply to every row.
+    assert list(converter.convert([85., 55.])) == ['B', 'F']
+
+
+def test_unknown_letters_are_rejected():
+    with pytest.raises(ValueError):
+        GradeConverter(cutoffs=[(90, 'E')])
+    with pytest.raises(ValueError):
+        GradeConverter(school_cutoffs={616: [(90, 'A*')]})
@@ -0,0 +1,90 @@
+import sqlite3
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import grade_history
+from grade_history import GradeHistory
+
+
+def report(*rows):
+    return pd.DataFrame(
+        [(number, last, 'Sam', course, 'apex', grade, letter)
+         for number, last, course, grade, letter in rows],
+        columns=grade_history.COLUMNS)
+
+
+@pytest.fixture
+def history(tmp_path):
+    with GradeHistory(str(tmp_path / 'history.sqlite')) as history:
+        history.append(report((101., 'Lee', 'Algebra', 55., 'F'),
+                              (102., 'Kim', 'Algebra', 91., 'A-')),
+                       run_date=date(2020, 3, 2))
+        # A rerun the same day replaces the first run.
+        history.append(report((101., 'Lee', 'Algebra', 65., 'D'),
+                              (102., 'Kim', 'Algebra', 91., 'A-')),
+                       run_date=date(2020, 3, 2))
+        history.append(report((101., 'Lee', 'Algebra', 45., 'F'),
+                              (101., 'Lee', 'Biology', 85., 'B'),
+                              (None, 'Park', 'Biology', 35., 'F')),
+                       run_date=date(2020, 3, 9))
+        yield history
+
+
+def test_trajectory_uses_the_last_run_of_each_day(history):
+    trajectory = history.trajectory(101)
+    assert list(trajectory['run_date']) == [
+        '2020-03-02', '2020-03-09', '2020-03-09']
+    assert list(trajectory['course']) == ['Algebra', 'Algebra', 'Biology']
+    assert list(trajectory['grade']) == [65., 45., 85.]
+    assert list(history.trajectory(101, course='Bio')['grade']) == [85.]
+    assert list(history.trajectory(101, since='2020-03-03')['grade']) == [
+        45., 85.]
+
+
+def test_failing_rows_of_one_day(history):
+    assert history.failing(date(2020, 3, 2)).empty
+    assert history.run_id(date(2020, 3, 5)) == 2
+    failing = history.failing()
+    assert list(failing['student_last']) == ['Lee', 'Park']
+    assert failing['student_number'].dtype == 'Int64'
+    assert list(history.failing(date(2020, 3, 2), letters=['D'])[
+        'student_last']) == ['Lee']
+    assert history.failing(source='idla').empty
+
+
+def test_distribution_per_course(history):
+    distribution = history.distribution(date(2020, 3, 2))
+    assert distribution.loc['Algebra', 'n'] == 2
+    assert distribution.loc['Algebra', 'mean'] == 78.
+    # Letters from the highest average grade down.
+    assert list(distribution.columns) == ['n', 'mean', 'min', 'max',
+                                          'A-', 'D']
+    biology = history.distribution(course='Bio')
+    assert list(biology.index) == ['Biology']
+    assert biology.loc['Biology', 'F'] == 1
+    assert history.distribution(source='idla').empty
+
+
+def test_stored_rows_cannot_be_changed(history):
+    assert list(history.runs()['n_rows']) == [2, 2, 3]
+    for sql in ['UPDATE grades SET grade = 100', 'DELETE FROM runs']:
+        with pytest.raises(sqlite3.IntegrityError):
+            with history.connection:
+                history.connection.execute(sql)
+    # Reopened, the history is unchanged.
+    with GradeHistory(history.path) as reopened:
+        assert list(reopened.trajectory(101)['grade']) == [65., 45., 85.]
+
+
+def test_command_line_imports_and_queries(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    report_path = str(tmp_path / 'grade-reports.csv')
+    report((101, 'Lee', 'Algebra', 55., 'F')).to_csv(report_path,
+                                                    index=False)
+    grade_history.main(['--history', path, 'import', report_path,
+                        '--date', '2020-03-02'])
+    out_path = str(tmp_path / 'failing.csv')
+    grade_history.main(['--history', path, '-o', out_path, 'failing'])
+    assert list(pd.read_csv(out_path)['student_number']) == [101]
@@ -0,0 +1,151 @@
+import json
+import random
+
+import pandas as pd
+import pytest
+
+from matching import (ResolutionTable, StudentResolver, edit_distance,
+                      normalize_names, soundex)
+
+
+@pytest.fixture
+def students():
+    return pd.DataFrame({
+        'last_name': ['Johansson', 'Núñez-Smith', 'Lee', 'Lee', 'Okafor'],
+        'first_name': ['Peter', 'Ana María', 'Kim', 'Kim', 'Chidi'],
+        'student_email': ['pj@example.org', None, 'kim1@example.org',
+                          'kim2@example.org', 'co@example.org']
+    }, index=pd.Index([101, 102, 103, 104, 105], name='student_number'))
+
+
+def names(*rows, **columns):
+    df = pd.DataFrame(list(rows), columns=['student_last', 'student_first'])
+    return df.assign(**columns)
+
+
+def methods(resolved):
+    """The match methods, None where there is none."""
+    return [None if pd.isnull(method) else method
+            for method in resolved['match_method']]
+
+
+def _reference_distance(a, b):
+    d = [[i + j if not i * j else 0 for j in range(len(b) + 1)]
+         for i in range(len(a) + 1)]
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            d[i][j] = min(d[i - 1][j] + 1, d[i][j - 1] + 1,
+                          d[i - 1][j - 1] + (a[i - 1] != b[j - 1]))
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2]
+                    and a[i - 2] == b[j - 1]):
+                d[i][j] = min(d[i][j], d[i - 2][j - 2] + 1)
+    return d[-1][-1]
+
+
+def test_edit_distance():
+    assert edit_distance('hansen', 'hasnen') == 1
+    assert edit_distance('hansen', 'hansen') == 0
+    assert edit_distance('', 'abc') == 3
+    assert edit_distance('kitten', 'sitting') == 3
+    rng = random.Random(0)
+    for _ in range(2000):
+        a = ''.join(rng.choice('abc') for _ in range(rng.randint(0, 7)))
+        b = ''.join(rng.choice('abc') for _ in range(rng.randint(0, 7)))
+        assert edit_distance(a, b) == _reference_distance(a, b), (a, b)
+
+
+def test_normalize_names_and_soundex():
+    assert list(normalize_names(pd.Series(['  Núñez-Smith ', "O'Neil",
+                                           None]))) == ['nunez smith',
+                                                        'oneil', '']
+    assert soundex('robert') == soundex('rupert') == 'r163'
+
+
+def test_exact_matches_ignore_accents_spacing_and_middle_names(students):
+    resolved = StudentResolver(students).resolve(names(
+        ('nunez smith', 'ana'), ('JOHANSSON', 'Peter James'),
+        ('Lee', 'Kim'), ('Nobody', 'At All')))
+    assert list(resolved['student_number']) == [102, 101, pd.NA, pd.NA]
+    assert methods(resolved) == ['exact', 'exact', None, None]
+    assert resolved['suggested_number'].isna().all()
+
+
+def test_email_is_trusted_over_the_name(students):
+    resolved = StudentResolver(students).resolve(names(
+        ('Lee', 'Kim'), ('Lee', 'Kim'), ('Okafor', 'Chidi'),
+        student_email=['KIM2@example.org ', None, 'pj@example.org']))
+    assert list(resolved['student_number']) == [104, pd.NA, 101]
+    assert methods(resolved) == ['email', None, 'email']
+
+
+def test_approximate_matches_are_only_suggested(students):
+    df = names(('Johanssno', 'Peter'), ('Okafor', 'Chidi'), ('Lea', 'Kin'))
+    resolver = StudentResolver(students)
+    resolved = resolver.resolve(df)
+    assert list(resolved['student_number']) == [pd.NA, 105, pd.NA]
+    assert list(resolved['suggested_number']) == [101, pd.NA, pd.NA]
+    assert methods(resolved) == ['fuzzy', 'exact', None]
+    assert 0.9 <= resolved['match_score'][0] < 1
+
+    resolved = resolver.resolve(df, approximate=False)
+    assert resolved['suggested_number'].isna().all()
+    assert resolved['match_score'].isna().tolist() == [True, False, True]
+
+
+def test_update_reindexes_students_who_left_or_joined(students):
+    resolver = StudentResolver(students)
+    roster = students.drop([101, 104]).copy()
+    roster.loc[106] = ['Haddad', 'Omar', None]
+    resolver.update(roster, removed=[101, 104], added=[106])
+    resolved = resolver.resolve(names(('Johansson', 'Peter'),
+                                      ('Haddad', 'Omar'), ('Lee', 'Kim')))
+    # Kim Lee is no longer ambiguous.
+    assert list(resolved['student_number']) == [pd.NA, 106, 103]
+
+
+def test_resolver_matches_synthetic_enrollments(synthetic):
+    roster = synthetic.roster.set_index('student_number')
+    enrollments = synthetic.enrollments().rename(
+        columns={'last': 'student_last', 'first': 'student_first'})
+    resolved = StudentResolver(roster).resolve(enrollments)
+
+    exact = resolved['match_method'] == 'exact'
+    assert exact.mean() > .95
+    assert (resolved.loc[exact, 'student_number'].to_numpy()
+            == enrollments.loc[exact, 'student_number'].to_numpy()).all()
+    fuzzy = resolved['match_method'] == 'fuzzy'
+    right = (resolved.loc[fuzzy, 'suggested_number'].to_numpy()
+             == enrollments.loc[fuzzy, 'student_number'].to_numpy())
+    assert fuzzy.any() and right.mean() > .95
+
+
+def test_resolution_table_learns_applies_and_prunes(tmp_path, students):
+    corrected = tmp_path / 'unknown-students.csv'
+    pd.DataFrame({
+        'source': ['apex', 'idla', 'apex'],
+        'student_last': ['Jonson', 'Smith', 'Doe'],
+        'student_first': ['Pete', 'Ana', 'Jane'],
+        'student_number': [101, 102, None]
+    }).to_csv(corrected, index=False)
+    path = str(tmp_path / 'student-resolutions.json')
+
+    table = ResolutionTable(path)
+    assert table.learn(str(corrected)) == 2
+    assert table.learn(str(corrected)) == 0
+    table.save()
+    table = ResolutionTable(path)
+    assert len(table) == 2
+
+    resolver = StudentResolver(students, resolutions=table)
+    resolved = resolver.resolve(names(('Jonson', 'Pete'), ('Jonson', 'Pete'),
+                                      source=['apex', 'idla']))
+    assert list(resolved['student_number']) == [101, pd.NA]
+    assert methods(resolved) == ['manual', None]
+
+    assert table.prune([101, 103]) == 1
+    table.save()
+    with open(path) as f:
+        assert list(json.load(f)['entries'].values()) == [101]
+    # The resolver forgets students who leave the roster.
+    StudentResolver(students.drop(101), resolutions=table)
+    assert len(table) == 0
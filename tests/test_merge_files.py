@@ -0,0 +1,153 @@
+import argparse
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+import merge_files
+from matching import StudentResolver
+from merge_files import cached_source
+
+
+def parse(file_path, scale=1):
+    parse.calls += 1
+    with open(file_path) as f:
+        return pd.DataFrame({'value': [scale * int(line) for line in f]})
+
+
+def write(file_path, *values):
+    with open(file_path, 'w') as f:
+        f.write(''.join('{}\n'.format(value) for value in values))
+
+
+def test_cached_source_serves_until_the_file_changes(tmp_path):
+    cached = cached_source(version=1)(parse)
+    cache_dir = str(tmp_path / 'cache')
+    file_path = str(tmp_path / 'export.csv')
+    write(file_path, 1, 2)
+    parse.calls = 0
+
+    first = cached(file_path, cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(cached(file_path, cache_dir=cache_dir),
+                                  first)
+    assert parse.calls == 1
+    assert os.stat(cache_dir).st_mode & 0o777 == 0o700
+
+    write(file_path, 1, 2, 3)
+    assert list(cached(file_path, cache_dir=cache_dir)['value']) == [1, 2, 3]
+    assert list(cached(file_path, 10, cache_dir=cache_dir)['value']) == [
+        10, 20, 30]
+    assert parse.calls == 3
+    # Only the latest entry for each file is kept.
+    assert len(os.listdir(cache_dir)) == 1
+
+    # Without a directory, nothing is cached.
+    cached(file_path)
+    assert parse.calls == 4
+
+
+def test_cached_source_is_keyed_by_version(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    file_path = str(tmp_path / 'export.csv')
+    write(file_path, 1)
+    parse.calls = 0
+    cached_source(version=1)(parse)(file_path, cache_dir=cache_dir)
+    cached_source(version=2)(parse)(file_path, cache_dir=cache_dir)
+    cached_source(version=2)(parse)(file_path, cache_dir=cache_dir)
+    assert parse.calls == 2
+
+
+def test_unreadable_cache_entries_are_replaced(tmp_path):
+    cached = cached_source(version=1)(parse)
+    cache_dir = str(tmp_path / 'cache')
+    file_path = str(tmp_path / 'export.csv')
+    write(file_path, 1)
+    parse.calls = 0
+    cached(file_path, cache_dir=cache_dir)
+    (entry,) = os.listdir(cache_dir)
+    write(os.path.join(cache_dir, entry), 'not a pickle')
+
+    assert list(cached(file_path, cache_dir=cache_dir)['value']) == [1]
+    assert parse.calls == 2
+
+
+def test_cached_exports_match_fresh_ones(tmp_path, synthetic):
+    exports = synthetic.write_exports(str(tmp_path))
+    cache_dir = str(tmp_path / 'cache')
+    for name in ['apex', 'idla', 'schoology', 'byu']:
+        fresh = merge_files.make_source(exports[name], name)
+        merge_files.make_source(exports[name], name, cache_dir=cache_dir)
+        pd.testing.assert_frame_equal(
+            merge_files.make_source(exports[name], name, cache_dir=cache_dir),
+            fresh)
+
+
+def test_approximate_matches_are_only_suggested(tmp_path):
+    students = pd.DataFrame({
+        'school_id': [616, 615],
+        'last_name': ['Johansson', 'Okafor'],
+        'first_name': ['Peter', 'Chidi']
+    }, index=pd.Index([101, 102], name='student_number'))
+    apex = pd.DataFrame({
+        'student_last': ['Johansson', 'Johanssno', 'Okafor'],
+        'student_first': ['Peter', 'Peter', 'Chidi'],
+        'course': ['Algebra', 'Biology', 'Algebra'],
+        'grade': [95., 75., 55.]
+    })
+    resolver = StudentResolver(students)
+    out = merge_files.merge_sources({'apex': apex}, students,
+                                    resolver=resolver)
+    # Sorted by name, the typo first.
+    assert out['student_number'].isnull().tolist() == [True, False, False]
+    assert list(out['letter_grade']) == ['C', 'A', 'F']
+
+    out_path = str(tmp_path / 'report.csv')
+    args = argparse.Namespace(silence_output=False)
+    merge_files.write_outputs(args, out, out_path, 'csv', resolver=resolver)
+    unknowns = pd.read_csv(str(tmp_path / 'unknown-students.csv'))
+    assert list(unknowns['student_last']) == ['Johanssno']
+    assert unknowns['student_number'].isnull().all()
+    assert list(unknowns['suggested_number']) == [101]
+    assert list(unknowns['match_method']) == ['fuzzy']
+    assert len(pd.read_csv(out_path)) == 3
+
+
+def test_students_are_downloaded_while_the_files_are_checked(tmp_path,
+                                                             synthetic,
+                                                             monkeypatch):
+    exports = synthetic.write_exports(str(tmp_path))
+    apex = pd.read_csv(exports['apex'], dtype=str)
+    apex.loc[10, 'ClassroomName'] = 'Algebra I'
+    apex.to_csv(exports['apex'], index=False)
+    started = threading.Event()
+    released = threading.Event()
+
+    def make_student_list(roster=None):
+        started.set()
+        released.wait(10)
+        return pd.DataFrame()
+    monkeypatch.setattr(merge_files, 'make_student_list', make_student_list)
+
+    argv = ['-o', str(tmp_path), '-j', '1', '--no-source-cache',
+            '--no-roster', '--no-history']
+    for name in ['apex', 'idla', 'schoology', 'byu']:
+        argv += ['--' + name, exports[name]]
+    # The invalid file stops the run without waiting for the download.
+    with pytest.raises(merge_files.SourceError):
+        merge_files.run(merge_files.parse_args(argv))
+    assert started.is_set() and not released.is_set()
+    released.set()
+
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_a_run_writes_the_report(tmp_path, synthetic, fake_server, jobs):
+    exports = synthetic.write_exports(str(tmp_path))
+    argv = ['-o', str(tmp_path / 'report.csv'), '-j', jobs, '-q',
+            '--no-source-cache', '--no-roster', '--no-history']
+    for name in ['apex', 'idla', 'schoology', 'byu']:
+        argv += ['--' + name, exports[name]]
+    merge_files.run(merge_files.parse_args(argv))
+    report = pd.read_csv(str(tmp_path / 'report.csv'))
+    assert set(report['source']) == {'apex', 'idla', 'schoology', 'byu'}
+    assert report['student_number'].notnull().any()
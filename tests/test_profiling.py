@@ -0,0 +1,99 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import profiling
+import ps_agent
+from profiling import span
+
+
+@pytest.fixture
+def tracer():
+    tracer = profiling.enable()
+    yield tracer
+    profiling.disable()
+
+
+def by_name(tracer):
+    return {record['name']: record for record in tracer.to_dicts()}
+
+
+def test_spans_cost_nothing_while_disabled():
+    assert not profiling.enabled()
+    assert span('stage', rows=1) is profiling.NULL_SPAN
+    with span('stage') as s:
+        s.set(rows=1)
+        s.add('http_bytes', 10)
+    assert profiling.current() is profiling.NULL_SPAN
+    assert profiling.settings() is None
+
+
+def test_spans_nest_and_roll_up_counters(tracer):
+    with span('run') as run:
+        with span('parse', path='apex.csv') as parse:
+            parse.set(rows=3)
+            parse.add('http_bytes', 10)
+            parse.add('cache_hits')
+        with pytest.raises(ValueError):
+            with span('merge'):
+                raise ValueError()
+    spans = by_name(tracer)
+    assert spans['parse']['parent'] == run.id
+    assert spans['parse']['attrs'] == {'path': 'apex.csv', 'rows': 3}
+    assert spans['merge']['attrs'] == {'error': 'ValueError'}
+    # Only the rollup counters are added into the parent.
+    assert spans['run']['counters'] == {'http_bytes': 10}
+    assert spans['run']['wall'] >= spans['parse']['wall'] >= 0
+
+
+def test_bound_functions_nest_in_the_callers_span(tracer):
+    def work(i):
+        with span('page', page=i) as s:
+            s.add('http_requests')
+
+    with span('query') as query:
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            list(pool.map(profiling.bind(work), range(6)))
+        # Unbound, the pages have no parent.
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pool.submit(work, 6).result()
+    pages = [r for r in tracer.to_dicts() if r['name'] == 'page']
+    assert sorted(r['attrs']['page'] for r in pages
+                  if r['parent'] == query.id) == list(range(6))
+    assert query.counters == {'http_requests': 6}
+
+
+def test_spans_of_other_processes_are_merged(tracer):
+    worker = profiling.Tracer()
+    with worker.span('make_apex') as make_apex:
+        make_apex.add('http_bytes', 5)
+    with span('load') as load:
+        profiling.merge(worker.to_dicts())
+    spans = by_name(tracer)
+    assert spans['make_apex']['parent'] == load.id
+    assert load.counters == {'http_bytes': 5}
+
+
+def test_trace_is_written_as_trace_events(tmp_path, tracer):
+    with span('run', rows=2):
+        pass
+    path = str(tmp_path / 'trace.json')
+    profiling.write(path)
+    with open(path) as f:
+        trace = json.load(f)
+    (event,) = trace['traceEvents']
+    assert event['name'] == 'run' and event['ph'] == 'X'
+    assert event['args']['rows'] == 2
+    assert len(trace['spans']) == 1
+
+
+def test_queries_count_their_requests_and_bytes(tracer, fake_server):
+    with span('download') as download:
+        ps_agent.fetch_sections.fetch_frame()
+    # The token handshake included.
+    assert download.counters['http_requests'] == fake_server.stats['requests']
+    assert download.counters['http_bytes'] == fake_server.stats['bytes_sent']
+    pages = [r for r in tracer.to_dicts() if r['name'] == 'page']
+    assert sum(r['attrs']['rows'] for r in pages) == len(
+        fake_server.tables['sections'])
@@ -0,0 +1,235 @@
+import asyncio
+import json
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+import requests
+
+import ps_agent
+from ps_agent import (PSClient, PSNoConnectionError, PSQueryError,
+                      TokenManager, columns_to_records, records_to_columns)
+
+
+class StubSession(requests.Session):
+    """Answers every request with the same canned response."""
+
+    def __init__(self, status, content=b'{}'):
+        super(StubSession, self).__init__()
+        self.status = status
+        self.content = content
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        r = requests.models.Response()
+        r.status_code = self.status
+        r._content = self.content
+        return r
+
+
+def test_token_is_reused_until_it_is_about_to_expire(fake_server):
+    manager = ps_agent.get_default_client().token_manager
+    token = manager.get_token()
+    assert manager.get_token() == token
+    assert fake_server.stats['tokens'] == 1
+    assert manager.get_token(force=True) != token
+    assert fake_server.stats['tokens'] == 2
+
+    # Tokens valid for less than the leeway are stale from the start.
+    fake_server.token_ttl = manager.leeway / 2
+    manager.get_token(force=True)
+    manager.get_token()
+    assert fake_server.stats['tokens'] == 4
+
+
+def test_one_thread_refreshes_the_token_for_all(fake_server):
+    fake_server.latency = 0.05
+    manager = ps_agent.get_default_client().token_manager
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        tokens = set(pool.map(lambda _: manager.get_token(), range(8)))
+    assert len(tokens) == 1
+    assert fake_server.stats['tokens'] == 1
+
+
+def test_token_is_saved_for_the_next_run(tmp_path, fake_server):
+    path = str(tmp_path / 'token.json')
+    client = ps_agent.get_default_client()
+    token = TokenManager(cache_path=path, client=client).get_token()
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    manager = TokenManager(cache_path=path, client=client)
+    assert manager.get_token() == token
+    assert fake_server.stats['tokens'] == 1
+    manager.invalidate()
+    assert not os.path.exists(path)
+
+
+def test_revoked_tokens_are_replaced(fake_server):
+    records = ps_agent.fetch_sections.fetch_page(1, 10)
+    fake_server.revoke_tokens()
+    assert ps_agent.fetch_sections.fetch_page(1, 10) == records
+    assert fake_server.stats['unauthorized'] == 1
+    assert fake_server.stats['tokens'] == 2
+
+
+def test_tokens_without_an_expiry_get_the_default_ttl():
+    session = StubSession(200, b'{"access_token": "abc", "expires_in": ""}')
+    client = PSClient(base_url='http://ps.test/', session=session)
+    creds = {'PS_CLIENT_ID': 'id', 'PS_CLIENT_SECRET': 'secret'}
+    assert (ps_agent.request_ps_token(creds, client)
+            == ('abc', float(ps_agent.DEFAULT_TOKEN_TTL)))
+
+
+def test_client_retries_transient_failures_of_idempotent_requests():
+    session = StubSession(503)
+    client = PSClient(base_url='http://ps.test/', session=session,
+                      max_retries=2, backoff=0.001)
+    assert client.request('GET', '/ws').status_code == 503
+    assert session.calls == 3
+    # POSTs are only retried when the caller says they are safe to.
+    assert client.post('/ws').status_code == 503
+    assert session.calls == 4
+    client.post('/ws', idempotent=True)
+    assert session.calls == 7
+
+
+def test_client_does_not_retry_other_errors():
+    session = StubSession(404)
+    client = PSClient(base_url='http://ps.test/', session=session,
+                      backoff=0.001)
+    assert client.request('GET', 'ws/missing').status_code == 404
+    assert session.calls == 1
+
+
+def test_unreachable_server_raises_no_connection_error():
+    # Nothing listens on the discard port.
+    client = PSClient(base_url='http://127.0.0.1:9/', max_retries=1,
+                      backoff=0.001, timeout=1)
+    with pytest.raises(PSNoConnectionError):
+        client.request('GET', '/ws')
+
+
+def test_responses_are_requested_gzipped(fake_server):
+    records = ps_agent.fetch_sections.fetch_page(1, 200)
+    size = len(json.dumps({'name': 'sections', 'record': records}))
+    assert fake_server.stats['bytes_sent'] < size / 2
+
+
+def test_pages_are_yielded_in_order(fake_server):
+    fake_server.jitter = 0.02
+    pages = list(ps_agent.fetch_sections.iter_pages(page_size=30,
+                                                    max_workers=4))
+    assert [len(page) for page in pages] == [30] * 16 + [20]
+    assert ([record for page in pages for record in page]
+            == fake_server.tables['sections'])
+
+
+def test_unordered_pages_are_all_yielded(fake_server):
+    fake_server.jitter = 0.02
+    records = list(ps_agent.fetch_sections.iter_records(
+        page_size=30, max_workers=4, ordered=False))
+    assert len(records) == len(fake_server.tables['sections'])
+    assert (sorted(records, key=json.dumps)
+            == sorted(fake_server.tables['sections'], key=json.dumps))
+
+
+def test_stopping_early_leaves_the_other_pages(fake_server):
+    fake_server.latency = 0.01
+    pages = ps_agent.fetch_sections.iter_pages(page_size=10, max_workers=2)
+    next(pages)
+    pages.close()
+    assert fake_server.stats['pages'] <= 1 + 2 * 2
+
+
+def test_uncountable_queries_are_fetched_page_by_page(fake_server,
+                                                      monkeypatch):
+    query = ps_agent.PowerQuery('sections')
+
+    def count():
+        raise PSQueryError(query.url + '/count', 404)
+    monkeypatch.setattr(query, 'count', count)
+    assert (list(query.iter_records(page_size=120))
+            == fake_server.tables['sections'])
+    # The last page is short, so no empty page is asked for.
+    assert fake_server.stats['pages'] == 5
+
+
+def test_gather_queries_keeps_to_the_total_concurrency(fake_server,
+                                                      monkeypatch):
+    fake_server.latency = 0.01
+    lock = threading.Lock()
+    in_flight = Counter()
+    fetch_page = ps_agent.PowerQuery.fetch_page
+
+    def counted_fetch_page(self, page, page_size=None):
+        with lock:
+            in_flight['now'] += 1
+            in_flight['most'] = max(in_flight['most'], in_flight['now'])
+        try:
+            return fetch_page(self, page, page_size)
+        finally:
+            with lock:
+                in_flight['now'] -= 1
+    monkeypatch.setattr(ps_agent.PowerQuery, 'fetch_page',
+                        counted_fetch_page)
+    monkeypatch.setattr(ps_agent.PowerQuery, 'PAGE_SIZE', 50)
+
+    sections, students = asyncio.run(ps_agent.gather_queries(
+        ps_agent.fetch_sections, 'students', concurrency=3))
+    assert sections == fake_server.tables['sections']
+    assert students == fake_server.tables['students']
+    assert in_flight['most'] == 3
+
+
+def test_fetch_many_is_a_synchronous_gather(fake_server):
+    (students,) = ps_agent.fetch_many(ps_agent.fetch_students)
+    assert students == fake_server.tables['students']
+    with pytest.raises(TypeError):
+        ps_agent.fetch_many(ps_agent.fetch_students, page_size=10)
+
+
+def test_async_query_fetches_one_page(fake_server):
+    query = ps_agent.AsyncPowerQuery('sections')
+    records = asyncio.run(query.fetch(page_size=10))
+    assert records == fake_server.tables['sections'][:10]
+    assert fake_server.stats['pages'] == 1
+
+
+def test_fetch_frame_applies_the_declared_dtypes(fake_server):
+    query = ps_agent.fetch_sections
+    frame = query.fetch_frame()
+    expected = pd.DataFrame([ps_agent.flatten_ps_json(record) for record
+                             in fake_server.tables['sections']])
+    assert list(frame.columns) == list(expected.columns)
+    for column, dtype in query.dtypes.items():
+        assert frame[column].dtype == dtype
+    # The repetitive strings are compacted into categoricals.
+    assert isinstance(frame['course_name'].dtype, pd.CategoricalDtype)
+    assert (frame.astype(str) == expected).all().all()
+    assert len(query.fetch_frame(page_size=10)) == 10
+
+
+def test_fetch_frame_makes_columns_with_nulls_nullable(fake_server):
+    fake_server.tables['scores'] = [
+        {'tables': {'scores': {'id': '1', 'points': '5', 'note': 'late'}}},
+        {'tables': {'scores': {'id': '2'}}}]
+    query = ps_agent.PowerQuery('scores', dtypes={'id': 'uint8',
+                                                  'points': 'uint8'})
+    frame = query.fetch_frame(optimize=False)
+    assert frame['id'].dtype == 'uint8'
+    assert frame['points'].dtype == 'UInt8'
+    assert frame['points'].isnull().tolist() == [False, True]
+    assert frame['note'][0] == 'late' and pd.isnull(frame['note'][1])
+
+
+def test_records_are_transposed_into_columns():
+    records = [{'a': 1}, {'b': 2}]
+    assert records_to_columns(records) == {'a': [1, None], 'b': [None, 2]}
+    assert columns_to_records(records_to_columns(records)) == records
+    nested = records + [{'tables': {'t': {'a': 3}, 'u': {'c': 4}}}]
+    assert records_to_columns(nested, flat=True) == {
+        'a': [1, None, 3], 'b': [None, 2, None], 'c': [None, None, 4]}
@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+import ps_agent
+from ps_agent import (PowerQuery, PSCacheMissError, PSNoConnectionError,
+                      PSQueryError, QueryCache, configure_cache,
+                      records_to_columns)
+
+
+RECORDS = [{'id': 1, 'name': 'a'}, {'id': 2}]
+
+
+@pytest.fixture
+def query():
+    return PowerQuery('students',
+                      client=ps_agent.PSClient(base_url='http://ps.test/'))
+
+
+def test_entries_are_served_until_they_expire(tmp_path, query):
+    cache = QueryCache(str(tmp_path), ttl=600)
+    assert cache.lookup(query) is None
+    cache.store(query, 0, records_to_columns(RECORDS))
+
+    assert cache.lookup(query) == records_to_columns(RECORDS)
+    assert cache.lookup(query, page_size=10) is None
+    assert QueryCache(str(tmp_path), ttl=-1).lookup(query) is None
+
+
+def test_entries_are_keyed_by_server(tmp_path, query):
+    cache = QueryCache(str(tmp_path))
+    cache.store(query, 0, records_to_columns(RECORDS))
+    elsewhere = PowerQuery('students', client=ps_agent.PSClient(
+        base_url='http://other.test/'))
+    assert cache.lookup(elsewhere) is None
+
+
+def test_refresh_skips_reading_but_still_writes(tmp_path, query):
+    QueryCache(str(tmp_path)).store(query, 0, records_to_columns(RECORDS))
+    cache = QueryCache(str(tmp_path), refresh=True)
+    assert cache.lookup(query) is None
+    cache.store(query, 0, records_to_columns(RECORDS[:1]))
+    assert (QueryCache(str(tmp_path)).lookup(query)
+            == records_to_columns(RECORDS[:1]))
+
+
+def test_offline_serves_any_age_or_fails(tmp_path, query):
+    cache = QueryCache(str(tmp_path), ttl=-1, offline=True)
+    with pytest.raises(PSCacheMissError):
+        cache.lookup(query)
+    cache.store(query, 0, records_to_columns(RECORDS))
+    assert cache.lookup(query) == records_to_columns(RECORDS)
+
+
+def test_fallback_serves_expired_entries_or_reraises(tmp_path, query):
+    cache = QueryCache(str(tmp_path), ttl=-1)
+    error = PSNoConnectionError()
+    with pytest.raises(PSNoConnectionError):
+        cache.fallback(query, 0, error)
+    cache.store(query, 0, records_to_columns(RECORDS))
+    assert cache.fallback(query, 0, error) == records_to_columns(RECORDS)
+
+
+def test_cache_directory_is_private_and_evicted(tmp_path, query):
+    directory = str(tmp_path / 'cache')
+    cache = QueryCache(directory, max_bytes=1)
+    cache.store(query, 0, records_to_columns(RECORDS))
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    assert os.listdir(directory) == []
+
+
+def test_fetch_uses_the_cache_then_falls_back(tmp_path, fake_server):
+    configure_cache(directory=str(tmp_path), ttl=600)
+    records = ps_agent.fetch_students.fetch()
+    served = fake_server.stats['pages']
+    assert ps_agent.fetch_students.fetch() == records
+    assert fake_server.stats['pages'] == served
+
+    # Expired, and the server fails: the old results are still served.
+    configure_cache(directory=str(tmp_path), ttl=-1)
+    fake_server.error_rate = 1.
+    fake_server.error_statuses = (500,)
+    ps_agent.set_default_client(ps_agent.PSClient(max_retries=0))
+    assert ps_agent.fetch_students.fetch() == records
+
+    # Nothing cached for the sections to fall back on.
+    with pytest.raises(PSQueryError):
+        ps_agent.fetch_sections.fetch()
+
+    # The server rejecting the query is not an outage.
+    fake_server.error_statuses = (404,)
+    with pytest.raises(PSQueryError):
+        ps_agent.fetch_students.fetch()
+    with pytest.raises(PSQueryError):
+        ps_agent.fetch_students.fetch_frame()
+
+    configure_cache(directory=str(tmp_path), offline=True)
+    assert ps_agent.fetch_students.fetch() == records
+    with pytest.raises(PSCacheMissError):
+        ps_agent.fetch_sections.fetch()
+
+
+def test_nothing_is_cached_unless_configured(tmp_path, fake_server):
+    assert ps_agent.get_query_cache() is None
+    ps_agent.fetch_students.fetch()
+    ps_agent.fetch_students.fetch()
+    assert fake_server.stats['records'] == 2 * len(
+        fake_server.tables['students'])
+    assert configure_cache(enabled=False) is None
+    cache = configure_cache(directory=str(tmp_path))
+    assert ps_agent.get_query_cache() is cache
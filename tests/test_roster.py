@@ -0,0 +1,107 @@
+import os
+
+import pandas as pd
+import pytest
+
+from matching import ResolutionTable
+from roster import RosterSnapshot
+
+
+def prepare(students):
+    prepare.rows += len(students)
+    return students.assign(last_first=students['last_name'] + ', '
+                           + students['first_name'])
+
+
+@pytest.fixture
+def fresh(synthetic):
+    prepare.rows = 0
+    return (synthetic.roster.set_index('student_number')
+            .sample(frac=1, random_state=0))
+
+
+def test_first_refresh_prepares_everyone(tmp_path, fresh):
+    snapshot = RosterSnapshot(str(tmp_path / 'roster.pkl'))
+    students = snapshot.refresh(fresh, prepare)
+    pd.testing.assert_frame_equal(students, prepare(fresh).sort_index())
+    assert snapshot.changes is None
+
+
+def test_refresh_only_prepares_what_changed(tmp_path, fresh):
+    path = str(tmp_path / 'roster.pkl')
+    snapshot = RosterSnapshot(path)
+    snapshot.refresh(fresh, prepare)
+    snapshot.resolver()
+    snapshot.save()
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    left, renamed = fresh.index[:3], fresh.index[3:5]
+    new = fresh.drop(left)
+    new.loc[renamed, 'last_name'] = 'Renamed'
+    joined = pd.DataFrame({'school_id': [615], 'last_name': ['Newcomer'],
+                           'first_name': ['Nia']},
+                          index=pd.Index([999999], name='student_number'))
+    new = pd.concat([new, joined])
+
+    prepare.rows = 0
+    snapshot = RosterSnapshot(path)
+    students = snapshot.refresh(new, prepare)
+    assert prepare.rows == 3
+    pd.testing.assert_frame_equal(students, prepare(new).sort_index())
+
+    changes = snapshot.changes
+    assert list(changes.added) == [999999]
+    assert sorted(changes.removed) == sorted(left)
+    assert sorted(changes.changed) == sorted(renamed)
+    assert len(changes) == 6
+    report = changes.report()
+    assert (report['change'].value_counts().to_dict()
+            == {'added': 3, 'removed': 9, 'changed': 2})
+    changed = report[report['change'] == 'changed']
+    assert set(changed['after']) == {'Renamed'}
+
+    # The resolver saved with the snapshot was brought up to date too.
+    resolved = snapshot.resolver().resolve(pd.DataFrame({
+        'student_last': ['Newcomer', fresh.loc[left[0], 'last_name']],
+        'student_first': ['Nia', fresh.loc[left[0], 'first_name']]}))
+    assert resolved['student_number'][0] == 999999
+    assert left[0] not in resolved['student_number'].dropna().tolist()
+
+
+def test_unchanged_refresh_keeps_the_snapshot(tmp_path, fresh):
+    path = str(tmp_path / 'roster.pkl')
+    snapshot = RosterSnapshot(path)
+    snapshot.refresh(fresh, prepare)
+    snapshot.resolver()
+    snapshot.save()
+    saved_at = os.stat(path).st_mtime_ns
+
+    prepare.rows = 0
+    snapshot = RosterSnapshot(path)
+    snapshot.refresh(fresh.sample(frac=1, random_state=1), prepare)
+    assert prepare.rows == 0
+    assert len(snapshot.changes) == 0
+    snapshot.save()
+    assert os.stat(path).st_mtime_ns == saved_at
+
+
+def test_new_columns_start_over(tmp_path, fresh):
+    path = str(tmp_path / 'roster.pkl')
+    snapshot = RosterSnapshot(path)
+    snapshot.refresh(fresh, prepare)
+    snapshot.save()
+
+    snapshot = RosterSnapshot(path)
+    snapshot.refresh(fresh.assign(grade_level=9), prepare)
+    assert snapshot.changes is None
+
+
+def test_resolver_prunes_manual_matches(tmp_path, fresh):
+    snapshot = RosterSnapshot(str(tmp_path / 'roster.pkl'))
+    snapshot.refresh(fresh, prepare)
+    snapshot.resolver()
+    table = ResolutionTable()
+    table.entries = {'apex\tGone, Student': 1,
+                     'apex\tStill, Here': int(fresh.index[0])}
+    assert snapshot.resolver(table).resolutions is table
+    assert list(table.entries.values()) == [fresh.index[0]]
@@ -0,0 +1,147 @@
+import threading
+import time
+
+import pytest
+
+import ps_agent
+from ps_agent import (BULK, INTERACTIVE, NORMAL, RequestScheduler,
+                      parse_retry_after)
+
+
+def test_interactive_requests_go_before_queued_bulk_ones():
+    scheduler = RequestScheduler(rate=None, concurrency=1)
+    order = []
+
+    def send(priority, name):
+        started = scheduler.acquire(priority)
+        order.append(name)
+        scheduler.release(started, 200)
+
+    blocker = scheduler.acquire(BULK)
+    threads = []
+    for priority, name in [(BULK, 'bulk 1'), (BULK, 'bulk 2'),
+                           (NORMAL, 'normal'), (INTERACTIVE, 'interactive')]:
+        threads.append(threading.Thread(target=send, args=(priority, name)))
+        threads[-1].start()
+        # Let each one join the queue before the next.
+        while scheduler.stats()['waiting'] < len(threads):
+            time.sleep(0.001)
+    scheduler.release(blocker, 200)
+    for thread in threads:
+        thread.join()
+
+    assert order == ['interactive', 'normal', 'bulk 1', 'bulk 2']
+    stats = scheduler.stats()
+    assert stats['interactive'] == 1 and stats['bulk'] == 3
+
+
+def test_rate_limit_allows_bursts_then_paces():
+    scheduler = RequestScheduler(rate=100, burst=5)
+    start = time.monotonic()
+    for _ in range(5):
+        scheduler.release(scheduler.acquire(), 200)
+    assert time.monotonic() - start < 0.03
+    for _ in range(10):
+        scheduler.release(scheduler.acquire(), 200)
+    assert time.monotonic() - start >= 0.09
+
+
+@pytest.mark.parametrize('outcome', [{'status': 429}, {'status': 503},
+                                     {'timed_out': True}])
+def test_throttling_halves_the_concurrency(outcome):
+    scheduler = RequestScheduler(rate=None, concurrency=8)
+    scheduler.release(scheduler.acquire(), **outcome)
+    assert scheduler.concurrency == 4
+    assert scheduler.stats()['decreases'] == 1
+
+
+def test_concurrency_is_halved_once_per_round_trip():
+    scheduler = RequestScheduler(rate=None, concurrency=8)
+    in_flight = [scheduler.acquire() for _ in range(4)]
+    time.sleep(0.05)
+    for started in in_flight:
+        scheduler.release(started, 429)
+    assert scheduler.concurrency == 4
+    assert scheduler.counters['throttled'] == 4
+
+
+def test_concurrency_never_drops_below_the_minimum():
+    scheduler = RequestScheduler(rate=None, concurrency=2, min_concurrency=2)
+    scheduler.release(scheduler.acquire(), 503)
+    assert scheduler.concurrency == 2
+
+
+def _saturate(scheduler, n):
+    """Sends `n` batches of as many requests as the limit allows."""
+    for _ in range(n):
+        in_flight = [scheduler.acquire()
+                     for _ in range(scheduler.concurrency)]
+        for started in in_flight:
+            scheduler.release(started, 200)
+
+
+def test_concurrency_grows_by_one_per_saturated_window():
+    scheduler = RequestScheduler(rate=None, concurrency=2, max_concurrency=3)
+    for _ in range(4):
+        scheduler.release(scheduler.acquire(), 200)
+    # One request at a time never uses the limit up.
+    assert scheduler.concurrency == 2
+
+    # Only the first release of each batch finds the limit used up.
+    _saturate(scheduler, 1)
+    assert scheduler.concurrency == 2
+    _saturate(scheduler, 1)
+    assert scheduler.concurrency == 3
+    _saturate(scheduler, 10)
+    assert scheduler.concurrency == 3
+    assert scheduler.stats()['increases'] == 1
+
+
+def test_slow_responses_lower_the_concurrency():
+    scheduler = RequestScheduler(rate=None, concurrency=8,
+                                 latency_target=0.01)
+    started = scheduler.acquire()
+    time.sleep(0.02)
+    scheduler.release(started, 200)
+    assert scheduler.concurrency == 4
+
+
+def test_retry_after_holds_back_every_request():
+    scheduler = RequestScheduler(rate=None)
+    scheduler.release(scheduler.acquire(), 429, retry_after=0.1)
+    assert scheduler.stats()['paused'] > 0
+    start = time.monotonic()
+    scheduler.release(scheduler.acquire(INTERACTIVE), 200)
+    assert time.monotonic() - start >= 0.09
+    assert scheduler.counters['pauses'] == 1
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('2') == 2.
+    assert parse_retry_after('-1') == 0.
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.
+    assert parse_retry_after('Wed, 21 Oct 2099 07:28:00 GMT') > 0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+def test_client_retries_throttled_requests(fake_server):
+    fake_server.error_rate = 0.4
+    fake_server.error_statuses = (429,)
+    fake_server.retry_after = 0.01
+    scheduler = ps_agent.configure_scheduler(rate=None, concurrency=4)
+    client = ps_agent.PSClient(max_retries=20, backoff=0.01,
+                               max_backoff=0.05)
+    query = ps_agent.PowerQuery('sections', client=client, priority=BULK)
+
+    records = list(query.iter_records(page_size=25))
+    client.close()
+
+    assert records == fake_server.tables['sections']
+    stats = scheduler.stats()
+    assert stats['throttled'] == fake_server.stats['errors_429'] > 0
+    assert stats['pauses'] == stats['throttled']
+    # Only the token handshake jumps the queue.
+    assert stats['interactive'] == fake_server.stats['tokens'] == 1
+    assert stats['bulk'] == stats['requests'] - 1
+    assert stats['in_flight'] == 0
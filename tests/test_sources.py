@@ -0,0 +1,143 @@
+import pandas as pd
+import pytest
+
+import merge_files  # noqa: F401 -- registers the vendors' schemas
+from sources import (PROBLEM_COLUMNS, SOURCES, Split, cast, read_checked,
+                     read_source, validate)
+
+
+@pytest.fixture(scope='module')
+def exports(tmp_path_factory, synthetic):
+    return synthetic.write_exports(str(tmp_path_factory.mktemp('exports')))
+
+
+@pytest.fixture
+def corrupt_apex(tmp_path, exports):
+    """An Apex export with three bad values, and the lines they are on."""
+    df = pd.read_csv(exports['apex'], dtype=str)
+    df.loc[10, 'TotalPointsPossible'] = 'lots'
+    df.loc[20, 'ClassroomName'] = 'Biology - A'
+    df.loc[30, 'ClassroomStartDate'] = 'last Tuesday'
+    path = str(tmp_path / 'apex.csv')
+    df.to_csv(path, index=False)
+    return path, [12, 22, 32]
+
+
+def test_sources_are_registered_in_merge_order():
+    assert list(SOURCES) == ['byu', 'apex', 'idla', 'schoology']
+
+
+@pytest.mark.parametrize('name', ['apex', 'idla', 'schoology', 'byu'])
+def test_exports_are_read_as_their_schemas_say(exports, name):
+    schema = SOURCES[name]
+    df = read_source(schema, exports[name])
+    assert len(df) > 0
+    assert list(df.index) == list(range(len(df)))
+    for column in schema.raw_columns:
+        assert schema.columns[column] in df
+    for column, dtype in schema.dtypes.items():
+        assert df[column].dtype == cast(df[column], dtype).dtype
+    if schema.dedupe:
+        assert not df.duplicated().any()
+    pd.testing.assert_frame_equal(
+        read_source(schema, exports[name], chunksize=100), df)
+
+
+def test_splits_and_derived_columns(exports):
+    apex = read_source(SOURCES['apex'], exports['apex'])
+    assert apex['section_number'].dtype == 'uint16'
+    assert not apex['course'].str.contains(' - ').any()
+    idla = read_source(SOURCES['idla'], exports['idla'])
+    assert idla['grade'].dtype == 'float32'
+    assert idla['grade_date'].notnull().all()
+    schoology = read_source(SOURCES['schoology'], exports['schoology'])
+    assert (schoology['student'] == schoology['student_last'] + ', '
+            + schoology['student_first']).all()
+
+
+def test_split_without_any_separator_leaves_the_parts_empty():
+    df = pd.DataFrame({'name': ['Lee', 'Kim']})
+    Split('name', ',', ['last', 'first']).apply(df)
+    assert list(df['last']) == ['Lee', 'Kim']
+    assert df['first'].isnull().all()
+
+
+def test_predicates_can_be_skipped(exports):
+    schema = SOURCES['apex']
+    n_rows = len(read_source(schema, exports['apex'], skip=['demo']))
+    assert n_rows > len(read_source(schema, exports['apex']))
+    problems, df = read_checked(schema, exports['apex'], skip=['demo'])
+    assert len(df) == n_rows
+    with pytest.raises(KeyError):
+        read_source(schema, exports['apex'], skip=['no such predicate'])
+    with pytest.raises(KeyError):
+        validate(schema, exports['apex'], skip=['no such predicate'])
+
+
+@pytest.mark.parametrize('name', ['apex', 'idla', 'schoology', 'byu'])
+def test_clean_exports_have_no_problems(exports, name):
+    problems = validate(SOURCES[name], exports[name])
+    assert list(problems.columns) == PROBLEM_COLUMNS
+    assert len(problems) == 0
+
+
+@pytest.mark.parametrize('name', ['apex', 'idla', 'schoology', 'byu'])
+def test_read_checked_reads_as_read_source(exports, name):
+    schema = SOURCES[name]
+    problems, df = read_checked(schema, exports[name], chunksize=500)
+    assert len(problems) == 0
+    pd.testing.assert_frame_equal(df, read_source(schema, exports[name]))
+
+
+def test_validate_finds_each_bad_value(corrupt_apex):
+    path, lines = corrupt_apex
+    problems = validate(SOURCES['apex'], path)
+    assert list(problems['line']) == lines
+    assert list(problems['column']) == ['points_possible', 'section_number',
+                                        'start_date']
+    assert list(problems['value']) == ['lots', 'Biology - A',
+                                       'last Tuesday']
+
+
+@pytest.mark.parametrize('name, column, value, problem', [
+    ('apex', 'ClassroomName', 'Algebra I', "no ' - '"),
+    ('idla', 'Grade', '88', "no ' as of '")
+])
+def test_values_without_the_separator_are_found(tmp_path, exports, name,
+                                                column, value, problem):
+    df = pd.read_csv(exports[name], dtype=str)
+    df.loc[10, column] = value
+    path = str(tmp_path / 'export.csv')
+    df.to_csv(path, index=False)
+    schema = SOURCES[name]
+    problems = validate(schema, path)
+    assert problems.to_dict('records') == [{
+        'line': 12, 'column': schema.columns[column], 'value': value,
+        'problem': problem}]
+    pd.testing.assert_frame_equal(read_checked(schema, path)[0], problems)
+
+
+def test_read_checked_reports_what_validate_does(corrupt_apex):
+    path, lines = corrupt_apex
+    schema = SOURCES['apex']
+    problems, df = read_checked(schema, path, chunksize=15)
+    assert df is None
+    pd.testing.assert_frame_equal(problems, validate(schema, path))
+
+
+def test_quarantine_leaves_the_bad_lines_out(corrupt_apex):
+    path, lines = corrupt_apex
+    schema = SOURCES['apex']
+    problems, df = read_checked(schema, path, chunksize=15, quarantine=True)
+    assert list(problems['line']) == lines
+    pd.testing.assert_frame_equal(
+        df, read_source(schema, path, skip_lines=lines))
+
+
+def test_missing_columns_are_an_error(tmp_path):
+    path = str(tmp_path / 'apex.csv')
+    pd.DataFrame({'LastName': ['Lee']}).to_csv(path, index=False)
+    with pytest.raises(ValueError):
+        validate(SOURCES['apex'], path)
+    with pytest.raises(ValueError):
+        read_checked(SOURCES['apex'], path)
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import watching
+from watching import FileWatcher
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [0.]
+    monkeypatch.setattr(watching.time, 'monotonic', lambda: clock[0])
+    return clock
+
+
+def write(file_path, text, mtime):
+    with open(file_path, 'w') as f:
+        f.write(text)
+    os.utime(file_path, (mtime, mtime))
+
+
+def test_changes_are_reported_once_they_settle(tmp_path, clock):
+    file_path = str(tmp_path / 'apex.csv')
+    write(file_path, 'a', 1)
+    watcher = FileWatcher({'apex': file_path}, settle=2.)
+    assert watcher.poll() == []
+
+    write(file_path, 'ab', 2)
+    assert watcher.poll() == []
+    clock[0] = 1.
+    # Still being written: the settling period starts over.
+    write(file_path, 'abc', 3)
+    assert watcher.poll() == []
+    clock[0] = 2.5
+    assert watcher.poll() == []
+    clock[0] = 3.
+    assert watcher.poll() == ['apex']
+    clock[0] = 10.
+    assert watcher.poll() == []
+
+
+def test_changes_undone_before_settling_are_not_reported(tmp_path, clock):
+    file_path = str(tmp_path / 'apex.csv')
+    write(file_path, 'a', 1)
+    watcher = FileWatcher({'apex': file_path}, settle=2.)
+    write(file_path, 'ab', 2)
+    assert watcher.poll() == []
+    write(file_path, 'a', 1)
+    assert watcher.poll() == []
+    clock[0] = 5.
+    assert watcher.poll() == []
+
+
+def test_missing_files_are_reported_when_they_are_back(tmp_path, clock):
+    file_path = str(tmp_path / 'idla.csv')
+    write(file_path, 'a', 1)
+    watcher = FileWatcher({'idla': file_path}, settle=1.)
+    os.remove(file_path)
+    assert watcher.poll() == []
+    clock[0] = 5.
+    assert watcher.poll() == []
+
+    write(file_path, 'b', 2)
+    assert watcher.poll() == []
+    clock[0] = 6.
+    assert watcher.poll() == ['idla']
+
+
+def test_wait_returns_the_settled_files(tmp_path):
+    file_path = str(tmp_path / 'byu.csv')
+    watcher = FileWatcher({'byu': file_path}, settle=0., interval=.01)
+    write(file_path, 'a', 1)
+    assert watcher.wait() == ['byu']
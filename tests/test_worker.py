@@ -0,0 +1,83 @@
+import io
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import lazy
+import worker
+from worker import Worker
+
+
+def test_lazy_modules_run_on_first_use(tmp_path, monkeypatch):
+    (tmp_path / 'slow_module.py').write_text(
+        'import sys\nsys.slow_module_loads += 1\nanswer = 42\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, 'slow_module_loads', 0, raising=False)
+    monkeypatch.delitem(sys.modules, 'slow_module', raising=False)
+    try:
+        module = lazy.lazy_import('slow_module')
+        assert sys.slow_module_loads == 0
+        assert lazy.lazy_import('slow_module') is module
+        lazy.load(module)
+        assert sys.slow_module_loads == 1
+        assert module.answer == 42
+        assert sys.slow_module_loads == 1
+    finally:
+        sys.modules.pop('slow_module', None)
+
+
+def test_lazy_import_of_a_missing_module_fails_at_once():
+    with pytest.raises(ImportError):
+        lazy.lazy_import('no_such_module_anywhere')
+
+
+@pytest.fixture
+def running_worker(tmp_path):
+    state_path = str(tmp_path / 'worker.json')
+    running = Worker(state_path=state_path)
+    thread = threading.Thread(target=running.serve_forever)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while not os.path.exists(state_path) and time.monotonic() < deadline:
+        time.sleep(.01)
+    yield state_path
+    worker.stop(state_path)
+    thread.join(5)
+
+
+def test_no_worker_means_no_submission(tmp_path):
+    state_path = str(tmp_path / 'worker.json')
+    assert worker.submit('merge_files', [], state_path=state_path) is None
+    assert not worker.stop(state_path)
+    assert worker.stats(state_path) is None
+
+
+def test_runs_are_streamed_back_with_their_status(running_worker):
+    output = io.StringIO()
+    status = worker.submit('make_classchoice', ['--help'], stream=output,
+                           state_path=running_worker)
+    assert status == 0
+    assert 'usage:' in output.getvalue()
+
+    output = io.StringIO()
+    assert worker.submit('rm', ['-rf'], stream=output,
+                         state_path=running_worker) == 2
+    assert output.getvalue() == 'Unknown script "rm".\n'
+    assert worker.stats(running_worker)['in_flight'] == 0
+
+
+def test_clients_need_the_key(running_worker, tmp_path):
+    with open(running_worker) as f:
+        state = f.read()
+    forged = tmp_path / 'forged.json'
+    forged.write_text(state.replace('"authkey": "', '"authkey": "00'))
+    # Treated as no worker at all, so that the script runs itself.
+    assert worker.submit('make_classchoice', ['--help'],
+                         state_path=str(forged)) is None
+    # The worker still serves the others.
+    assert worker.submit('make_classchoice', ['--help'],
+                         stream=io.StringIO(),
+                         state_path=running_worker) == 0
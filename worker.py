@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""
+A resident process that keeps pandas, NumPy and a PowerSchool session
+loaded between runs of the scripts, so that repeated runs skip the
+seconds spent starting up:
+
+    python worker.py                                # start it
+    python grade_reports/merge_files.py --worker    # runs in the worker
+    python worker.py --stats                        # its PowerSchool traffic
+    python worker.py --stop
+
+The worker listens on a local port only. Clients prove that they may use
+it with a random key that the worker writes, with the port, to
+:data:`STATE_PATH`, a file only the user can read. Runs are carried out
+one at a time, in the client's working directory, and their output is
+streamed back to the client as it is written. A client that finds no
+worker running simply runs the script itself.
+"""
+
+import argparse
+import importlib
+import io
+import json
+import logging
+import os
+import secrets
+import sys
+import threading
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from typing import List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.realpath(__file__))
+STATE_PATH = os.path.join(os.path.expanduser('~'), '.osd-worker.json')
+# The scripts a worker runs, and the directories they live in.
+SCRIPTS = {
+    'merge_files': os.path.join(REPO_ROOT, 'grade_reports'),
+    'make_classchoice': os.path.join(REPO_ROOT, 'class_choice')
+}
+
+
+class _Stream(io.TextIOBase):
+    """Sends whatever is written to it to the client."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        # type: (str) -> int
+        if text:
+            with self._lock:
+                self.connection.send(('output', text))
+        return len(text)
+
+
+class Worker(object):
+    """
+    Runs the scripts' `main` functions on behalf of clients.
+
+    :ivar str state_path: where the port and key are written
+    """
+
+    def __init__(self, port=0, state_path=STATE_PATH):
+        # type: (int, str) -> None
+        self.state_path = state_path
+        self.authkey = secrets.token_bytes(32)
+        self.listener = Listener(('127.0.0.1', port), authkey=self.authkey)
+
+    @property
+    def port(self):
+        # type: () -> int
+        return self.listener.address[1]
+
+    def warm(self):
+        # type: () -> None
+        """Loads the libraries and the scripts and fetches a token."""
+        logger = logging.getLogger(__name__)
+        for directory in SCRIPTS.values():
+            if directory not in sys.path:
+                sys.path.insert(0, directory)
+        import numpy  # noqa: F401
+        import pandas  # noqa: F401
+        for script in SCRIPTS:
+            importlib.import_module(script)
+        import ps_agent
+        ps_agent.get_default_client()
+        try:
+            ps_agent.get_ps_token()
+        except Exception as e:
+            logger.warning('Could not fetch a PowerSchool token yet: {}'
+                           .format(e))
+
+    def serve_forever(self):
+        # type: () -> None
+        logger = logging.getLogger(__name__)
+        self._write_state()
+        logger.info('Worker listening on port {}. Stop it with CTRL+C or '
+                    '"python worker.py --stop".'.format(self.port))
+        try:
+            while True:
+                try:
+                    connection = self.listener.accept()
+                except Exception as e:
+                    # E.g. a client with the wrong key.
+                    logger.warning('Refused a connection: {}'.format(e))
+                    continue
+                with connection:
+                    try:
+                        message = connection.recv()
+                        if message[0] == 'stop':
+                            connection.send(('exit', 0))
+                            break
+                        if message[0] == 'stats':
+                            import ps_agent
+                            connection.send(
+                                ('exit', ps_agent.get_scheduler().stats()))
+                            continue
+                        _, script, argv, cwd = message
+                        logger.info('Running {} {}'.format(script,
+                                                           ' '.join(argv)))
+                        status = self.run(script, argv, cwd,
+                                          _Stream(connection))
+                        connection.send(('exit', status))
+                    except (EOFError, OSError) as e:
+                        logger.warning('Lost the client: {}'.format(e))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+        logger.info('Worker stopped.')
+
+    def run(self, script, argv, cwd, stream):
+        # type: (str, List[str], str, io.TextIOBase) -> int
+        """
+        Runs a script's `main` with the arguments `argv` in the directory
+        `cwd`, writing its output to `stream`.
+
+        :return: the exit status
+        """
+        import profiling
+
+        if script not in SCRIPTS:
+            stream.write('Unknown script "{}".\n'.format(script))
+            return 2
+        module = importlib.import_module(script)
+        # The scripts configure logging on every run; let them.
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+        for handler in handlers:
+            root.removeHandler(handler)
+        previous = os.getcwd()
+        status = 0
+        try:
+            os.chdir(cwd)
+            with redirect_stdout(stream), redirect_stderr(stream):
+                try:
+                    # Worker processes would each load pandas again.
+                    module.main(['--jobs', '1'] + argv, interactive=False)
+                except SystemExit as e:
+                    status = e.code if isinstance(e.code, int) else int(
+                        e.code is not None)
+                except Exception as e:
+                    traceback.print_exc(file=stream)
+                    stream.write('Failed with error: "{}"\n'.format(e))
+                    status = 1
+        finally:
+            os.chdir(previous)
+            profiling.disable()
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+            for handler in handlers:
+                root.addHandler(handler)
+        return status
+
+    def _write_state(self):
+        # type: () -> None
+        fd = os.open(self.state_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'port': self.port, 'authkey': self.authkey.hex(),
+                       'pid': os.getpid()}, f)
+
+    def close(self):
+        # type: () -> None
+        self.listener.close()
+        try:
+            with open(self.state_path, 'r') as f:
+                mine = json.load(f).get('pid') == os.getpid()
+            if mine:
+                os.remove(self.state_path)
+        except (IOError, OSError, ValueError):
+            pass
+
+
+def _connect(state_path=STATE_PATH):
+    # type: (str) -> Optional[Client]
+    """Connects to the running worker; None if there is none."""
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        return Client(('127.0.0.1', state['port']),
+                      authkey=bytes.fromhex(state['authkey']))
+    except (IOError, OSError, ValueError, KeyError, EOFError,
+            AuthenticationError):
+        # E.g. a stale file left by a worker that is gone.
+        return None
+
+
+def submit(script, argv, stream=None, state_path=STATE_PATH):
+    # type: (str, List[str], Optional[io.TextIOBase], str) -> Optional[int]
+    """
+    Runs `script` with the arguments `argv` in the worker, in this
+    process's working directory, copying its output to `stream` (stdout
+    by default).
+
+    :return: the exit status, or None if no worker is running
+    """
+    connection = _connect(state_path)
+    if connection is None:
+        return None
+    stream = stream or sys.stdout
+    with connection:
+        connection.send(('run', script, list(argv), os.getcwd()))
+        while True:
+            kind, value = connection.recv()
+            if kind == 'exit':
+                return value
+            stream.write(value)
+            stream.flush()
+
+
+def stop(state_path=STATE_PATH):
+    # type: (str) -> bool
+    """Stops the running worker; False if there is none."""
+    connection = _connect(state_path)
+    if connection is None:
+        return False
+    with connection:
+        connection.send(('stop',))
+        connection.recv()
+    return True
+
+
+def stats(state_path=STATE_PATH):
+    # type: (str) -> Optional[dict]
+    """
+    Returns the counters of the running worker's
+    :class:`ps_agent.RequestScheduler`; None if there is no worker.
+    """
+    connection = _connect(state_path)
+    if connection is None:
+        return None
+    with connection:
+        connection.send(('stats',))
+        return connection.recv()[1]
+
+
+def parse_args(argv=None):
+    # type: (Optional[List[str]]) -> argparse.Namespace
+    parser = argparse.ArgumentParser(
+        description='Keep the scripts loaded between runs.')
+    parser.add_argument('-p', '--port', type=int, default=0,
+                        help='the local port to listen on (default: any '
+                             'free one)')
+    parser.add_argument('--stop', action='store_true',
+                        help='stop the running worker')
+    parser.add_argument('--stats', action='store_true',
+                        help="show the running worker's PowerSchool "
+                             'request counters')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> int
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logger = logging.getLogger(__name__)
+    if args.stop:
+        if stop():
+            logger.info('Worker stopped.')
+            return 0
+        logger.info('No worker is running.')
+        return 1
+    if args.stats:
+        counters = stats()
+        if counters is None:
+            logger.info('No worker is running.')
+            return 1
+        for name, value in sorted(counters.items()):
+            logger.info('{:<12} {}'.format(name, value))
+        return 0
+    if _connect() is not None:
+        logger.info('A worker is already running.')
+        return 1
+
+    worker = Worker(port=args.port)
+    logger.info('Loading the libraries.')
+    worker.warm()
+    worker.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())